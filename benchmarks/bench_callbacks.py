@@ -0,0 +1,97 @@
+"""Measures how many messages per second `Callbacks.message` can get through.
+
+Replays a mix of synthetic messages through the callback: messages of moderators,
+thread replies, old messages and messages that have to be moderated. Moderation jobs
+are only counted, not run, so this measures the cost of the callback itself. Every
+message has its own event ID, so none is skipped as a redelivery.
+
+Usage:
+    python -m benchmarks.bench_callbacks [messages]
+"""
+import asyncio
+import copy
+import sys
+import time
+from types import SimpleNamespace
+
+from nio import MatrixRoom, RoomMessageText
+
+from nio_channel_bot.callbacks import Callbacks
+from nio_channel_bot.storage import ProcessedEventCache
+
+BOT_ID = "@bot:example.com"
+MODERATOR_ID = "@moderator:example.com"
+USER_ID = "@user:example.com"
+ROOM_ID = "!channel:example.com"
+
+
+class CountingPipeline:
+    """Stands in for the moderation pipeline, counting the submitted jobs"""
+
+    def __init__(self):
+        self.submitted = 0
+
+    async def submit(self, room_id, job):
+        self.submitted += 1
+
+
+def make_room() -> MatrixRoom:
+    room = MatrixRoom(ROOM_ID, BOT_ID)
+    for user_id in (BOT_ID, MODERATOR_ID, USER_ID):
+        room.add_member(user_id, None, None)
+    room.power_levels.users.update({BOT_ID: 50, MODERATOR_ID: 50})
+    return room
+
+
+def make_message(sender: str, timestamp: int, thread: bool = False) -> RoomMessageText:
+    content = {"msgtype": "m.text", "body": "Hello world, this is a message"}
+    if thread:
+        content["m.relates_to"] = {"rel_type": "m.thread", "event_id": "$root"}
+
+    return RoomMessageText.from_dict(
+        {
+            "type": "m.room.message",
+            "event_id": f"${sender}{timestamp}{thread}",
+            "sender": sender,
+            "origin_server_ts": timestamp,
+            "content": content,
+        }
+    )
+
+
+async def run(count: int) -> None:
+    pipeline = CountingPipeline()
+    client = SimpleNamespace(user=BOT_ID, user_id=BOT_ID)
+    config = SimpleNamespace(command_prefix="!c ", filter_old_messages=False)
+    store = SimpleNamespace(processed=ProcessedEventCache(None))
+    callbacks = Callbacks(client, store, config, None, pipeline)
+    room = make_room()
+
+    now = int(time.time() * 1000)
+    kinds = {
+        "moderator": make_message(MODERATOR_ID, now),
+        "thread": make_message(USER_ID, now, thread=True),
+        "old": make_message(USER_ID, now - 3600 * 1000),
+        "moderated": make_message(USER_ID, now),
+    }
+
+    print(f"{count} messages per kind")
+    total_seconds = 0.0
+    for kind, event in kinds.items():
+        events = [copy.copy(event) for _ in range(count)]
+        for i, copied in enumerate(events):
+            copied.event_id = f"{event.event_id}{i}"
+
+        start = time.perf_counter()
+        for copied in events:
+            await callbacks.message(room, copied)
+        seconds = time.perf_counter() - start
+        total_seconds += seconds
+        print(f"{kind:>10}: {count / seconds:>12,.0f} messages/s")
+
+    print(f"{'overall':>10}: {count * len(kinds) / total_seconds:>12,.0f} messages/s")
+    assert pipeline.submitted == count
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
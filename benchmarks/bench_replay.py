@@ -0,0 +1,474 @@
+"""Replays sync responses through the whole moderation path, against a fake homeserver.
+
+Messages go through `Callbacks.message`, the moderation pipeline, `Command.filter_channel`
+and `ChatFunctions`, which make real HTTP requests to a local `FakeHomeserver`. The
+homeserver can be slowed down and made to rate limit requests.
+
+Reports the throughput, the p50/p99 latency from a message being received to it
+being moderated, the requests made and the memory used.
+
+Usage:
+    python -m benchmarks.bench_replay [--messages 2000] [--latency-ms 5] ...
+    python -m benchmarks.bench_replay --replay recorded_syncs.json
+
+A recorded replay is a JSON list of /sync response bodies. The rooms they join are
+added to the fake homeserver, with the bot as their admin.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional
+
+from nio import AsyncClient, AsyncClientConfig, Event, RoomMessageText, SyncResponse
+
+import nio_channel_bot
+from benchmarks.fake_homeserver import FakeHomeserver, room_state_events
+from nio_channel_bot.callbacks import Callbacks
+from nio_channel_bot.chat_functions import ChatFunctions
+from nio_channel_bot.offload import (
+    CooperativeYield,
+    LoopMonitor,
+    offloader,
+    parse_sync_response,
+)
+from nio_channel_bot.pipeline import ModerationPipeline
+from nio_channel_bot.raid import RaidDetector, RaidMode
+from nio_channel_bot.ratelimit import rate_limiter
+from nio_channel_bot.storage import Storage
+from nio_channel_bot.templates import compile_messages
+
+BOT_ID = "@bot:localhost"
+# Tasks of the bot that run until it stops, rather than until their work is done
+BACKGROUND_TASKS = {
+    "FailCounterCache._flush_periodically",
+    "PersistentOutbox._drain_forever",
+    "ProcessedEventCache._flush_periodically",
+}
+MODERATOR_ID = "@moderator:localhost"
+
+
+class TimedPipeline(ModerationPipeline):
+    """A moderation pipeline recording the time from submitting a job to its end"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []  # type: List[float]
+
+    async def submit(self, room_id, job):
+        submitted_at = time.perf_counter()
+
+        async def timed_job():
+            try:
+                await job()
+            finally:
+                self.latencies.append(time.perf_counter() - submitted_at)
+
+        await super().submit(room_id, timed_job)
+
+
+def sync_response(
+    next_batch: str,
+    rooms: Dict[str, Dict[str, List[Dict[str, Any]]]],
+) -> Dict[str, Any]:
+    """Build the body of a /sync response
+
+    Args:
+        next_batch: The sync token of the response.
+
+        rooms: room_id -> {"state": [...], "timeline": [...]}
+    """
+    return {
+        "next_batch": next_batch,
+        "rooms": {
+            "join": {
+                room_id: {
+                    "state": {"events": events.get("state", [])},
+                    "timeline": {
+                        "events": events.get("timeline", []),
+                        "limited": False,
+                        "prev_batch": next_batch,
+                    },
+                    "ephemeral": {"events": []},
+                    "account_data": {"events": []},
+                }
+                for room_id, events in rooms.items()
+            },
+            "invite": {},
+            "leave": {},
+        },
+    }
+
+
+def synthetic_syncs(
+    homeserver: FakeHomeserver,
+    messages: int,
+    rooms: int,
+    users: int,
+    batch: int,
+    thread_ratio: float,
+    moderator_ratio: float,
+    seed: int,
+) -> Iterator[Dict[str, Any]]:
+    """Generate an initial sync joining the channels, then syncs full of messages"""
+    rng = random.Random(seed)
+    room_ids = [f"!channel{i}:localhost" for i in range(rooms)]
+    user_ids = [f"@user{i}:localhost" for i in range(users)]
+    power_levels = {"users": {BOT_ID: 100, MODERATOR_ID: 50}}
+
+    initial = {}
+    for room_id in room_ids:
+        members = [BOT_ID, MODERATOR_ID] + user_ids
+        homeserver.add_room(room_id, members, power_levels)
+        initial[room_id] = {"state": room_state_events(room_id, members, power_levels)}
+    yield sync_response("s0", initial)
+
+    now = int(time.time() * 1000)
+    for start in range(0, messages, batch):
+        timelines = {}  # type: Dict[str, Dict[str, List[Dict[str, Any]]]]
+        for i in range(start, min(start + batch, messages)):
+            content = {"msgtype": "m.text", "body": f"Message {i}"}
+            roll = rng.random()
+            if roll < thread_ratio:
+                content["m.relates_to"] = {"rel_type": "m.thread", "event_id": "$root"}
+            sender = (
+                MODERATOR_ID
+                if thread_ratio <= roll < thread_ratio + moderator_ratio
+                else rng.choice(user_ids)
+            )
+            room_id = rng.choice(room_ids)
+            timelines.setdefault(room_id, {"timeline": []})["timeline"].append(
+                {
+                    "type": "m.room.message",
+                    "event_id": f"$message{i}",
+                    "sender": sender,
+                    "origin_server_ts": now,
+                    "content": content,
+                }
+            )
+        yield sync_response(f"s{start + 1}", timelines)
+
+
+def recorded_syncs(homeserver: FakeHomeserver, path: str) -> Iterator[Dict[str, Any]]:
+    """Load recorded sync responses, adding the rooms they join to the homeserver"""
+    with open(path) as f:
+        syncs = json.load(f)
+
+    for sync in syncs:
+        for room_id, room in sync.get("rooms", {}).get("join", {}).items():
+            if room_id in homeserver.members:
+                continue
+            events = room.get("state", {}).get("events", []) + room.get(
+                "timeline", {}
+            ).get("events", [])
+            members = [BOT_ID] + [
+                event["state_key"]
+                for event in events
+                if event["type"] == "m.room.member"
+                and event["content"].get("membership") == "join"
+                and event["state_key"] != BOT_ID
+            ]
+            homeserver.add_room(room_id, members, {"users": {BOT_ID: 100}})
+        yield sync
+
+
+def created_room_syncs(homeserver: FakeHomeserver) -> Dict[str, Any]:
+    """Build the rooms section of a sync for the DM rooms created since the last sync"""
+    return {
+        room_id: {
+            "state": room_state_events(
+                room_id,
+                homeserver.members[room_id],
+                homeserver.power_levels[room_id],
+            )
+        }
+        for room_id in homeserver.take_created_rooms()
+    }
+
+
+async def receive_sync(
+    client: AsyncClient, body: Dict[str, Any], offload: bool = False
+) -> None:
+    """Let the client handle a sync response, as `sync_forever` would
+
+    Args:
+        client: The client of the bot.
+
+        body: The sync response body.
+
+        offload: Whether to parse the response outside of the event loop, as
+            `OffloadingClient` does.
+    """
+    created = created_room_syncs(client.fake_homeserver)
+    if created:
+        body = dict(body, rooms=dict(body["rooms"], join={**body["rooms"]["join"]}))
+        body["rooms"]["join"].update(
+            sync_response(body["next_batch"], created)["rooms"]["join"]
+        )
+
+    if offload:
+        response = await offloader.run(
+            "parse_sync", parse_sync_response, body, picklable=False
+        )
+    else:
+        response = SyncResponse.from_dict(body)
+    await client.receive_response(response)
+    await client.run_response_callbacks([response])
+    client.synced.set()
+    client.synced.clear()
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run the benchmark, returning its results"""
+    if args.memory:
+        tracemalloc.start()
+
+    # Pace requests as configured, or not at all by default
+    if not args.rate_limits:
+        rate_limiter.configure(
+            {
+                endpoint: {"rate": 100000, "burst": 100000}
+                for endpoint in ("send", "redact", "state", "create_room")
+            }
+        )
+
+    homeserver = FakeHomeserver(
+        BOT_ID,
+        latency=args.latency_ms / 1000,
+        rate_limit_probability=args.rate_limit_probability,
+        seed=args.seed,
+    )
+    await homeserver.start()
+
+    store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+    await store.connect()
+
+    client = AsyncClient(
+        homeserver.url,
+        BOT_ID,
+        device_id="BENCHMARK",
+        config=AsyncClientConfig(max_limit_exceeded=0, max_timeouts=0),
+    )
+    client.access_token = "token"
+    client.user_id = BOT_ID
+    client.fake_homeserver = homeserver
+
+    config = SimpleNamespace(
+        command_prefix="!c ",
+        filter_old_messages=True,
+        user_id=BOT_ID,
+        messages=compile_messages({}),
+    )
+    chat = ChatFunctions(
+        client,
+        store,
+        messages=config.messages,
+        warning_window=args.warning_window,
+        warning_image_period=3600,
+        outbox={"retry_delay": 0.1},
+    )
+    chat.outbox.start()
+    pipeline = TimedPipeline(args.workers)
+    pipeline.start()
+
+    raid = None
+    if args.raid_threshold:
+        raid = RaidMode(
+            client,
+            store,
+            chat,
+            RaidDetector(args.raid_threshold, window=10, cooldown=60),
+            pipeline,
+        )
+
+    callbacks = Callbacks(client, store, config, chat, pipeline, raid)
+    client.add_event_callback(callbacks.message, (RoomMessageText,))
+    if args.yield_interval is not None:
+        client.add_event_callback(
+            CooperativeYield(args.yield_interval).on_event, (Event,)
+        )
+    client.add_response_callback(chat.dm_index.on_sync, (SyncResponse,))
+    client.add_response_callback(chat.power_levels.on_sync, (SyncResponse,))
+    client.add_response_callback(chat.room_state.on_sync, (SyncResponse,))
+    client.add_response_callback(chat.room_arrivals.on_sync, (SyncResponse,))
+
+    if args.replay:
+        syncs = recorded_syncs(homeserver, args.replay)
+    else:
+        syncs = synthetic_syncs(
+            homeserver,
+            args.messages,
+            args.rooms,
+            args.users,
+            args.batch,
+            args.thread_ratio,
+            args.moderator_ratio,
+            args.seed,
+        )
+
+    # The initial sync isn't part of the measurement
+    await receive_sync(client, next(syncs))
+    loop_monitor = LoopMonitor(interval=0.001, warning_threshold=float("inf"))
+    loop_monitor.start()
+    start = time.perf_counter()
+
+    for body in syncs:
+        await receive_sync(client, body, args.offload)
+        # Let queued work run between syncs, as the sync request would
+        await asyncio.sleep(0)
+
+    await pipeline.close(timeout=args.timeout)
+    elapsed = time.perf_counter() - start
+    await loop_monitor.close()
+    if raid is not None:
+        await raid.close()
+    await chat.warnings.close()
+
+    # Keep syncing until the DMs sent in the background are done
+    await settle(client, store, homeserver)
+    await chat.outbox.close()
+
+    results = {
+        "submitted": pipeline.submitted,
+        "moderated": pipeline.processed,
+        "failed": pipeline.failed,
+        "seconds": elapsed,
+        "throughput": pipeline.processed / elapsed if elapsed else 0,
+        "p50_ms": percentile(pipeline.latencies, 50) * 1000,
+        "p99_ms": percentile(pipeline.latencies, 99) * 1000,
+        "requests": dict(homeserver.requests),
+        "rate_limited": homeserver.rate_limited,
+        "loop_blocked_seconds": loop_monitor.blocked_seconds,
+        "max_loop_block_ms": loop_monitor.max_blocked_seconds * 1000,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if args.memory:
+        results["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+
+    await client.close()
+    await store.close()
+    await homeserver.close()
+    return results
+
+
+def bot_tasks() -> List[asyncio.Task]:
+    """Get the pending tasks started by the bot, e.g. DMs waiting to be sent"""
+    package = os.path.dirname(nio_channel_bot.__file__)
+    return [
+        task
+        for task in asyncio.all_tasks()
+        if task is not asyncio.current_task()
+        and getattr(task.get_coro(), "cr_code", None) is not None
+        and task.get_coro().cr_code.co_filename.startswith(package)
+        and task.get_coro().__qualname__ not in BACKGROUND_TASKS
+    ]
+
+
+async def settle(
+    client: AsyncClient,
+    store: Storage,
+    homeserver: FakeHomeserver,
+    quiet: float = 0.2,
+) -> None:
+    """Sync until the bot has no pending tasks or queued messages, and made no
+    requests for `quiet` seconds"""
+    batch = 0
+    last_total = -1
+    while (
+        sum(homeserver.requests.values()) != last_total
+        or bot_tasks()
+        or await store.get_next_message_attempt() is not None
+    ):
+        last_total = sum(homeserver.requests.values())
+        batch += 1
+        await receive_sync(client, sync_response(f"settle{batch}", {}))
+        await asyncio.sleep(quiet)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(percent) - 1]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=50, help="Messages per sync")
+    parser.add_argument("--thread-ratio", type=float, default=0.3)
+    parser.add_argument("--moderator-ratio", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--rate-limit-probability", type=float, default=0)
+    parser.add_argument(
+        "--rate-limits",
+        action="store_true",
+        help="Pace requests with the default rate limits of the bot",
+    )
+    parser.add_argument(
+        "--raid-threshold",
+        type=int,
+        default=0,
+        help="Moderate rooms in bulk once this many messages arrive within 10s",
+    )
+    parser.add_argument(
+        "--warning-window",
+        type=float,
+        default=1,
+        help="Seconds to merge warnings to the same user for",
+    )
+    parser.add_argument(
+        "--offload",
+        action="store_true",
+        help="Parse sync responses in a thread, as the bot does",
+    )
+    parser.add_argument(
+        "--yield-interval",
+        type=float,
+        default=None,
+        help="Let other tasks run every this many seconds while processing a sync",
+    )
+    parser.add_argument("--replay", help="A JSON file of recorded sync responses")
+    parser.add_argument("--memory", action="store_true", help="Trace allocations")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(run(parse_args()))
+
+    # In raid mode a single moderation job redacts many messages
+    redacted = results["requests"].get("redact", 0)
+    print(
+        f"Ran {results['moderated']} moderation jobs in {results['seconds']:.2f}s "
+        f"({results['throughput']:.0f} jobs/s, {results['failed']} failed), "
+        f"redacting {redacted} messages ({redacted / results['seconds']:.0f}/s)"
+    )
+    print(f"Latency: p50 {results['p50_ms']:.1f}ms, p99 {results['p99_ms']:.1f}ms")
+    print(f"Requests: {results['requests']}, rate limited: {results['rate_limited']}")
+    print(
+        f"Event loop: blocked {results['loop_blocked_seconds']:.2f}s in total, "
+        f"at most {results['max_loop_block_ms']:.1f}ms at once"
+    )
+    memory = f"Memory: max RSS {results['max_rss_mb']:.1f}MB"
+    if "peak_traced_mb" in results:
+        memory += f", peak traced {results['peak_traced_mb']:.1f}MB"
+    print(memory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Measures how long checking a message against the content rules of a room takes, as
+the amount of rules grows.
+
+For each rule count, a rule set of that many random keywords, and one of that many
+phrases of two keywords, is compiled. A mix of messages (most of them breaking no
+rule, so the whole message is scanned) is checked against them. Checking every keyword on its own is measured alongside, for
+comparison. The same is done for regex patterns, which are merged into a single
+regex but, unlike keywords, still cost more as there are more of them.
+
+Usage:
+    python -m benchmarks.bench_rules [messages]
+"""
+import random
+import re
+import string
+import sys
+import time
+from typing import Callable, List
+
+from nio import RoomMessageText
+
+from nio_channel_bot.rules import CompiledRules
+
+RULE_COUNTS = (10, 100, 1000, 10000)
+
+
+def random_word(rng: random.Random) -> str:
+    return "".join(
+        rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10))
+    )
+
+
+def make_messages(
+    rng: random.Random, count: int, keywords: List[str]
+) -> List[RoomMessageText]:
+    messages = []
+    for i in range(count):
+        words = [random_word(rng) for _ in range(rng.randint(5, 40))]
+        if i % 10 == 0:
+            # Some messages break a rule
+            words.insert(rng.randrange(len(words)), rng.choice(keywords))
+        messages.append(
+            RoomMessageText.from_dict(
+                {
+                    "type": "m.room.message",
+                    "event_id": f"$message{i}",
+                    "sender": "@user:example.com",
+                    "origin_server_ts": 0,
+                    "content": {"msgtype": "m.text", "body": " ".join(words)},
+                }
+            )
+        )
+    return messages
+
+
+def measure(
+    check: Callable[[RoomMessageText], object], messages: List[RoomMessageText]
+) -> float:
+    """The average amount of microseconds a message takes to check"""
+    start = time.perf_counter()
+    for message in messages:
+        check(message)
+    return (time.perf_counter() - start) / len(messages) * 1e6
+
+
+def run(count: int) -> None:
+    rng = random.Random(0)
+    print(f"{count} messages per rule set, microseconds per message")
+    print(
+        f"{'rules':>8} {'compile ms':>11} {'keywords':>9} {'phrases':>9} "
+        f"{'one by one':>11} {'patterns':>9}"
+    )
+    for rule_count in RULE_COUNTS:
+        keywords = [random_word(rng) for _ in range(rule_count)]
+        messages = make_messages(rng, count, keywords)
+
+        start = time.perf_counter()
+        rules = CompiledRules({"keywords": keywords})
+        compile_ms = (time.perf_counter() - start) * 1000
+        compiled = measure(rules.check, messages)
+
+        phrases = CompiledRules(
+            {"keywords": [f"{keyword} {rng.choice(keywords)}" for keyword in keywords]}
+        )
+        phrase_us = measure(phrases.check, messages)
+
+        # Checking keyword by keyword, as a rule engine without a merged matcher would
+        sample = messages[: max(10, count // rule_count)]
+        separate = [
+            re.compile(rf"(?<!\w){re.escape(keyword)}(?!\w)", re.IGNORECASE)
+            for keyword in keywords
+        ]
+        one_by_one = measure(
+            lambda message: any(keyword.search(message.body) for keyword in separate),
+            sample,
+        )
+
+        patterns = CompiledRules(
+            {"patterns": [rf"{re.escape(keyword)}\d+" for keyword in keywords]}
+        )
+        pattern_us = measure(patterns.check, sample)
+
+        print(
+            f"{rule_count:>8} {compile_ms:>11.1f} {compiled:>9.2f} {phrase_us:>9.2f} "
+            f"{one_by_one:>11.2f} {pattern_us:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
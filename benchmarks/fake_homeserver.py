@@ -0,0 +1,209 @@
+"""A local stand-in for a homeserver, implementing the endpoints used for moderation."""
+import asyncio
+import random
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+# (method, path regex, handler name). Paths are matched against the end of the URL
+ROUTES = [
+    ("PUT", r"/rooms/(?P<room_id>[^/]+)/redact/[^/]+/[^/]+$", "redact"),
+    ("PUT", r"/rooms/(?P<room_id>[^/]+)/send/[^/]+/[^/]+$", "send"),
+    (
+        "GET",
+        r"/rooms/(?P<room_id>[^/]+)/state/m\.room\.power_levels/?$",
+        "get_power_levels",
+    ),
+    (
+        "PUT",
+        r"/rooms/(?P<room_id>[^/]+)/state/m\.room\.power_levels/?$",
+        "put_power_levels",
+    ),
+    ("GET", r"/rooms/(?P<room_id>[^/]+)/state$", "get_state"),
+    ("GET", r"/rooms/(?P<room_id>[^/]+)/joined_members$", "joined_members"),
+    ("POST", r"/createRoom$", "create_room"),
+    ("POST", r"/upload$", "upload"),
+]
+
+
+class FakeHomeserver:
+    def __init__(
+        self,
+        user_id: str,
+        latency: float = 0,
+        rate_limit_probability: float = 0,
+        retry_after_ms: int = 10,
+        seed: int = 0,
+    ):
+        """Answers the requests the bot makes while moderating, keeping room state.
+
+        Args:
+            user_id: The user ID of the bot.
+
+            latency: The amount of seconds each request takes.
+
+            rate_limit_probability: The probability of a request being answered with
+                M_LIMIT_EXCEEDED.
+
+            retry_after_ms: The delay rate limited requests are asked to wait for.
+
+            seed: Seed of the random rate limiting, so that runs are reproducible.
+        """
+        self.user_id = user_id
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+
+        # room_id -> the content of the room's m.room.power_levels
+        self.power_levels = {}  # type: Dict[str, Dict[str, Any]]
+        # room_id -> joined members
+        self.members = {}  # type: Dict[str, List[str]]
+        # DM rooms created since they were last taken by `take_created_rooms`
+        self.created_rooms = []  # type: List[str]
+
+        # Metrics: handler name -> amount of requests answered
+        self.requests = Counter()  # type: Counter
+        self.rate_limited = 0
+
+        self._routes = [
+            (method, re.compile(path), getattr(self, "_" + name))
+            for method, path, name in ROUTES
+        ]
+        self._runner = None  # type: Optional[web.AppRunner]
+        self._next_id = 0
+        self.url = ""
+
+    def add_room(
+        self, room_id: str, members: List[str], power_levels: Dict[str, Any]
+    ) -> None:
+        """Add a room the bot is in"""
+        self.members[room_id] = list(members)
+        self.power_levels[room_id] = power_levels
+
+    def take_created_rooms(self) -> List[str]:
+        """Get the rooms created since the last call, to be included in the next sync"""
+        rooms, self.created_rooms = self.created_rooms, []
+        return rooms
+
+    async def start(self) -> None:
+        """Start listening on a free local port"""
+        # Uploaded media can be larger than aiohttp's default limit
+        app = web.Application(client_max_size=100 * 1024 * 1024)
+        app.router.add_route("*", "/{path:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _new_id(self, sigil: str) -> str:
+        self._next_id += 1
+        return f"{sigil}{self._next_id}:localhost"
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        path = request.path
+        for method, regex, handler in self._routes:
+            match = regex.search(path)
+            if match and request.method == method:
+                break
+        else:
+            return web.json_response(
+                {"errcode": "M_UNRECOGNIZED", "error": f"Unknown endpoint {path}"},
+                status=404,
+            )
+
+        if self.random.random() < self.rate_limit_probability:
+            self.rate_limited += 1
+            return web.json_response(
+                {
+                    "errcode": "M_LIMIT_EXCEEDED",
+                    "error": "Too many requests",
+                    "retry_after_ms": self.retry_after_ms,
+                },
+                status=429,
+            )
+
+        self.requests[handler.__name__[1:]] += 1
+        return web.json_response(await handler(request, **match.groupdict()))
+
+    async def _redact(self, request: web.Request, room_id: str) -> Dict[str, Any]:
+        return {"event_id": self._new_id("$")}
+
+    async def _send(self, request: web.Request, room_id: str) -> Dict[str, Any]:
+        return {"event_id": self._new_id("$")}
+
+    async def _get_power_levels(
+        self, request: web.Request, room_id: str
+    ) -> Dict[str, Any]:
+        return self.power_levels[room_id]
+
+    async def _put_power_levels(
+        self, request: web.Request, room_id: str
+    ) -> Dict[str, Any]:
+        self.power_levels[room_id] = await request.json()
+        return {"event_id": self._new_id("$")}
+
+    async def _get_state(self, request: web.Request, room_id: str) -> List[Any]:
+        return room_state_events(
+            room_id, self.members[room_id], self.power_levels[room_id]
+        )
+
+    async def _joined_members(
+        self, request: web.Request, room_id: str
+    ) -> Dict[str, Any]:
+        return {"joined": {user_id: {} for user_id in self.members[room_id]}}
+
+    async def _create_room(self, request: web.Request) -> Dict[str, Any]:
+        body = await request.json()
+        room_id = self._new_id("!")
+        self.add_room(
+            room_id,
+            [self.user_id] + body.get("invite", []),
+            {"users": {self.user_id: 100}},
+        )
+        self.created_rooms.append(room_id)
+        return {"room_id": room_id}
+
+    async def _upload(self, request: web.Request) -> Dict[str, Any]:
+        await request.read()
+        return {"content_uri": f"mxc://localhost/{self._next_id}"}
+
+
+def room_state_events(
+    room_id: str, members: List[str], power_levels: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """Build the state events of a room"""
+
+    def state_event(event_type, state_key, content):
+        return {
+            "type": event_type,
+            "state_key": state_key,
+            "sender": members[0],
+            "event_id": f"${event_type}{state_key}{room_id}",
+            "origin_server_ts": 0,
+            "content": content,
+        }
+
+    events = [
+        state_event("m.room.create", "", {"creator": members[0]}),
+        state_event("m.room.name", "", {"name": room_id}),
+        state_event("m.room.power_levels", "", power_levels),
+    ]
+    events.extend(
+        state_event("m.room.member", user_id, {"membership": "join"})
+        for user_id in members
+    )
+    return events
@@ -1,14 +1,22 @@
 import asyncio
 import logging
+from typing import List, Optional
 
 from nio import AsyncClient, MatrixRoom, RoomMessageText, RoomRedactResponse, RoomRedactError, RoomCreateError, RoomPutStateResponse
 
-from nio_channel_bot.chat_functions import ChatFunctions, with_ratelimit
+from nio_channel_bot import metrics
+from nio_channel_bot.chat_functions import ChatFunctions
 from nio_channel_bot.config import Config
+from nio_channel_bot.ratelimit import with_ratelimit
 from nio_channel_bot.storage import Storage
 
 logger = logging.getLogger(__name__)
 
+# Users with at least this power level are moderators, whose messages are allowed
+MODERATOR_POWER_LEVEL = 50
+# Users with at least this power level are admins, whom muted users are referred to
+ADMIN_POWER_LEVEL = 100
+
 
 class Command:
     def __init__(
@@ -19,7 +27,8 @@ class Command:
         command: str,
         room: MatrixRoom,
         event: RoomMessageText,
-        chat: ChatFunctions
+        chat: ChatFunctions,
+        rule: Optional[str] = None,
     ):
         """A command made by a user.
 
@@ -35,6 +44,9 @@ class Command:
             room: The room the command was sent in.
 
             event: The event describing the command.
+
+            rule: The content rule of the room the message breaks, if it is moderated
+                for breaking one rather than for being sent outside of a thread.
         """
         self.client = client
         self.store = store
@@ -43,7 +55,13 @@ class Command:
         self.room = room
         self.event = event
         self.chat = chat
-        self.args = self.command.split()[1:]
+        self.rule = rule
+
+    @property
+    def args(self) -> List[str]:
+        """The arguments of the command. Only split when needed, as messages being
+        moderated aren't commands"""
+        return self.command.split()[1:]
 
     async def process(self):
         """Process the command"""
@@ -99,29 +117,42 @@ class Command:
             self.room.room_id,
             f"Unknown command '{self.command}'. Try the 'help' command for more information.",
         )
-    @with_ratelimit
+    @with_ratelimit(endpoint="redact")
     async def send_room_redact(self):
+        reason = "You are not a moderator of this channel."
+        if self.rule is not None:
+            reason = f"The message breaks the {self.rule} rule of this channel."
         return await self.client.room_redact(
                 self.room.room_id,
                 self.event.event_id,
-                "You are not a moderator of this channel.",
+                reason,
             )
 
     #
 
     async def filter_channel(self):
+        with metrics.moderation_seconds.time():
+            await self._filter_channel()
+
+    async def _filter_channel(self):
+        # The power levels of the room may not have been synced since the bot started
+        await self.chat.room_state.load(self.room.room_id)
+
         # First check the power level of the sender. 0 - default, 50 - moderator, 100 - admin, others - custom.
         logger.debug(
             f"{self.room.user_name(self.event.sender)} has power level: {self.room.power_levels.get_user_level(self.event.sender)}"
         )
-        if self.room.power_levels.get_user_level(self.event.sender) < 50:
+        if self.room.power_levels.get_user_level(self.event.sender) < MODERATOR_POWER_LEVEL:
             if self.room.power_levels.can_user_redact(self.client.user_id):
 
                 # Redact the message
-                redact_response = await self.send_room_redact()
+                with metrics.redaction_seconds.time():
+                    redact_response = await self.send_room_redact()
                 if isinstance(redact_response, RoomRedactError):
+                    metrics.redactions.inc(result="error")
                     logger.error(f"Failed to redact message in room {self.room.room_id} with id {self.event.event_id} with error: {redact_response.status_code}")
                     return
+                metrics.redactions.inc(result="ok")
 
                 fails = None
                 is_banned = False
@@ -129,27 +160,30 @@ class Command:
                     is_banned = True
                     fails = 3
                 else:
-                    # Get user attempts from database
-                    fails = self.store.get_fail(self.event.sender, self.room.room_id)
+                    # Get user attempts from the fail counter cache
+                    fails = await self.store.fails.get(self.event.sender, self.room.room_id)
 
                 # Ban if over 3 fails or issue warning:
                 if fails < 3:
-                    self.store.update_or_create_fail(
+                    await self.store.fails.increment(
                         self.event.sender, self.room.room_id
                     )
                 elif not is_banned:
                     # Delete the user attempt entry
-                    self.store.delete_fail(self.event.sender, self.room.room_id)
+                    await self.store.fails.reset(self.event.sender, self.room.room_id)
 
                     # Mute user
-                    resp = await self.chat.set_user_power(
-                        self.room.room_id, self.event.sender, -1
-                    )
+                    with metrics.mute_seconds.time():
+                        resp = await self.chat.set_user_power(
+                            self.room.room_id, self.event.sender, -1
+                        )
                     if isinstance(resp, RoomPutStateResponse):
+                        metrics.mutes.inc(result="ok")
                         logger.info(
                             f"{self.room.user_name(self.event.sender)} has been banned from room {self.room.name}"
                         )
                     else:
+                        metrics.mutes.inc(result="error")
                         logger.error(f"Error: Power level response: {resp}")
                         return
 
@@ -158,37 +192,39 @@ class Command:
                 if isinstance(notification_room_id_future, RoomCreateError):
                     return
 
-                # Inform user about ban/issue warning
+                # Inform user about ban/issue warning. Warnings in quick succession
+                # are merged into a single message
                 if fails < 3:
-                    print("Sending warning message")
-                    await self.chat.roomManager.send_msg_on_creation(
-                        ("""Your comment has been deleted {} times in {} discussion due to being improperly sent. Please reply in threads. \n
-How to enable threads: \n
-1. Hover on a message and click 'Reply in Thread' button. \n
-2. Press 'Join the beta' button. \n
-3. Reply to a message using the 'Reply in Thread' button.""").format(fails+1, self.room.name),
-                        notification_room_id_future,
-                    )
-
-                    await self.chat.roomManager.send_msg_on_creation(
-                        "media/info_threads.gif",
+                    logger.debug("Sending warning message")
+                    await self.chat.warnings.warn(
+                        self.event.sender,
                         notification_room_id_future,
-                        is_image = True,
+                        self.room.room_id,
+                        self.room.name,
+                        fails + 1,
+                        self.rule,
                     )
                 else:
-                    #Find admin users in room
-                    admins = []
-                    for user in self.room.users:
-                        powerlevel = self.room.power_levels.get_user_level(user)
-                        if user != self.client.user and powerlevel == 100:
-                            admins.append(user)
+                    # Find admin users in room. Only the few users listed in the
+                    # power levels are checked, not every member of the room
+                    await self.chat.room_state.load_members(self.room)
+                    admins = [
+                        user
+                        for user in await self.chat.power_levels.get_moderators(
+                            self.room.room_id, ADMIN_POWER_LEVEL
+                        )
+                        if user != self.client.user and user in self.room.users
+                    ]
                     admin_string = ", ".join(admins)
                     logger.debug(f"Room admins: {admin_string}")
 
                     # Inform user about the ban
-                    await self.chat.roomManager.send_msg_on_creation(
-                        f"# You have made >3 improper comments in {self.room.name} discussion. Please seek help from the group admins: {admin_string}",
-                        notification_room_id_future
+                    await self.chat.warnings.ban(
+                        self.event.sender,
+                        notification_room_id_future,
+                        self.room.room_id,
+                        self.room.name,
+                        admin_string,
                     )
             else:
                 logger.error(
@@ -1,5 +1,8 @@
 import logging
-from datetime import datetime
+import time
+from functools import partial
+from typing import Optional, Tuple
+
 from nio import (
     AsyncClient,
     InviteMemberEvent,
@@ -12,16 +15,36 @@ from nio import (
     RoomMemberEvent,
 )
 
-from nio_channel_bot.bot_commands import Command
+from nio_channel_bot import metrics
+from nio_channel_bot.bot_commands import MODERATOR_POWER_LEVEL, Command
+from nio_channel_bot.catchup import RoomCheckpoints
 from nio_channel_bot.chat_functions import ChatFunctions
 from nio_channel_bot.config import Config
+from nio_channel_bot.pipeline import ModerationPipeline
+from nio_channel_bot.raid import RaidMode
+from nio_channel_bot.rules import MEDIA_EVENTS, RuledEvent, RuleEngine
+from nio_channel_bot.sharding import ShardCoordinator
 from nio_channel_bot.storage import Storage
 
 logger = logging.getLogger(__name__)
 
+# Messages older than this are not moderated, unless filter_old_messages is enabled
+MAX_MESSAGE_AGE_MS = 5 * 60 * 1000
+
 
 class Callbacks:
-    def __init__(self, client: AsyncClient, store: Storage, config: Config, chat: ChatFunctions):
+    def __init__(
+        self,
+        client: AsyncClient,
+        store: Storage,
+        config: Config,
+        chat: ChatFunctions,
+        pipeline: Optional[ModerationPipeline] = None,
+        raid: Optional[RaidMode] = None,
+        shards: Optional[ShardCoordinator] = None,
+        checkpoints: Optional[RoomCheckpoints] = None,
+        rules: Optional[RuleEngine] = None,
+    ):
         """
         Args:
             client: nio client used to interact with matrix.
@@ -29,12 +52,38 @@ class Callbacks:
             store: Bot storage.
 
             config: Bot configuration parameters.
+
+            chat: Chat functions used to communicate with rooms.
+
+            pipeline: The pipeline moderation jobs are queued on. If not provided,
+                messages are moderated inline, before the next event is processed.
+
+            raid: Moderates flooded rooms in bulk. If not provided, every message is
+                moderated on its own.
+
+            shards: Decides which rooms this worker handles, when rooms are sharded
+                across several bot processes. If not provided, every room is handled.
+
+            checkpoints: Records the last message processed in each room. Messages
+                sent before the bot started are left to the catch-up of their room.
+
+            rules: The content rules of each room, which thread replies and media
+                are moderated by. If not provided, they are always allowed.
         """
         self.client = client
         self.store = store
         self.config = config
         self.command_prefix = config.command_prefix
         self.chat = chat
+        self.pipeline = pipeline
+        self.raid = raid
+        self.shards = shards
+        self.checkpoints = checkpoints
+        self.rules = rules
+
+    def _owns(self, room_id: str) -> bool:
+        """Whether events of a room are handled by this worker"""
+        return self.shards is None or self.shards.owns(room_id)
 
     def _check_if_message_from_thread(self, event: RoomMessageText):
         """Extracts the rel_type from a RoomMessageText object content
@@ -52,48 +101,140 @@ class Callbacks:
 
         return is_thread_reply
 
-    async def message(self, room: MatrixRoom, event: RoomMessageText) -> None:
+    async def message(self, room: MatrixRoom, event: RuledEvent) -> None:
         """Callback for when a message event is received
 
+        Messages that don't need moderating are rejected with cheap checks first, so
+        that nothing is allocated for them.
+
         Args:
             room: The room the event came from.
 
             event: The event defining the message.
         """
-        # Extract the message text
-        msg = event.body
+        # Rooms owned by other workers are moderated by them
+        if not self._owns(room.room_id):
+            return
 
-        # Extract flag if the message is in a thread
-        is_thread_reply = self._check_if_message_from_thread(event)
+        # Events delivered again after a reconnect or restart were already handled
+        if self.store.processed.contains(event.event_id):
+            metrics.duplicate_events.inc()
+            return
 
-        # Ignore messages from ourselves
-        if event.sender == self.client.user:
+        if self.checkpoints is not None:
+            self.checkpoints.record(room.room_id, event.event_id, event.server_timestamp)
+
+        needed, rule = self._check_moderation(room, event)
+        if not needed:
+            return
+
+        if self.checkpoints is not None and self.checkpoints.covers(
+            room.room_id, event.server_timestamp
+        ):
+            # Moderated by the catch-up, along with the messages before it
             return
 
         # If we are not filtering old messages, ignore messages older than 5 minutes
-        if not self.config.filter_old_messages:
-            if (
-                datetime.now() - datetime.fromtimestamp(event.server_timestamp / 1000.0)
-            ).total_seconds() > 300:
-                return
+        if (
+            not self.config.filter_old_messages
+            and time.time() * 1000 - event.server_timestamp > MAX_MESSAGE_AGE_MS
+        ):
+            return
 
-        logger.debug(
-            f"Bot message received for room {room.display_name} | "
-            f"{room.user_name(event.sender)}: {msg}"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Bot message received for room {room.display_name} | "
+                f"{room.user_name(event.sender)}: {event.body}"
+            )
+
+        # Redeliveries are skipped while the message waits to be moderated. It is only
+        # recorded as processed once it has been moderated
+        self.store.processed.claim(event.event_id)
+
+        # Flooded rooms are moderated in bulk
+        if self.raid is not None and self.raid.record(room.room_id):
+            await self.raid.moderate(room, event)
+            return
+
+        if rule is not None:
+            metrics.rule_matches.inc(rule=rule)
+
+        # Call the filter method on a message in a channel that not a thread discussion and does not contain the prefix (! REMOVE PREFIXES ENTIRELLY !)
+        command = Command(
+            self.client, self.store, self.config, event.body, room, event, self.chat, rule
         )
+        job = partial(self._moderate, command, event.event_id)
+        if self.pipeline is not None:
+            # Queue the moderation so the sync loop can move on to the next event
+            await self.pipeline.submit(room.room_id, job)
+        else:
+            await job()
+
+    async def _moderate(self, command: Command, event_id: str) -> None:
+        """Moderate a message, and record it as processed once moderated"""
+        # Another worker may have taken over the room while the job was queued
+        if not self._owns(command.room.room_id):
+            self.store.processed.release(event_id)
+            return
+
+        try:
+            await command.filter_channel()
+        except BaseException:
+            self.store.processed.release(event_id)
+            raise
+        self.store.processed.complete(event_id)
+
+    def needs_moderation(self, room: MatrixRoom, event: RuledEvent) -> bool:
+        """Whether a message has to be moderated, leaving out how old it is
+
+        Args:
+            room: The room the event came from.
 
-        # Process as message if in a public room without command prefix
-        # has_command_prefix = msg.startswith(self.command_prefix)
+            event: The event defining the message.
+        """
+        return self._check_moderation(room, event)[0]
+
+    def _check_moderation(
+        self, room: MatrixRoom, event: RuledEvent
+    ) -> Tuple[bool, Optional[str]]:
+        """Whether a message has to be moderated, and the content rule it breaks
+
+        The rules of the room are only checked once per message, for thread replies
+        and media.
+
+        Returns:
+            Whether the message has to be moderated, and the name of the rule it
+            breaks, if any.
+        """
+        # Ignore messages from ourselves
+        if event.sender == self.client.user:
+            return False, None
 
         # room.is_group is often a DM, but not always.
         # room.is_group does not allow room aliases
         # room.member_count > 2 ... we assume a public room
         # room.member_count <= 2 ... we assume a DM
-        if room.member_count > 2 and not is_thread_reply:
-            # Call the filter method on a message in a channel that not a thread discussion and does not contain the prefix (! REMOVE PREFIXES ENTIRELLY !)
-            command = Command(self.client, self.store, self.config, msg, room, event, self.chat)
-            await command.filter_channel()
-            return
+        if room.member_count <= 2:
+            return False, None
+
+        # Messages in threads are allowed
+        is_thread_reply = self._check_if_message_from_thread(event)
+        metrics.messages_seen.inc(thread="true" if is_thread_reply else "false")
+        ruled = is_thread_reply or isinstance(event, MEDIA_EVENTS)
+        if ruled and self.rules is None:
+            return False, None
+
+        # Messages of moderators are allowed. If the room's power levels haven't been
+        # synced yet, everyone has the default level and moderation checks again
+        if room.power_levels.get_user_level(event.sender) >= MODERATOR_POWER_LEVEL:
+            return False, None
+
+        if not ruled:
+            return True, None
+
+        # Thread replies and media are allowed, unless they break a rule of the room
+        rule = self.rules.check(room.room_id, event)
+        return rule is not None, rule
 
     async def invite(self, room: MatrixRoom, event: InviteMemberEvent) -> None:
         """Callback for when an invite is received. Join the room specified in the invite.
@@ -105,6 +246,10 @@ class Callbacks:
         """
         logger.debug(f"Got invite to {room.room_id} from {event.sender}.")
 
+        # Only the worker owning the room joins it
+        if not self._owns(room.room_id):
+            return
+
         # Attempt to join 3 times before giving up
         for attempt in range(3):
             result = await self.client.join(room.room_id)
@@ -212,6 +357,9 @@ class Callbacks:
 
             event: The event defining the message.
         """
+        # Keep the DM room index up to date with membership changes
+        self.chat.dm_index.update_room(room)
+
         # Check if the call happened in a 1-1 room
         event_content = event.source["content"]
         user_joined = event_content["membership"] == "join"
@@ -232,7 +380,7 @@ class Callbacks:
 
             event: The event itself.
         """
-        if event.type == "m.reaction":
+        if event.type == "m.reaction" and self._owns(room.room_id):
             # Get the ID of the event this was a reaction to
             relation_dict = event.source.get("content", {}).get("m.relates_to", {})
 
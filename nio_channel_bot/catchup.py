@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from nio import (
+    AsyncClient,
+    MatrixRoom,
+    MessageDirection,
+    RoomContextError,
+    RoomMessagesError,
+    RoomMessageText,
+)
+
+from nio_channel_bot import metrics
+from nio_channel_bot.raid import BulkModerator
+from nio_channel_bot.rules import MEDIA_EVENTS
+from nio_channel_bot.sharding import ShardCoordinator
+from nio_channel_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Only the events that may need moderating are paginated
+MESSAGE_FILTER = {"types": ["m.room.message", "m.room.encrypted"]}
+
+
+class RoomCheckpoints:
+    def __init__(self, store: Storage, flush_interval: float = 5):
+        """Remembers the last message processed in each room.
+
+        Checkpoints are kept in memory and written to the database every
+        `flush_interval` seconds, and when closed. The checkpoints stored when the bot
+        starts, along with the start time, mark the messages to catch up on.
+
+        Args:
+            store: The storage the checkpoints are kept in.
+
+            flush_interval: The amount of seconds between writes.
+        """
+        self.store = store
+        self.flush_interval = flush_interval
+
+        # room_id -> (event_id, origin_server_ts) of the checkpoints stored at startup
+        self.initial = {}  # type: Dict[str, Tuple[str, int]]
+        # The time the bot started processing messages, in milliseconds
+        self.cutoff = 0
+
+        # room_id -> (event_id, origin_server_ts) of the last processed messages
+        self._latest = {}  # type: Dict[str, Tuple[str, int]]
+        self._dirty = set()  # type: Set[str]
+        # Rooms being caught up on, whose checkpoints can't move on yet
+        self._held = set()  # type: Set[str]
+        self._flush_task = None  # type: Optional[asyncio.Task]
+
+    async def load(self) -> None:
+        """Load the stored checkpoints, before any message is processed"""
+        self.initial = await self.store.get_room_checkpoints()
+        self._latest = dict(self.initial)
+        self.cutoff = int(time.time() * 1000)
+
+    def covers(self, room_id: str, timestamp: int) -> bool:
+        """Whether a message is caught up on, rather than moderated as it is synced"""
+        return timestamp < self.cutoff and room_id in self.initial
+
+    def record(self, room_id: str, event_id: str, timestamp: int) -> None:
+        """Record a processed message of a room"""
+        latest = self._latest.get(room_id)
+        if latest is None or timestamp >= latest[1]:
+            self._latest[room_id] = (event_id, timestamp)
+            self._dirty.add(room_id)
+
+    def hold(self, room_ids: Iterable[str]) -> None:
+        """Keep the stored checkpoints of rooms until they have been caught up on,
+        so that a restart in the meantime catches up on them again"""
+        self._held.update(room_ids)
+
+    def release(self, room_id: str) -> None:
+        """Let the checkpoint of a room that has been caught up on be stored"""
+        self._held.discard(room_id)
+
+    def start(self) -> None:
+        """Start periodically writing checkpoints to the database"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(
+                self._flush_periodically()
+            )
+
+    async def close(self) -> None:
+        """Stop the periodic writes and write out the remaining checkpoints"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Write the changed checkpoints to the database in a single batch"""
+        rooms = self._dirty - self._held
+        if not rooms:
+            return
+        self._dirty -= rooms
+
+        try:
+            await self.store.set_room_checkpoints(
+                (room_id, *self._latest[room_id]) for room_id in rooms
+            )
+        except Exception:
+            self._dirty |= rooms
+            raise
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write room checkpoints to the database")
+
+
+class CatchUp:
+    def __init__(
+        self,
+        client: AsyncClient,
+        checkpoints: RoomCheckpoints,
+        moderator: BulkModerator,
+        needs_moderation: Callable[[MatrixRoom, RoomMessageText], bool],
+        parallelism: int = 4,
+        page_size: int = 100,
+        max_messages: int = 5000,
+        shards: Optional[ShardCoordinator] = None,
+    ):
+        """Moderates the messages sent while the bot was down.
+
+        Once the first sync is done, the messages of each room are paginated from its
+        stored checkpoint up to the time the bot started, `parallelism` rooms at a
+        time. The messages of each page that need moderating are redacted in bulk.
+        Messages sent after the bot started are moderated as they are synced.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            checkpoints: The last processed message of each room.
+
+            moderator: Redacts the offending messages in bulk.
+
+            needs_moderation: Whether a message has to be moderated, leaving out how
+                old it is.
+
+            parallelism: The maximum amount of rooms caught up on at once.
+
+            page_size: The amount of messages requested at once.
+
+            max_messages: The maximum amount of messages caught up on per room.
+
+            shards: If set, only the rooms owned by this worker are caught up on.
+        """
+        self.client = client
+        self.checkpoints = checkpoints
+        self.moderator = moderator
+        self.needs_moderation = needs_moderation
+        self.parallelism = parallelism
+        self.page_size = page_size
+        self.max_messages = max_messages
+        self.shards = shards
+
+        self._task = None  # type: Optional[asyncio.Task]
+        # Progress over every room
+        self.rooms_total = 0
+        self.rooms_done = 0
+        self.scanned = 0
+        self.redacted = 0
+        self._last_report = 0.0
+
+    async def on_sync(self, response) -> None:
+        """Response callback starting the catch-up once the first sync is done"""
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    async def close(self) -> None:
+        """Stop catching up. Rooms not caught up on are caught up on at the next start"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def run(self) -> None:
+        """Catch up on every joined room with a stored checkpoint"""
+        rooms = [
+            (room_id, event_id)
+            for room_id, (event_id, _) in self.checkpoints.initial.items()
+            if room_id in self.client.rooms
+            and (self.shards is None or self.shards.owns(room_id))
+        ]
+        if not rooms:
+            return
+
+        start = time.monotonic()
+        self.rooms_total = len(rooms)
+        self.checkpoints.hold(room_id for room_id, _ in rooms)
+        metrics.catchup_rooms.set(len(rooms))
+        logger.info(f"Catching up on messages of {len(rooms)} rooms...")
+
+        queue = asyncio.Queue()  # type: asyncio.Queue
+        for room in rooms:
+            queue.put_nowait(room)
+        workers = [
+            asyncio.get_event_loop().create_task(self._work(queue))
+            for _ in range(min(self.parallelism, len(rooms)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        elapsed = time.monotonic() - start
+        metrics.catchup_seconds.set(elapsed)
+        logger.info(
+            f"Caught up on {self.rooms_done} rooms in {elapsed:.1f}s: scanned "
+            f"{self.scanned} messages, redacted {self.redacted}"
+        )
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        while not queue.empty():
+            room_id, event_id = queue.get_nowait()
+            # Rooms that couldn't be caught up on keep their stored checkpoint, so
+            # that they are caught up on again at the next start
+            try:
+                if await self._catch_up_room(room_id, event_id):
+                    self.checkpoints.release(room_id)
+            except Exception:
+                logger.exception(f"Failed to catch up on room {room_id}")
+
+            self.rooms_done += 1
+            metrics.catchup_rooms.inc(-1)
+            self._report_progress()
+
+    async def _catch_up_room(self, room_id: str, event_id: str) -> bool:
+        """Catch up on the messages of a room sent since a checkpoint
+
+        Returns:
+            Whether the room was caught up on, False if a request failed.
+        """
+        room = self.client.rooms.get(room_id)
+        if room is None:
+            return True
+
+        # Pagination starts from the token right after the checkpoint
+        context = await self.client.room_context(room_id, event_id, limit=0)
+        if isinstance(context, RoomContextError):
+            logger.warning(
+                f"Can't catch up on room {room_id} from {event_id}: {context.message}"
+            )
+            return False
+
+        token = context.end
+        scanned = 0
+        while token is not None and scanned < self.max_messages:
+            response = await self.client.room_messages(
+                room_id,
+                start=token,
+                direction=MessageDirection.front,
+                limit=self.page_size,
+                message_filter=MESSAGE_FILTER,
+            )
+            if isinstance(response, RoomMessagesError):
+                logger.warning(
+                    f"Failed to catch up on room {room_id}: {response.message}"
+                )
+                return False
+
+            offenders = []  # type: List[RoomMessageText]
+            done = not response.chunk or response.end == token
+            page_scanned = 0
+            for event in response.chunk:
+                if event.server_timestamp >= self.checkpoints.cutoff:
+                    # Moderated as it was synced
+                    done = True
+                    break
+
+                page_scanned += 1
+                self.checkpoints.record(room_id, event.event_id, event.server_timestamp)
+                if isinstance(
+                    event, (RoomMessageText,) + MEDIA_EVENTS
+                ) and self.needs_moderation(room, event):
+                    offenders.append(event)
+
+            scanned += page_scanned
+            self.scanned += page_scanned
+            metrics.catchup_messages.inc(page_scanned, result="scanned")
+            if offenders:
+                redacted = await self.moderator.redact_and_mute(
+                    room, offenders, reason="caught up"
+                )
+                metrics.catchup_messages.inc(redacted, result="redacted")
+                self.redacted += redacted
+
+            if done:
+                break
+            token = response.end
+
+        if scanned >= self.max_messages:
+            logger.warning(
+                f"Stopped catching up on room {room_id} after {scanned} messages"
+            )
+        return True
+
+    def _report_progress(self) -> None:
+        now = time.monotonic()
+        if now - self._last_report < 5 and self.rooms_done < self.rooms_total:
+            return
+        self._last_report = now
+        logger.info(
+            f"Catch-up progress: {self.rooms_done}/{self.rooms_total} rooms, "
+            f"{self.scanned} messages scanned, {self.redacted} redacted"
+        )
@@ -1,11 +1,22 @@
 import logging
 import asyncio
-from typing import Optional, Union
+from typing import Any, Dict, Optional, Union
 from collections.abc import Coroutine
-from asyncio import AbstractEventLoop
+from nio_channel_bot import metrics
+from nio_channel_bot.dm_index import DirectRoomIndex
+from nio_channel_bot.media import MediaCache
+from nio_channel_bot.offload import offloader
+from nio_channel_bot.outbox import PersistentOutbox, WarningOutbox
+from nio_channel_bot.power_levels import PowerLevelCache
+from nio_channel_bot.ratelimit import with_ratelimit
 from nio_channel_bot.storage import Storage
-from aiohttp import ClientResponse
-from markdown import markdown
+from nio_channel_bot.sync import RoomStateLoader
+from nio_channel_bot.templates import (
+    MessageTemplate,
+    RenderedMessage,
+    compile_messages,
+    render_markdown,
+)
 from nio import (
     AsyncClient,
     ErrorResponse,
@@ -16,54 +27,40 @@ from nio import (
     RoomCreateError,
     RoomCreateResponse,
     RoomGetStateEventError,
-    RoomGetStateEventResponse,
     RoomPreset,
     RoomPutStateError,
     RoomPutStateResponse,
     RoomSendResponse,
     RoomVisibility,
     SendRetryError,
-    UploadResponse,
+    SyncResponse,
 )
-from nio.http import TransportResponse
 
 # File sending prerequisites
-import aiofiles
-import aiofiles.os
 import os
-import magic
 import traceback
 
 logger = logging.getLogger(__name__)
 
-async def retry_after(delay_ms):
-    deadzone = 50  # 50ms additional wait time.
-    delay_s = (delay_ms + deadzone) / 1000
-
-    await asyncio.sleep(delay_s)
+# The amount of seconds to wait for a created DM room to be synced, before dropping
+# the messages waiting for it
+ROOM_ARRIVAL_TIMEOUT = 300
 
+# Messages at least this long are converted from markdown outside of the event loop
+OFFLOAD_MARKDOWN_LENGTH = 4096
 
-def with_ratelimit(func):
-    async def wrapper(*args, **kwargs):
-        while True:
-            logger.debug(f"Executing function: {func.__name__}")
-            response = await func(*args, **kwargs)
-            if isinstance(response, ErrorResponse):
-                if response.status_code == "M_LIMIT_EXCEEDED":
-                    await retry_after(response.retry_after_ms)
-                else:
-                    return response
-            else:
-                return response
-
-    return wrapper
 
 class ChatFunctions:
 
     def __init__(
         self,
         client: AsyncClient,
-        store: Storage
+        store: Storage,
+        power_level_batch_window: float = 0,
+        messages: Optional[Dict[str, MessageTemplate]] = None,
+        warning_window: float = 0,
+        warning_image_period: float = 0,
+        outbox: Optional[Dict[str, Any]] = None,
     ):
         """ Chat commands used for communicating with a room.
 
@@ -71,25 +68,55 @@ class ChatFunctions:
             client: The client to communicate to matrix with.
 
             store: Bot storage.
+
+            power_level_batch_window: The amount of seconds to collect power level
+                changes of a room for, before sending them in a single update. 0 sends
+                every change right away.
+
+            messages: The compiled messages sent to users. Defaults to the default
+                messages.
+
+            warning_window: The amount of seconds to merge warnings to the same user
+                for. 0 sends every warning right away.
+
+            warning_image_period: The minimum amount of seconds between sending the
+                threads image to the same user. 0 sends it with every warning.
+
+            outbox: Keyword arguments of the `PersistentOutbox` messages to users are
+                sent through.
         """
         self.client = client
         self.store = store
+        self.dm_index = DirectRoomIndex(client, store)
+        self.power_levels = PowerLevelCache(client, power_level_batch_window)
+        self.media = MediaCache(client, store)
+        self.room_state = RoomStateLoader(client)
+        self.room_arrivals = RoomArrivals(client)
         self.roomManager = RoomManager(self, client, store)
+        self.outbox = PersistentOutbox(self, store, **(outbox or {}))
+        self.warnings = WarningOutbox(
+            self.roomManager,
+            messages or compile_messages({}),
+            warning_window,
+            warning_image_period,
+        )
 
     async def send_text_to_room(
         self,
         room_id: str,
-        message: str,
+        message: Union[str, RenderedMessage],
         notice: bool = True,
         markdown_convert: bool = True,
         reply_to_event_id: Optional[str] = None,
+        tx_id: Optional[str] = None,
     ) -> Union[RoomSendResponse, ErrorResponse]:
         """Send text to a matrix room.
 
         Args:
             room_id: The ID of the room to send the message to.
 
-            message: The message content.
+            message: The message content. Either markdown text, or a message that has
+                already been rendered from a template.
 
             notice: Whether the message should be sent with an "m.notice" message type
                 (will not ping users).
@@ -100,29 +127,46 @@ class ChatFunctions:
             reply_to_event_id: Whether this message is a reply to another event. The event
                 ID this is message is a reply to.
 
+            tx_id: The transaction ID to send the message with. Sending again with the
+                same ID doesn't send the message twice.
+
         Returns:
             A RoomSendResponse if the request was successful, else an ErrorResponse.
         """
         # Determine whether to ping room members or not
         msgtype = "m.notice" if notice else "m.text"
 
-        content = {
-            "msgtype": msgtype,
-            "format": "org.matrix.custom.html",
-            "body": message,
-        }
+        if isinstance(message, RenderedMessage):
+            content = {
+                "msgtype": msgtype,
+                "format": "org.matrix.custom.html",
+                "body": message.body,
+                "formatted_body": message.formatted_body,
+            }
+        else:
+            content = {
+                "msgtype": msgtype,
+                "format": "org.matrix.custom.html",
+                "body": message,
+            }
 
-        if markdown_convert:
-            content["formatted_body"] = markdown(message)
+            if markdown_convert:
+                if len(message) >= OFFLOAD_MARKDOWN_LENGTH:
+                    content["formatted_body"] = await offloader.run(
+                        "markdown", render_markdown, message
+                    )
+                else:
+                    content["formatted_body"] = render_markdown(message)
 
         if reply_to_event_id:
             content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
 
         try:
-            return await self.client.room_send(
+            return await with_ratelimit(self.client.room_send, endpoint="send")(
                 room_id,
                 "m.room.message",
                 content,
+                tx_id=tx_id,
                 ignore_unverified_devices=True,
             )
         except (SendRetryError, LocalProtocolError):
@@ -133,6 +177,7 @@ class ChatFunctions:
         self,
         room_id: str,
         file: str,
+        tx_id: Optional[str] = None,
     ) -> Union[RoomSendResponse, ErrorResponse]:
         """Process file.
         Upload file to server and then send link to rooms.
@@ -169,90 +214,35 @@ class ChatFunctions:
             "room_id": "!SomeRoomId:example.com"
         }
         """
-        if not os.path.isfile(file):
-            error_msg = f"File {file} is not a file. Doesn't exist or is a directory. This file is being droppend and NOT sent."
-
-            logger.debug(error_msg)
-            return ErrorResponse(error_msg)
-
-        # # restrict to "txt", "pdf", "mp3", "ogg", "wav", ...
-        # if not re.match("^.pdf$|^.txt$|^.doc$|^.xls$|^.mobi$|^.mp3$",
-        #                os.path.splitext(file)[1].lower()):
-        #    logger.debug(f"File {file} is not a permitted file type. Should be "
-        #                 ".pdf, .txt, .doc, .xls, .mobi or .mp3 ... "
-        #                 f"[{os.path.splitext(file)[1].lower()}]"
-        #                 "This file is being droppend and NOT sent.")
-        #    return
-
-        # 'application/pdf' "plain/text" "audio/ogg"
-        mime_type = magic.from_file(file, mime=True)
-        # if ((not mime_type.startswith("application/")) and
-        #        (not mime_type.startswith("plain/")) and
-        #        (not mime_type.startswith("audio/"))):
-        #    logger.debug(f"File {file} does not have an accepted mime type. "
-        #                 "Should be something like application/pdf. "
-        #                 f"Found mime type {mime_type}. "
-        #                 "This file is being droppend and NOT sent.")
-        #    return
-
-        # first do an upload of file if it hasn't already been uploaded
-        # see https://matrix-nio.readthedocs.io/en/latest/nio.html#nio.AsyncClient.upload # noqa
-        # then send URI of upload to room
-        file_stat = await aiofiles.os.stat(file)
-
-        content_uri = self.store.get_uri(file)
-
-        if content_uri is None:
-            async with aiofiles.open(file, "r+b") as f:
-                resp, maybe_keys = await self.client.upload(
-                    f,
-                    content_type=mime_type,  # application/pdf
-                    filename=os.path.basename(file),
-                    filesize=file_stat.st_size)
-            if (isinstance(resp, UploadResponse)):
-                logger.debug("File was uploaded successfully to server. "
-                            f"Response is: {resp.content_uri}")
-                content_uri = resp.content_uri
-
-                # Store the content uri in our database for later reuse
-                logger.debug(f"Storing file {file} uri {content_uri} to the DB.")
-                self.store.set_uri(file, content_uri)
-            else:
-                error_msg = f"Failed to upload file to server. "\
-                            "Please retry. This could be temporary issue on "\
-                            "your server. "\
-                            "Sorry."
-                logger.info(error_msg)
-                logger.info(f"file=\"{file}\"; mime_type=\"{mime_type}\"; "
-                            f"filessize=\"{file_stat.st_size}\""
-                            f"Failed to upload: {resp}")
-                return resp
-        else:
-            logger.debug(f"Found URI of {file} in the DB, using: {content_uri}")
+        # The file is only hashed, inspected and uploaded again if it has changed
+        media = await self.media.get(file)
+        if isinstance(media, ErrorResponse):
+            return media
 
         content = {
             "body": os.path.basename(file),  # descriptive title
             "info": {
-                "size": file_stat.st_size,
-                "mimetype": mime_type,
+                "size": media.size,
+                "mimetype": media.mime_type,
             },
             "msgtype": "m.image",
-            "url": content_uri,
+            "url": media.uri,
         }
 
         try:
-            await self.client.room_send(
+            resp = await with_ratelimit(self.client.room_send, endpoint="send")(
                 room_id,
                 message_type="m.room.message",
-                content=content
+                content=content,
+                tx_id=tx_id,
             )
             logger.debug(f"This file was sent: \"{file}\" "
                          f"to room \"{room_id}\".")
+            return resp
         except Exception:
             logger.debug(f"File send of file {file} failed. "
                          "Sorry. Here is the traceback.")
             logger.debug(traceback.format_exc())
-        return content_uri
 
 
     def make_pill(self, user_id: str, displayname: str = None) -> str:
@@ -304,7 +294,7 @@ class ChatFunctions:
             }
         }
 
-        return await self.client.room_send(
+        return await with_ratelimit(self.client.room_send, endpoint="send")(
             room_id,
             "m.reaction",
             content,
@@ -336,23 +326,32 @@ class ChatFunctions:
         )
 
 
-    async def _send_task(self, room_id: str, send_method: staticmethod, content: str):
+    async def _send_task(self, room_id: str, send_method: staticmethod, content: str, tx_id: Optional[str] = None):
         """
         : Wait for new sync, until we receive the new room information
         : Send the message to the room
         """
-        resp = await with_ratelimit(send_method)(room_id, content)
+        kind = "image" if send_method == self.send_image_to_room else "text"
+        with metrics.dm_send_seconds.time(kind=kind):
+            resp = await send_method(room_id, content, tx_id=tx_id)
         if isinstance(resp, ErrorResponse):
+            metrics.dm_sends.inc(kind=kind, result="error")
             logger.error(
                 f"Failed to send message to room {room_id} with error: {resp.status_code}")
+        elif resp is None:
+            # The request couldn't be made, the error has been logged already
+            metrics.dm_sends.inc(kind=kind, result="error")
+        else:
+            metrics.dm_sends.inc(kind=kind, result="ok")
         return resp
 
-    async def send_msg(self, content: str, room_id: str, is_image: bool = False):
+    async def send_msg(self, content: Union[str, RenderedMessage], room_id: str, is_image: bool = False, tx_id: Optional[str] = None):
         """
         :Code from - https://github.com/vranki/hemppa/blob/dcd69da85f10a60a8eb51670009e7d6829639a2a/bot.py
         :param content: Text/Image to be sent as message
         :param room_id: A Matrix room id to send the message to
         :param is_image: Boolean if the content is of image type
+        :param tx_id: The transaction ID to send the message with
         :return bool: Returns room id upon sending the message
         """
         """
@@ -362,9 +361,9 @@ class ChatFunctions:
         """
         task = None
         method = self.send_image_to_room if is_image else self.send_text_to_room
-        print("sending task")
+        logger.debug(f"Sending message to room {room_id}")
         #task = asyncio.get_event_loop().create_task(
-        return await self._send_task(room_id, method, content)
+        return await self._send_task(room_id, method, content, tx_id)
         #    )
         #return [room_id, task]
     @staticmethod
@@ -381,12 +380,20 @@ class ChatFunctions:
     def find_private_msg(self, mxid:str)-> MatrixRoom:
         # Find if we already have a common room with user:
         msg_room = None
-        for roomid in self.client.rooms:
-            room = self.client.rooms[roomid]
-            if ChatFunctions.is_room_private_msg(room, mxid):
+        room_id = self.dm_index.get(mxid)
+        while room_id is not None:
+            room = self.client.rooms.get(room_id)
+            if room is not None and ChatFunctions.is_room_private_msg(room, mxid):
                 msg_room = room
                 break
 
+            # The index is out of date for this room, fix it and try the next one
+            if room is None:
+                self.dm_index.remove_room(room_id)
+            else:
+                self.dm_index.update_room(room)
+            room_id = self.dm_index.get(mxid)
+
         if msg_room:
             logger.debug(f"Found existing DM for user {mxid} with roomID: {msg_room.room_id}")
         return msg_room
@@ -402,7 +409,7 @@ class ChatFunctions:
        # print("WAITING FOR SYNC")
         #await self.client.synced.wait()
        # print("SYNC RECEIVED")
-        resp = await with_ratelimit(self.client.room_create)(
+        resp = await with_ratelimit(self.client.room_create, endpoint="create_room")(
                 visibility=RoomVisibility.private,
                 name=roomname,
                 is_direct=True,
@@ -417,78 +424,120 @@ class ChatFunctions:
 
 
 
-    # Code for changing user power was taken from https://github.com/elokapina/bubo/commit/d2a69117e52bb15090f993f79eeed8dbc3b3e4ae
-
-    @with_ratelimit
     async def set_user_power(
         self,
         room_id: str,
         user_id: str,
         power: int,
     ) -> Union[
-        int,
         RoomGetStateEventError,
-        RoomGetStateEventResponse,
         RoomPutStateError,
         RoomPutStateResponse,
     ]:
         """
         Set user power in a room.
+
+        The power levels are built from the cached state of the room, see
+        `PowerLevelCache`.
         """
-        logger.debug(f"Setting user power: {room_id}, user: {user_id}, level: {power}")
-        state_response = await with_ratelimit(self.client.room_get_state_event)(room_id, "m.room.power_levels")
-        if isinstance(state_response, RoomGetStateEventError):
-            logger.error(f"Failed to fetch room {room_id} state: {state_response.message}")
-            return state_response
-        if isinstance(state_response.transport_response, TransportResponse):
-            status_code = state_response.transport_response.status_code
-        elif isinstance(state_response.transport_response, ClientResponse):
-            status_code = state_response.transport_response.status
-        else:
-            logger.error(
-                f"Failed to determine status code from state response: {state_response}"
-            )
-            return state_response
-        if status_code >= 400:
-            logger.warning(
-                f"Failed to set user {user_id} power in {room_id}, response {status_code}"
-            )
-            return status_code
-        state_response.content["users"][user_id] = power
+        return await self.power_levels.set_user_power(room_id, user_id, power)
 
-        response = await with_ratelimit(self.client.room_put_state)(
-            room_id=room_id,
-            event_type="m.room.power_levels",
-            content=state_response.content,
-        )
-        return response
 
+class RoomArrivals:
+    def __init__(self, client: AsyncClient, timeout: float = ROOM_ARRIVAL_TIMEOUT):
+        """Resolves a future for each awaited room, once the room appears in a sync.
 
-class RoomFuture:
-    def __init__(self, client:AsyncClient, loop:AbstractEventLoop, mxid: str, room_id: str):
+        Rooms created by the bot only become usable once they have been synced. Rather
+        than every waiter polling the client's rooms after each sync, each sync
+        response is checked once for the rooms being waited for.
 
+        Args:
+            client: The client whose syncs are watched.
+
+            timeout: The amount of seconds to wait for a room before failing its
+                future with a TimeoutError. 0 waits forever.
+        """
         self.client = client
-        self.loop = loop
+        self.timeout = timeout
+
+        # room_id -> the future resolved once the room has been synced
+        self._futures = {}  # type: Dict[str, asyncio.Future]
+
+    def wait_for(self, room_id: str) -> asyncio.Future:
+        """Get a future resolved with the room ID once the room has been synced
+
+        Everyone waiting for the same room shares the same future.
+        """
+        future = self._futures.get(room_id)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if room_id in self.client.rooms:
+            future.set_result(room_id)
+            return future
+
+        self._futures[room_id] = future
+        if self.timeout > 0:
+            timer = loop.call_later(self.timeout, self._expire, room_id, future)
+            future.add_done_callback(lambda _: timer.cancel())
+            # Nobody may be awaiting the future any more when it times out (e.g. the
+            # room is only checked through RoomFuture.isCreated), so its TimeoutError
+            # is retrieved here rather than logged as never retrieved
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return future
+
+    async def on_sync(self, response: SyncResponse) -> None:
+        """Response callback resolving the futures of the synced rooms"""
+        if not self._futures:
+            return
+
+        for room_id in response.rooms.join:
+            future = self._futures.pop(room_id, None)
+            if future is not None and not future.done():
+                future.set_result(room_id)
+
+    def close(self) -> None:
+        """Cancel the futures of all rooms still being waited for"""
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+
+    def _expire(self, room_id: str, future: asyncio.Future) -> None:
+        if self._futures.get(room_id) is future:
+            del self._futures[room_id]
+        if not future.done():
+            future.set_exception(
+                asyncio.TimeoutError(f"Room {room_id} wasn't synced in time")
+            )
+
+
+class RoomFuture:
+    def __init__(self, arrivals: RoomArrivals, mxid: str, room_id: str):
+        """A DM room of a user, which may not have been synced yet.
+
+        Args:
+            arrivals: Tells when the room has been synced.
+
+            mxid: The user the room is a DM with.
+
+            room_id: The ID of the room.
+        """
         self.mxid = mxid
         self.room_id = room_id
+        self.arrived = arrivals.wait_for(room_id)
+
+    @property
+    def isCreated(self) -> bool:
+        """Whether the room has been synced"""
+        return (
+            self.arrived.done()
+            and not self.arrived.cancelled()
+            and self.arrived.exception() is None
+        )
 
-        self.waited_by = []
-        self.isCreated = False
-        self.isCreatedCondition = asyncio.Condition()
 
-        if room_id not in client.rooms.keys():
-            self.start_checking_state()
-        else:
-            self.isCreated = True
-    def start_checking_state(self):
-        self.loop.create_task(self.check_state())
-    async def check_state(self):
-        while self.room_id not in self.client.rooms.keys():
-            await self.client.synced.wait()
-        self.isCreated = True
-
-        async with self.isCreatedCondition:
-            self.isCreatedCondition.notify_all()
 class RoomManager:
     def __init__(
             self,
@@ -504,6 +553,8 @@ class RoomManager:
             store: Bot storage.
         """
         self.user_room_futures = {} # Queue for holding DM rooms that have been created and are waiting on new sync.
+        # mxid -> the lookup of the user's DM room in progress
+        self._lookups = {}  # type: Dict[str, asyncio.Task]
         self.chat = chat
         self.client = client
         self.store = store
@@ -516,13 +567,29 @@ class RoomManager:
 
     def room_valid(self, room_future: RoomFuture):
         # If we are still waiting for the room data - treat it as valid
-        if not room_future.isCreated:
+        if not room_future.arrived.done():
             return True
-        room = self.client.rooms[room_future.room_id]
+        room = self.client.rooms.get(room_future.room_id)
+        if not room_future.isCreated or room is None:
+            return False
         mxid = room_future.mxid
         return ChatFunctions.is_room_private_msg(room, mxid)
 
-    async def get_private_room_id(self, mxid: str) -> str:
+    async def get_private_room_id(self, mxid: str) -> Union[RoomFuture, RoomCreateError]:
+        # Messages of the same user in different rooms are moderated concurrently.
+        # Share a single lookup, so that only one DM room is created for the user
+        lookup = self._lookups.get(mxid)
+        if lookup is None:
+            lookup = asyncio.get_event_loop().create_task(
+                self._get_private_room_id(mxid)
+            )
+            self._lookups[mxid] = lookup
+            lookup.add_done_callback(lambda _: self._lookups.pop(mxid, None))
+
+        # Shield the lookup, as it is shared with the other callers waiting for it
+        return await asyncio.shield(lookup)
+
+    async def _get_private_room_id(self, mxid: str) -> Union[RoomFuture, RoomCreateError]:
         # First check if we have a processed room for the user
         if mxid in self.user_room_futures.keys():
             room_future = self.user_room_futures[mxid]
@@ -534,31 +601,41 @@ class RoomManager:
 
         # Check if client state contains info about a DM room
         existing_room = self.chat.find_private_msg(mxid)
-        loop = asyncio.get_event_loop()
-
         # Create a new room future from the existing room data.
         if existing_room is not None:
-            room_future = RoomFuture(self.client, loop, mxid, existing_room.room_id)
+            room_future = RoomFuture(self.chat.room_arrivals, mxid, existing_room.room_id)
             self.user_room_futures[mxid] = room_future
+            await self.store.set_dm_room(mxid, existing_room.room_id)
             return room_future
 
+        # Check if a DM room was stored for the user by a previous run
+        stored_room_id = await self.store.get_dm_room(mxid)
+        if stored_room_id is not None:
+            # The room may not have been synced since the bot started
+            stored_room = await self.chat.room_state.load(stored_room_id)
+
+            if stored_room is not None and ChatFunctions.is_room_private_msg(stored_room, mxid):
+                logger.debug(f"Found stored DM for user {mxid} with roomID: {stored_room_id}")
+                room_future = RoomFuture(self.chat.room_arrivals, mxid, stored_room_id)
+                self.user_room_futures[mxid] = room_future
+                return room_future
+
+            # The user (or the bot) has left the stored room
+            await self.store.delete_dm_room(mxid)
+
         # Request one to be created and add the task to the queue.
         response = await self.chat.create_private_msg(mxid, "WARNING!")
         if isinstance(response, RoomCreateResponse):
-            room_future = RoomFuture(self.client, loop, mxid, response.room_id)
+            room_future = RoomFuture(self.chat.room_arrivals, mxid, response.room_id)
             self.user_room_futures[mxid] = room_future
+            await self.store.set_dm_room(mxid, response.room_id)
             return room_future
         else:
             return response
 
-    async def send_msg_on_creation(self, content: str, room_id_future: RoomFuture, is_image: bool = False):
-        async def on_creation():
-            async with room_id_future.isCreatedCondition:
-                await room_id_future.isCreatedCondition.wait()
-                return await self.chat.send_msg(content, room_id_future.room_id, is_image)
-
-        if room_id_future.isCreated:
-            return await self.chat.send_msg(content, room_id_future.room_id, is_image)
-        else:
-            loop = asyncio.get_event_loop()
-            loop.create_task(on_creation())
+    async def send_msg_on_creation(self, content: Union[str, RenderedMessage], room_id_future: RoomFuture, is_image: bool = False):
+        # The message is stored and sent in the background once the room has been
+        # synced, in the order it was queued, even if the bot restarts in between
+        await self.chat.outbox.queue(
+            room_id_future.mxid, room_id_future.room_id, content, is_image
+        )
@@ -2,11 +2,17 @@ import logging
 import os
 import re
 import sys
+from itertools import chain
 from typing import Any, List, Optional
 
 import yaml
 
 from nio_channel_bot.errors import ConfigError
+from nio_channel_bot.offload import EXECUTORS
+from nio_channel_bot.ratelimit import DEFAULT_LIMITS
+from nio_channel_bot.rules import CompiledRules
+from nio_channel_bot.sync import DEFAULT_TIMELINE_LIMIT
+from nio_channel_bot.templates import compile_messages
 
 logger = logging.getLogger()
 logging.getLogger("peewee").setLevel(
@@ -87,6 +93,28 @@ class Config:
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
+        # Maximum amount of connections kept open to a Postgres database
+        self.database["pool_size"] = self._get_cfg(["storage", "pool_size"], default=10)
+
+        # In-memory cache of the fail counters
+        self.database["fail_cache_size"] = self._get_cfg(
+            ["storage", "fail_cache", "max_size"], default=10000
+        )
+        self.database["fail_flush_interval"] = self._get_cfg(
+            ["storage", "fail_cache", "flush_interval"], default=5
+        )
+
+        # IDs of recently processed events, so that redelivered events are skipped
+        self.database["processed_cache_size"] = self._get_cfg(
+            ["storage", "processed_events", "max_size"], default=10000
+        )
+        self.database["processed_flush_interval"] = self._get_cfg(
+            ["storage", "processed_events", "flush_interval"], default=5
+        )
+        self.database["processed_retention"] = self._get_cfg(
+            ["storage", "processed_events", "retention"], default=86400
+        )
+
         # Matrix bot account setup
         self.user_id = self._get_cfg(["matrix", "user_id"], required=True)
         if not re.match("@.*:.*", self.user_id):
@@ -107,6 +135,138 @@ class Config:
 
         self.filter_old_messages = self._get_cfg(["filter_old_messages"], default=False)
 
+        # Moderation pipeline setup
+        self.moderation_workers = self._get_cfg(["moderation", "workers"], default=4)
+        self.moderation_queue_size = self._get_cfg(
+            ["moderation", "max_queue_size"], default=100
+        )
+        self.power_level_batch_window = self._get_cfg(
+            ["moderation", "power_level_batch_window"], default=0
+        )
+
+        # Warnings sent to users
+        self.warning_window = self._get_cfg(["warnings", "window"], default=10)
+        self.warning_image_period = self._get_cfg(
+            ["warnings", "image_period"], default=3600
+        )
+
+        # Messages to users are stored in the database until they have been sent
+        self.outbox = {
+            "batch_size": self._get_cfg(["outbox", "batch_size"], default=50),
+            "retry_delay": self._get_cfg(["outbox", "retry_delay"], default=5),
+            "max_retry_delay": self._get_cfg(
+                ["outbox", "max_retry_delay"], default=600
+            ),
+            "max_attempts": self._get_cfg(["outbox", "max_attempts"], default=10),
+        }
+
+        # Raid mode setup
+        self.raid_enabled = self._get_cfg(["raid", "enabled"], default=True)
+        self.raid_threshold = self._get_cfg(["raid", "threshold"], default=20)
+        self.raid_window = self._get_cfg(["raid", "window"], default=10)
+        self.raid_cooldown = self._get_cfg(["raid", "cooldown"], default=60)
+        self.raid_batch_size = self._get_cfg(["raid", "batch_size"], default=20)
+        self.raid_lockdown_level = self._get_cfg(
+            ["raid", "lockdown_level"], required=False
+        )
+
+        # Catching up on messages sent while the bot was down
+        self.catchup_enabled = self._get_cfg(["catchup", "enabled"], default=True)
+        self.catchup_parallelism = self._get_cfg(["catchup", "parallelism"], default=4)
+        self.catchup_page_size = self._get_cfg(["catchup", "page_size"], default=100)
+        self.catchup_max_messages = self._get_cfg(
+            ["catchup", "max_messages"], default=5000
+        )
+        self.catchup_batch_size = self._get_cfg(["catchup", "batch_size"], default=20)
+        self.catchup_checkpoint_interval = self._get_cfg(
+            ["catchup", "checkpoint_interval"], default=5
+        )
+
+        # Sharding of rooms across several bot processes sharing a Postgres database
+        self.sharding_enabled = self._get_cfg(["sharding", "enabled"], required=False)
+        self.sharding_worker_id = (
+            self._get_cfg(["sharding", "worker_id"], required=False) or self.device_id
+        )
+        self.sharding_shards = self._get_cfg(["sharding", "shards"], default=64)
+        self.sharding_lease_seconds = self._get_cfg(
+            ["sharding", "lease_seconds"], default=30
+        )
+        if self.sharding_enabled and self.database["type"] != "postgres":
+            raise ConfigError("sharding requires a Postgres storage.database")
+
+        # Blocking or CPU heavy work is run outside of the event loop
+        self.offload_executor = self._get_cfg(["offload", "executor"], default="thread")
+        if self.offload_executor not in EXECUTORS:
+            raise ConfigError(f"offload.executor must be one of {', '.join(EXECUTORS)}")
+        self.offload_workers = self._get_cfg(["offload", "workers"], default=4)
+        self.offload_yield_interval = self._get_cfg(
+            ["offload", "yield_interval"], default=0.02
+        )
+        self.loop_monitor_interval = self._get_cfg(
+            ["offload", "loop_monitor_interval"], default=0.1
+        )
+        self.loop_blocked_warning = self._get_cfg(
+            ["offload", "loop_blocked_warning"], default=0.5
+        )
+
+        # Sync setup
+        self.sync_full_state = self._get_cfg(["sync", "full_state"], default=False)
+        self.sync_lazy_load_members = self._get_cfg(
+            ["sync", "lazy_load_members"], default=True
+        )
+        self.sync_timeline_types = self._get_cfg(
+            ["sync", "timeline_types"], required=False
+        )
+        self.sync_timeline_limit = self._get_cfg(
+            ["sync", "timeline_limit"], default=DEFAULT_TIMELINE_LIMIT
+        )
+
+        # Reconnection setup
+        self.reconnect = {
+            "base_delay": self._get_cfg(["reconnect", "base_delay"], default=1),
+            "max_delay": self._get_cfg(["reconnect", "max_delay"], default=60),
+            "failure_threshold": self._get_cfg(
+                ["reconnect", "failure_threshold"], default=10
+            ),
+            "cooldown": self._get_cfg(["reconnect", "cooldown"], default=300),
+        }
+
+        # Content rules, checked once here so that invalid ones stop the bot
+        self.rules_default = self._get_cfg(["rules", "default"], default={}) or {}
+        self.rules_rooms = self._get_cfg(["rules", "rooms"], default={}) or {}
+        for key, rules in chain(
+            [("default", self.rules_default)],
+            (
+                (f"rooms.{room_id}", rules)
+                for room_id, rules in self.rules_rooms.items()
+            ),
+        ):
+            try:
+                CompiledRules(rules)
+            except ConfigError as e:
+                raise ConfigError(f"Invalid rules.{key}: {e}")
+        self.rules_state_events = self._get_cfg(["rules", "state_events"], default=True)
+
+        # Metrics setup
+        self.metrics_enabled = self._get_cfg(["metrics", "enabled"], default=False)
+        self.metrics_host = self._get_cfg(["metrics", "host"], default="127.0.0.1")
+        self.metrics_port = self._get_cfg(["metrics", "port"], default=9100)
+
+        # Messages sent to users, compiled once from markdown
+        self.messages = compile_messages(self._get_cfg(["messages"], default={}))
+
+        # Rate limits of requests to the homeserver, per class of endpoint
+        self.rate_limits = self._get_cfg(["rate_limits"], default={})
+        for endpoint, limit in self.rate_limits.items():
+            if endpoint not in DEFAULT_LIMITS:
+                raise ConfigError(
+                    f"rate_limits.{endpoint} must be one of {', '.join(DEFAULT_LIMITS)}"
+                )
+            if not isinstance(limit, dict):
+                raise ConfigError(
+                    f"rate_limits.{endpoint} must contain a rate and burst"
+                )
+
     def _get_cfg(
         self,
         path: List[str],
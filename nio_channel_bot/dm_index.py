@@ -0,0 +1,99 @@
+import logging
+from itertools import chain
+from typing import Dict, Optional
+
+from nio import AsyncClient, MatrixRoom, SyncResponse
+
+from nio_channel_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class DirectRoomIndex:
+    def __init__(self, client: AsyncClient, store: Optional[Storage] = None):
+        """An index of the DM rooms the bot shares with each user.
+
+        Instead of scanning every joined room on each lookup, the index is built from
+        every room known to the client once the first sync is done, and then updated
+        incrementally whenever a room's membership changes.
+
+        A sync resumed from a stored token only carries the rooms that changed, so DM
+        rooms that stay quiet are never indexed after a restart. The DM rooms found
+        are therefore also stored, for the next runs to look them up in the store.
+
+        Args:
+            client: The client whose rooms are indexed.
+
+            store: The storage the DM rooms found are recorded in, if any.
+        """
+        self.client = client
+        self.store = store
+        self._seeded = False
+
+        # mxid -> DM room ids shared with that user, in the order they were found
+        self._rooms_by_user = {}  # type: Dict[str, Dict[str, None]]
+        # DM room id -> mxid of the other member
+        self._users_by_room = {}  # type: Dict[str, str]
+        # mxid -> the first DM room found with that user since the last sync, to store
+        self._found = {}  # type: Dict[str, str]
+
+    def get(self, mxid: str) -> Optional[str]:
+        """Get the ID of a DM room shared with a user, if there is one"""
+        room_ids = self._rooms_by_user.get(mxid)
+        if room_ids:
+            return next(iter(room_ids))
+        return None
+
+    def update_room(self, room: MatrixRoom) -> None:
+        """Re-evaluate whether a room is a DM after its membership has changed"""
+        mxid = self._dm_partner(room)
+        if self._users_by_room.get(room.room_id) == mxid:
+            return
+
+        self.remove_room(room.room_id)
+        if mxid is not None:
+            self._users_by_room[room.room_id] = mxid
+            self._rooms_by_user.setdefault(mxid, {})[room.room_id] = None
+            if self.store is not None:
+                self._found.setdefault(mxid, room.room_id)
+
+    def remove_room(self, room_id: str) -> None:
+        """Remove a room from the index, e.g. after the bot has left it"""
+        mxid = self._users_by_room.pop(room_id, None)
+        if mxid is None:
+            return
+
+        room_ids = self._rooms_by_user[mxid]
+        room_ids.pop(room_id, None)
+        if not room_ids:
+            del self._rooms_by_user[mxid]
+
+    async def on_sync(self, response: SyncResponse) -> None:
+        """Response callback applying the membership changes of a sync to the index"""
+        for room_id in response.rooms.leave:
+            self.remove_room(room_id)
+
+        if not self._seeded:
+            # Index every room the client knows of, not only those in this response
+            self._seeded = True
+            for room in list(self.client.rooms.values()):
+                self.update_room(room)
+        else:
+            for room_id in response.rooms.join:
+                room = self.client.rooms.get(room_id)
+                if room is not None:
+                    self.update_room(room)
+
+        if self._found:
+            found, self._found = self._found, {}
+            await self.store.add_dm_rooms(found)
+
+    def _dm_partner(self, room: MatrixRoom) -> Optional[str]:
+        """Get the mxid of the other member of a DM room, or None if it isn't a DM"""
+        if room.member_count != 2:
+            return None
+
+        for user_id in chain(room.users, room.invited_users):
+            if user_id != self.client.user_id:
+                return user_id
+        return None
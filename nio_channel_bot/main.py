@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
+import signal
 import sys
-from time import sleep
+import time
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
-    AsyncClient,
     AsyncClientConfig,
+    Event,
     InviteMemberEvent,
     LocalProtocolError,
     LoginError,
@@ -15,11 +16,27 @@ from nio import (
     RoomMessageText,
     UnknownEvent,
     RoomMemberEvent,
+    SyncResponse,
 )
 
 from nio_channel_bot.callbacks import Callbacks
+from nio_channel_bot.catchup import CatchUp, RoomCheckpoints
 from nio_channel_bot.config import Config
+from nio_channel_bot.metrics import MetricsServer
+from nio_channel_bot.offload import (
+    CooperativeYield,
+    LoopMonitor,
+    OffloadingClient,
+    offloader,
+)
+from nio_channel_bot.pipeline import ModerationPipeline
+from nio_channel_bot.raid import BulkModerator, RaidDetector, RaidMode
+from nio_channel_bot.ratelimit import rate_limiter
+from nio_channel_bot.reconnect import ReconnectBackoff
+from nio_channel_bot.rules import MEDIA_EVENTS, RuleEngine
+from nio_channel_bot.sharding import ShardCoordinator
 from nio_channel_bot.storage import Storage
+from nio_channel_bot.sync import StartupTimer, build_sync_filter, upload_sync_filter
 from nio_channel_bot.chat_functions import ChatFunctions
 
 logger = logging.getLogger(__name__)
@@ -27,6 +44,7 @@ logger = logging.getLogger(__name__)
 
 async def main():
     """The first function that is run when starting the bot"""
+    started = time.monotonic()
 
     # Read user-configured options from a config file.
     # A different config file path can be specified as the first command line argument
@@ -38,8 +56,31 @@ async def main():
     # Read the parsed config file and create a Config object
     config = Config(config_path)
 
+    # Configure the rate limits shared by all requests to the homeserver
+    rate_limiter.configure(config.rate_limits)
+
+    # Run blocking work in a bounded pool, and report when the event loop is blocked
+    offloader.configure(config.offload_executor, config.offload_workers)
+    loop_monitor = LoopMonitor(
+        config.loop_monitor_interval, config.loop_blocked_warning
+    )
+    loop_monitor.start()
+
     # Configure the database
     store = Storage(config.database)
+    await store.connect()
+
+    # Take the shards of rooms this process moderates before any event is handled
+    shards = None
+    if config.sharding_enabled:
+        shards = ShardCoordinator(
+            store,
+            config.sharding_worker_id,
+            config.sharding_shards,
+            config.sharding_lease_seconds,
+        )
+        await shards.rebalance()
+        shards.start()
 
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
@@ -49,8 +90,8 @@ async def main():
         encryption_enabled=True,
     )
 
-    # Initialize the matrix client
-    client = AsyncClient(
+    # Initialize the matrix client. Sync responses are parsed outside of the loop
+    client = OffloadingClient(
         config.homeserver_url,
         config.user_id,
         device_id=config.device_id,
@@ -63,11 +104,60 @@ async def main():
         client.user_id = config.user_id
 
     # Set up Chat Functions
-    chat = ChatFunctions(client, store)
+    chat = ChatFunctions(
+        client,
+        store,
+        config.power_level_batch_window,
+        config.messages,
+        config.warning_window,
+        config.warning_image_period,
+        dict(config.outbox, shards=shards),
+    )
+
+    # Set up the moderation pipeline
+    pipeline = ModerationPipeline(
+        config.moderation_workers, config.moderation_queue_size
+    )
+    pipeline.start()
+
+    # Moderate flooded rooms in bulk
+    raid = None
+    if config.raid_enabled:
+        raid = RaidMode(
+            client,
+            store,
+            chat,
+            RaidDetector(
+                config.raid_threshold, config.raid_window, config.raid_cooldown
+            ),
+            pipeline,
+            config.raid_batch_size,
+            config.raid_lockdown_level,
+            shards,
+        )
 
     # Set up event callbacks
-    callbacks = Callbacks(client, store, config, chat)
-    client.add_event_callback(callbacks.message, (RoomMessageText,))
+    # Remember the last message processed in each room, to catch up on missed ones
+    checkpoints = None
+    if config.catchup_enabled:
+        checkpoints = RoomCheckpoints(store, config.catchup_checkpoint_interval)
+        await checkpoints.load()
+        checkpoints.start()
+
+    # The content rules of each room, compiled as they are first needed
+    rules = RuleEngine(
+        store, config.rules_default, config.rules_rooms, config.rules_state_events
+    )
+    await rules.load()
+
+    callbacks = Callbacks(
+        client, store, config, chat, pipeline, raid, shards, checkpoints, rules
+    )
+    # Let other tasks run between the events of large syncs
+    client.add_event_callback(
+        CooperativeYield(config.offload_yield_interval).on_event, (Event,)
+    )
+    client.add_event_callback(callbacks.message, (RoomMessageText,) + MEDIA_EVENTS)
     client.add_event_callback(
         callbacks.invite_event_filtered_callback, (InviteMemberEvent,)
     )
@@ -75,55 +165,158 @@ async def main():
     client.add_event_callback(callbacks.joined, (RoomMemberEvent,))
     client.add_event_callback(callbacks.unknown, (UnknownEvent,))
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            if config.user_token:
-                # Use token to log in
-                client.load_store()
-
-                # Sync encryption keys with the server
-                if client.should_upload_keys:
-                    await client.keys_upload()
-            else:
-                # Try to login with the configured username/password
-                try:
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
-
-                    # Check if login failed
-                    if type(login_response) == LoginError:
-                        logger.error("Failed to login: %s", login_response.message)
+    # Moderate the messages sent while the bot was down, once the first sync is done
+    catchup = None
+    if checkpoints is not None:
+        catchup = CatchUp(
+            client,
+            checkpoints,
+            BulkModerator(client, store, chat, config.catchup_batch_size),
+            callbacks.needs_moderation,
+            config.catchup_parallelism,
+            config.catchup_page_size,
+            config.catchup_max_messages,
+            shards,
+        )
+
+    # Apply membership changes from every sync to the DM room index
+    client.add_response_callback(chat.dm_index.on_sync, (SyncResponse,))
+
+    # Cache the power levels of every synced room
+    client.add_response_callback(chat.power_levels.on_sync, (SyncResponse,))
+
+    # Resolve the DM rooms being waited for as they are synced
+    client.add_response_callback(chat.room_arrivals.on_sync, (SyncResponse,))
+
+    # Pick up the content rules moderators set in rooms
+    client.add_response_callback(rules.on_sync, (SyncResponse,))
+
+    # Keep track of the rooms whose full state has been synced
+    client.add_response_callback(chat.room_state.on_sync, (SyncResponse,))
+    startup_timer = StartupTimer(client, started)
+    client.add_response_callback(startup_timer.on_sync, (SyncResponse,))
+    if catchup is not None:
+        client.add_response_callback(catchup.on_sync, (SyncResponse,))
+
+    # Lift the raid lockdowns left by a previous run
+    if raid is not None:
+        client.add_response_callback(raid.on_sync, (SyncResponse,))
+
+    # Serve metrics of the moderation hot paths
+    metrics_server = None
+    if config.metrics_enabled:
+        metrics_server = MetricsServer(config.metrics_host, config.metrics_port)
+        await metrics_server.start()
+        client.add_response_callback(metrics_server.on_sync, (SyncResponse,))
+
+    # Back off between reconnection attempts, until a sync succeeds again
+    backoff = ReconnectBackoff(**config.reconnect)
+    client.add_response_callback(backoff.on_sync, (SyncResponse,))
+
+    # Stop gracefully on SIGINT/SIGTERM, so that cached data is written to the database
+    main_task = asyncio.current_task()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_event_loop().add_signal_handler(signum, main_task.cancel)
+
+    try:
+        # Only sync the events the bot needs
+        sync_filter = build_sync_filter(
+            config.sync_lazy_load_members,
+            config.sync_timeline_types,
+            config.sync_timeline_limit,
+        )
+
+        # Keep trying to reconnect on failure (with some time in-between)
+        logged_in = False
+        while True:
+            try:
+                if logged_in:
+                    # Reconnecting, the session is still valid. Work queued by the
+                    # moderation pipeline and pending DMs carry on once syncing resumes
+                    logger.info("Reconnecting to the homeserver...")
+                elif config.user_token:
+                    # Use token to log in
+                    client.load_store()
+
+                    # Sync encryption keys with the server
+                    if client.should_upload_keys:
+                        await client.keys_upload()
+                else:
+                    # Try to login with the configured username/password
+                    try:
+                        login_response = await client.login(
+                            password=config.user_password,
+                            device_name=config.device_name,
+                        )
+
+                        # Check if login failed
+                        if type(login_response) == LoginError:
+                            logger.error("Failed to login: %s", login_response.message)
+                            return False
+                    except LocalProtocolError as e:
+                        # There's an edge case here where the user hasn't installed the correct C
+                        # dependencies. In that case, a LocalProtocolError is raised on login.
+                        logger.fatal(
+                            "Failed to login. Have you installed the correct dependencies? "
+                            "https://github.com/poljar/matrix-nio#installation "
+                            "Error: %s",
+                            e,
+                        )
                         return False
-                except LocalProtocolError as e:
-                    # There's an edge case here where the user hasn't installed the correct C
-                    # dependencies. In that case, a LocalProtocolError is raised on login.
-                    logger.fatal(
-                        "Failed to login. Have you installed the correct dependencies? "
-                        "https://github.com/poljar/matrix-nio#installation "
-                        "Error: %s",
-                        e,
-                    )
-                    return False
-
-                # Login succeeded!
-
-            logger.info(f"Logged in as {config.user_id}")
-            # Perform first time sync
-            # await client.synced.wait()
-            await client.sync_forever(timeout=30000, full_state=True)
-
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
-
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
-
-
-# Run the main function in an asyncio event loop
-asyncio.get_event_loop().run_until_complete(main())
+
+                    # Login succeeded!
+
+                if not logged_in:
+                    logger.info(f"Logged in as {config.user_id}")
+                    logged_in = True
+
+                    # Send the messages to users queued so far, including those
+                    # left over from a previous run
+                    chat.outbox.start()
+
+                # Upload the filter once, the homeserver then applies it by its ID
+                if isinstance(sync_filter, dict):
+                    sync_filter = await upload_sync_filter(client, store, sync_filter)
+                # Perform first time sync
+                # await client.synced.wait()
+                # Resume from the stored sync token if there is one. The full state
+                # of rooms is only fetched when the bot needs to act in them
+                await client.sync_forever(
+                    timeout=30000,
+                    full_state=config.sync_full_state,
+                    sync_filter=sync_filter,
+                )
+
+            except (
+                ClientConnectionError,
+                ServerDisconnectedError,
+                asyncio.TimeoutError,
+            ):
+                # Wait so we don't bombard the server with requests. The connection
+                # is kept open, so requests of other tasks aren't cut off
+                await backoff.wait()
+    except asyncio.CancelledError:
+        logger.info("Shutting down...")
+    finally:
+        if catchup is not None:
+            await catchup.close()
+        await pipeline.close()
+        # Lift the lockdown of raided rooms while the client is still open
+        if raid is not None:
+            await raid.close()
+        # Send the warnings still being held back
+        await chat.warnings.close()
+        await chat.outbox.close()
+        chat.room_arrivals.close()
+        if checkpoints is not None:
+            await checkpoints.close()
+        # Hand the shards of this process over to the others
+        if shards is not None:
+            await shards.close()
+        # Make sure to close the client connection
+        await client.close()
+        if metrics_server is not None:
+            await metrics_server.close()
+        await store.close()
+        await loop_monitor.close()
+        offloader.close()
@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import logging
+import os
+import stat
+from typing import Dict, NamedTuple, Union
+
+import aiofiles
+import magic
+from nio import AsyncClient, ErrorResponse, UploadResponse
+
+from nio_channel_bot.offload import offloader
+from nio_channel_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class MediaInfo(NamedTuple):
+    """A local file that has been uploaded to the homeserver"""
+
+    path: str
+    mtime_ns: int
+    size: int
+    sha256: str
+    mime_type: str
+    uri: str
+
+
+def _hash_file(path: str) -> str:
+    """Compute the SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _mime_type(path: str) -> str:
+    """Detect the MIME type of a file from its contents, e.g. 'application/pdf'"""
+    return magic.from_file(path, mime=True)
+
+
+class MediaCache:
+    def __init__(self, client: AsyncClient, store: Storage):
+        """Uploads local files once, and remembers their content URIs.
+
+        The hash, mime type and content URI of a file are kept in memory and only
+        recomputed when the file's modification time or size change. Content URIs are
+        stored in the database along with the hash of the uploaded contents, so a file
+        that changed while the bot was not running is uploaded again.
+
+        Args:
+            client: The client to upload files with.
+
+            store: Bot storage.
+        """
+        self.client = client
+        self.store = store
+
+        # path -> the last known version of the file
+        self._entries = {}  # type: Dict[str, MediaInfo]
+        # Only one upload of the same file happens at a time
+        self._locks = {}  # type: Dict[str, asyncio.Lock]
+
+    async def get(self, path: str) -> Union[MediaInfo, ErrorResponse]:
+        """Get the uploaded version of a file, uploading it if necessary
+
+        Args:
+            path: The path of the file.
+
+        Returns:
+            The uploaded file's info, or an ErrorResponse if the file doesn't exist or
+            could not be uploaded.
+        """
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            file_stat = None
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            error_msg = f"File {path} is not a file. Doesn't exist or is a directory. This file is being droppend and NOT sent."
+            logger.debug(error_msg)
+            return ErrorResponse(error_msg)
+
+        entry = self._entries.get(path)
+        if self._is_current(entry, file_stat):
+            return entry
+
+        lock = self._locks.get(path)
+        if lock is None:
+            lock = self._locks[path] = asyncio.Lock()
+
+        async with lock:
+            # The file may have been uploaded while we were waiting
+            entry = self._entries.get(path)
+            if self._is_current(entry, file_stat):
+                return entry
+
+            sha256 = await offloader.run("hash_file", _hash_file, path)
+            mime_type = await offloader.run("mime_type", _mime_type, path)
+
+            uri = await self.store.get_uri(path, sha256)
+            if uri is not None:
+                logger.debug(f"Found URI of {path} in the DB, using: {uri}")
+            else:
+                resp = await self._upload(path, mime_type, file_stat.st_size)
+                if not isinstance(resp, UploadResponse):
+                    return resp
+                uri = resp.content_uri
+
+                # Store the content uri in our database for later reuse
+                logger.debug(f"Storing file {path} uri {uri} to the DB.")
+                await self.store.set_uri(path, uri, sha256)
+
+            entry = MediaInfo(
+                path, file_stat.st_mtime_ns, file_stat.st_size, sha256, mime_type, uri
+            )
+            self._entries[path] = entry
+            return entry
+
+    async def _upload(self, path: str, mime_type: str, size: int):
+        # see https://matrix-nio.readthedocs.io/en/latest/nio.html#nio.AsyncClient.upload # noqa
+        async with aiofiles.open(path, "r+b") as f:
+            resp, maybe_keys = await self.client.upload(
+                f,
+                content_type=mime_type,  # application/pdf
+                filename=os.path.basename(path),
+                filesize=size,
+            )
+        if isinstance(resp, UploadResponse):
+            logger.debug(
+                "File was uploaded successfully to server. "
+                f"Response is: {resp.content_uri}"
+            )
+        else:
+            logger.info(
+                "Failed to upload file to server. Please retry. This could be "
+                "temporary issue on your server. Sorry."
+            )
+            logger.info(
+                f'file="{path}"; mime_type="{mime_type}"; '
+                f'filessize="{size}"'
+                f"Failed to upload: {resp}"
+            )
+        return resp
+
+    @staticmethod
+    def _is_current(entry: MediaInfo, file_stat: os.stat_result) -> bool:
+        """Whether a cached entry is of the file's current version"""
+        return (
+            entry is not None
+            and entry.mtime_ns == file_stat.st_mtime_ns
+            and entry.size == file_stat.st_size
+        )
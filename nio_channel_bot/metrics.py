@@ -0,0 +1,340 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Label values of a single series, in the order of the metric's label names
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        """A named metric with a series per combination of label values.
+
+        Args:
+            name: The name of the metric, e.g. "bot_messages_total".
+
+            description: A short description of what the metric measures.
+
+            labels: The names of the labels the metric's series are split by.
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _format_labels(self, key: LabelValues, **extra: str) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        """Render the metric in the Prometheus text exposition format"""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. the number of redacted messages"""
+
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self.values = {}  # type: Dict[LabelValues, float]
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the counter of the series with the given label values"""
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        """Get the value of the series with the given label values"""
+        return self.values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{self._format_labels(key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, e.g. the depth of a queue"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set the value of the series with the given label values"""
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """The distribution of observed values, e.g. request latencies"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+        # label values -> the amount of observations in each bucket, the last one
+        # being +Inf. Counts are not cumulative until rendered
+        self.counts = {}  # type: Dict[LabelValues, List[int]]
+        self.sums = {}  # type: Dict[LabelValues, float]
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record a single observation in the series with the given label values"""
+        key = self._key(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0.0
+
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Observe the amount of seconds spent in a `with` block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        """Get the amount of observations of the series with the given label values"""
+        return sum(self.counts.get(self._key(labels), ()))
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, counts in self.counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(
+                    f"{self.name}_bucket{self._format_labels(key, le=le)} {total}"
+                )
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {self.sums[key]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {total}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """A collection of metrics, rendered together"""
+        self.metrics = {}  # type: Dict[str, Metric]
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric to the registry, returning it"""
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, description: str, labels: Sequence[str] = ()
+    ) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# The metrics of the whole process
+registry = Registry()
+
+messages_seen = registry.counter(
+    "bot_messages_total", "Messages received in channels", ["thread"]
+)
+moderation_seconds = registry.histogram(
+    "bot_moderation_seconds", "Time taken to moderate a single message"
+)
+redactions = registry.counter(
+    "bot_redactions_total", "Messages redacted by the bot", ["result"]
+)
+redaction_seconds = registry.histogram(
+    "bot_redaction_seconds", "Time taken by redaction requests"
+)
+mutes = registry.counter("bot_mutes_total", "Users muted by the bot", ["result"])
+mute_seconds = registry.histogram(
+    "bot_mute_seconds", "Time taken to mute a user, including batching"
+)
+dm_sends = registry.counter(
+    "bot_dm_sends_total", "Messages sent to users in DMs", ["kind", "result"]
+)
+dm_send_seconds = registry.histogram(
+    "bot_dm_send_seconds", "Time taken to send a message to a user", ["kind"]
+)
+ratelimit_waits = registry.histogram(
+    "bot_ratelimit_wait_seconds",
+    "Time requests waited for the rate limiter",
+    ["endpoint"],
+)
+ratelimit_hits = registry.counter(
+    "bot_ratelimit_hits_total",
+    "Requests rate limited by the homeserver",
+    ["endpoint"],
+)
+db_query_seconds = registry.histogram(
+    "bot_db_query_seconds", "Time taken by database statements", ["operation"]
+)
+loop_lag_seconds = registry.histogram(
+    "bot_event_loop_lag_seconds",
+    "How late the event loop ran a task scheduled to wake up on time",
+)
+loop_blocked_seconds = registry.counter(
+    "bot_event_loop_blocked_seconds_total",
+    "Time during which the event loop could not run other tasks",
+)
+offload_seconds = registry.histogram(
+    "bot_offload_seconds",
+    "Time taken by blocking or CPU heavy work run outside of the event loop",
+    ["task"],
+)
+offload_waiting = registry.gauge(
+    "bot_offload_waiting", "Blocking or CPU heavy work waiting for a free worker"
+)
+queue_seconds = registry.histogram(
+    "bot_moderation_queue_seconds", "Time messages waited to be moderated"
+)
+queue_depth = registry.gauge(
+    "bot_moderation_queue_depth", "Messages waiting to be moderated, over all rooms"
+)
+startup_seconds = registry.gauge(
+    "bot_startup_seconds", "Time from starting the bot to the end of the first sync"
+)
+reconnects = registry.counter(
+    "bot_reconnects_total", "Failed attempts to connect to the homeserver"
+)
+sync_seconds = registry.histogram(
+    "bot_sync_interval_seconds",
+    "Time between consecutive sync responses, including processing them",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 35, 60, 120),
+)
+warnings = registry.counter(
+    "bot_warnings_total",
+    "Warnings given to users, either sent or merged into a pending one",
+    ["result"],
+)
+outbox_messages = registry.counter(
+    "bot_outbox_messages_total",
+    "Messages to users queued, sent, retried or dropped by the outbox",
+    ["event"],
+)
+raids = registry.counter(
+    "bot_raids_total", "Rooms switched into raid mode, or locked down", ["event"]
+)
+raided_rooms = registry.gauge("bot_raided_rooms", "Rooms currently in raid mode")
+duplicate_events = registry.counter(
+    "bot_duplicate_events_total", "Messages skipped as they had already been processed"
+)
+rule_matches = registry.counter(
+    "bot_rule_matches_total", "Messages moderated for breaking a content rule", ["rule"]
+)
+rules_compile_seconds = registry.histogram(
+    "bot_rules_compile_seconds", "Time taken to compile the content rules of a room"
+)
+catchup_messages = registry.counter(
+    "bot_catchup_messages_total",
+    "Messages sent while the bot was down, scanned or redacted on startup",
+    ["result"],
+)
+catchup_rooms = registry.gauge(
+    "bot_catchup_rooms", "Rooms whose missed messages are waiting to be caught up on"
+)
+catchup_seconds = registry.gauge(
+    "bot_catchup_seconds", "Time taken to catch up on the messages missed while down"
+)
+owned_shards = registry.gauge("bot_owned_shards", "Room shards owned by this worker")
+shard_changes = registry.counter(
+    "bot_shard_changes_total", "Room shards gained or lost by this worker", ["event"]
+)
+
+
+class MetricsServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 9100,
+        metrics: Optional[Registry] = None,
+    ):
+        """Serves the metrics over HTTP at /metrics.
+
+        Args:
+            host: The address to listen on.
+
+            port: The port to listen on.
+
+            metrics: The registry to serve. Defaults to the registry of the process.
+        """
+        self.host = host
+        self.port = port
+        self.metrics = metrics or registry
+
+        self._runner = None  # type: Optional[web.AppRunner]
+        self._last_sync = None  # type: Optional[float]
+
+    async def start(self) -> None:
+        """Start listening"""
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self) -> None:
+        """Stop the server"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def on_sync(self, response) -> None:
+        """Response callback recording the time between sync responses"""
+        now = time.monotonic()
+        if self._last_sync is not None:
+            sync_seconds.observe(now - self._last_sync)
+        self._last_sync = now
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.metrics.render(), content_type="text/plain", charset="utf-8"
+        )
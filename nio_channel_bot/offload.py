@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from aiohttp import ClientResponse
+from nio import AsyncClient, Event, MatrixRoom, Response, SyncResponse
+
+from nio_channel_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = ("thread", "process")
+
+
+class Offloader:
+    def __init__(self, executor: str = "thread", workers: int = 4):
+        """Runs blocking or CPU heavy functions outside of the event loop thread.
+
+        At most `workers` functions run at once. Further callers wait on the event
+        loop, so that a burst of work can't pile up in the pool.
+
+        Args:
+            executor: Either "thread" to run functions in a thread pool, or "process"
+                to run them in a pool of processes. Functions run in processes, and
+                their arguments, must be picklable.
+
+            workers: The maximum amount of functions running at once.
+        """
+        self.executor = executor
+        self.workers = workers
+
+        self._pool = None  # type: Optional[Executor]
+        # Runs functions whose results can't be sent back from another process
+        self._thread_pool = None  # type: Optional[Executor]
+        self._semaphore = None  # type: Optional[asyncio.Semaphore]
+        # The loop the semaphore was created for
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+
+    def configure(self, executor: str, workers: int) -> None:
+        """Change the pool functions are run in. Functions already running finish in
+        the previous pool"""
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor {executor}")
+        self.close(wait=False)
+        self.executor = executor
+        self.workers = workers
+
+    async def run(
+        self, task: str, func: Callable[..., Any], *args: Any, picklable: bool = True
+    ) -> Any:
+        """Run a function in the pool, and wait for its result
+
+        Args:
+            task: The name of the task, used as a metrics label.
+
+            func: The function to run.
+
+            args: The arguments to call the function with.
+
+            picklable: Whether the function, its arguments and its result can be
+                pickled. If not, the function is always run in a thread.
+        """
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.workers)
+            self._loop = loop
+
+        metrics.offload_waiting.inc()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            metrics.offload_waiting.inc(-1)
+
+        try:
+            with metrics.offload_seconds.time(task=task):
+                return await loop.run_in_executor(
+                    self._get_pool(picklable), func, *args
+                )
+        finally:
+            self._semaphore.release()
+
+    def close(self, wait: bool = True) -> None:
+        """Shut the pool down"""
+        for pool in (self._pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=wait)
+        self._pool = None
+        self._thread_pool = None
+        self._semaphore = None
+
+    def _get_pool(self, picklable: bool) -> Executor:
+        if self.executor == "process" and picklable:
+            if self._pool is None:
+                # Forking a process that runs threads (e.g. aiosqlite's) isn't safe
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="offload"
+            )
+        return self._thread_pool
+
+
+# The pool shared by the whole process
+offloader = Offloader()
+
+
+def parse_sync_response(body: Dict[str, Any]) -> Response:
+    """Validate a sync response body and build its events"""
+    return SyncResponse.from_dict(body)
+
+
+def _parse_sync_body(body: bytes) -> Response:
+    try:
+        parsed = json.loads(body)
+    except json.JSONDecodeError:
+        # Turned into a SyncError, as nio does
+        parsed = {}
+    return parse_sync_response(parsed)
+
+
+class OffloadingClient(AsyncClient):
+    """An AsyncClient that parses sync responses outside of the event loop.
+
+    nio validates and builds every event of a sync response in one go, which takes
+    the longest of anything the bot does for large syncs. The events are built in a
+    thread, so other tasks keep running in the meantime.
+    """
+
+    async def create_matrix_response(
+        self,
+        response_class: type,
+        transport_response: ClientResponse,
+        data: Optional[tuple] = None,
+        save_to=None,
+    ) -> Response:
+        if (
+            response_class is not SyncResponse
+            or transport_response.status != 200
+            or transport_response.content_type != "application/json"
+        ):
+            return await super().create_matrix_response(
+                response_class, transport_response, data, save_to
+            )
+
+        body = await transport_response.read()
+        response = await offloader.run(
+            "parse_sync", _parse_sync_body, body, picklable=False
+        )
+        response.transport_response = transport_response
+        return response
+
+
+class CooperativeYield:
+    def __init__(self, interval: float = 0.02):
+        """Lets other tasks run while a large sync is being processed.
+
+        nio decrypts and dispatches every event of a sync response without giving
+        control back to the event loop, as long as the event callbacks don't wait on
+        anything. Registered as an event callback, this gives control back once the
+        loop has been held for `interval` seconds, so that a heavy sync batch doesn't
+        hold up redactions in other rooms.
+
+        Decryption itself can't be moved off the loop, as nio's olm sessions are
+        neither thread safe nor picklable.
+
+        Args:
+            interval: The maximum amount of seconds to hold the loop for.
+        """
+        self.interval = interval
+        self._last_yield = time.monotonic()
+
+    async def on_event(self, room: MatrixRoom, event: Event) -> None:
+        """Event callback giving control back to the loop if it has been held too long"""
+        if time.monotonic() - self._last_yield >= self.interval:
+            await asyncio.sleep(0)
+            self._last_yield = time.monotonic()
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.1, warning_threshold: float = 0.5):
+        """Measures how long the event loop is blocked for.
+
+        A task sleeping for `interval` seconds at a time records how late it wakes up.
+        That delay is time during which no other task could run.
+
+        Args:
+            interval: How often to sample the event loop, in seconds.
+
+            warning_threshold: Blocks longer than this many seconds are logged.
+        """
+        self.interval = interval
+        self.warning_threshold = warning_threshold
+
+        # The total and longest amount of seconds the loop was blocked for
+        self.blocked_seconds = 0.0
+        self.max_blocked_seconds = 0.0
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def start(self) -> None:
+        """Start sampling the event loop"""
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._sample())
+
+    async def close(self) -> None:
+        """Stop sampling the event loop"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sample(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - start - self.interval)
+
+            metrics.loop_lag_seconds.observe(lag)
+            metrics.loop_blocked_seconds.inc(lag)
+            self.blocked_seconds += lag
+            self.max_blocked_seconds = max(self.max_blocked_seconds, lag)
+            if lag >= self.warning_threshold:
+                logger.warning(f"Event loop was blocked for {lag:.3f}s")
@@ -0,0 +1,496 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+from nio import ErrorResponse
+
+from nio_channel_bot import metrics
+from nio_channel_bot.storage import Storage
+from nio_channel_bot.templates import MessageTemplate, RenderedMessage
+
+if TYPE_CHECKING:
+    from nio_channel_bot.chat_functions import ChatFunctions, RoomFuture, RoomManager
+    from nio_channel_bot.sharding import ShardCoordinator
+
+logger = logging.getLogger(__name__)
+
+# Sent along with warnings, showing how to reply in threads
+WARNING_IMAGE = "media/info_threads.gif"
+
+
+class _PendingWarning:
+    def __init__(
+        self,
+        room_future: "RoomFuture",
+        room_name: str,
+        count: int,
+        rule: Optional[str] = None,
+    ):
+        self.room_future = room_future
+        self.room_name = room_name
+        self.count = count
+        # The content rule the last message broke, if any
+        self.rule = rule
+        # The amount of warnings merged into this one
+        self.merged = 0
+
+
+class WarningOutbox:
+    def __init__(
+        self,
+        room_manager: "RoomManager",
+        messages: Dict[str, MessageTemplate],
+        window: float = 10,
+        image_period: float = 3600,
+    ):
+        """Coalesces the warnings sent to users in DMs.
+
+        The first warning of a user in a room is held back for `window` seconds. Any
+        further warnings of the same user and room within that time are merged into
+        it, so the user gets a single message with the final count. The image showing
+        how to use threads is sent at most once per user every `image_period` seconds.
+
+        Args:
+            room_manager: Finds or creates the DM rooms messages are sent to.
+
+            messages: The compiled messages sent to users.
+
+            window: The amount of seconds to collect warnings for. 0 sends every
+                warning right away.
+
+            image_period: The minimum amount of seconds between sending the image to
+                the same user.
+        """
+        self.room_manager = room_manager
+        self.messages = messages
+        self.window = window
+        self.image_period = image_period
+
+        # (user_id, room_id) -> the warning waiting to be sent
+        self._pending = {}  # type: Dict[Tuple[str, str], _PendingWarning]
+        # (user_id, room_id) -> the task sending the pending warning
+        self._timers = {}  # type: Dict[Tuple[str, str], asyncio.Task]
+        # user_id -> the last time the image was sent to the user, oldest first
+        self._image_sent = OrderedDict()  # type: OrderedDict[str, float]
+
+    async def warn(
+        self,
+        user_id: str,
+        room_future: "RoomFuture",
+        room_id: str,
+        room_name: str,
+        count: int,
+        rule: Optional[str] = None,
+    ) -> None:
+        """Warn a user that their message was deleted
+
+        Args:
+            user_id: The user to warn.
+
+            room_future: The DM room of the user.
+
+            room_id: The room the message was deleted from.
+
+            room_name: The name of that room.
+
+            count: The amount of messages of the user deleted so far.
+
+            rule: The content rule of the room the message broke, if it was deleted
+                for breaking one.
+        """
+        key = (user_id, room_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.room_future = room_future
+            pending.count = count
+            pending.rule = rule
+            pending.merged += 1
+            metrics.warnings.inc(result="coalesced")
+            return
+
+        pending = _PendingWarning(room_future, room_name, count, rule)
+        if self.window <= 0:
+            await self._send(user_id, pending)
+            return
+
+        self._pending[key] = pending
+        self._timers[key] = asyncio.get_event_loop().create_task(
+            self._send_after_window(key)
+        )
+
+    async def ban(
+        self,
+        user_id: str,
+        room_future: "RoomFuture",
+        room_id: str,
+        room_name: str,
+        admins: str,
+    ) -> None:
+        """Tell a user they have been muted, dropping their pending warning
+
+        Args:
+            user_id: The muted user.
+
+            room_future: The DM room of the user.
+
+            room_id: The room the user was muted in.
+
+            room_name: The name of that room.
+
+            admins: The admins of that room.
+        """
+        key = (user_id, room_id)
+        if self._pending.pop(key, None) is not None:
+            self._timers.pop(key).cancel()
+
+        await self.room_manager.send_msg_on_creation(
+            self.messages["ban"].render(room_name=room_name, admins=admins),
+            room_future,
+        )
+
+    async def close(self) -> None:
+        """Send all pending warnings right away"""
+        for key, timer in list(self._timers.items()):
+            timer.cancel()
+            await asyncio.gather(timer, return_exceptions=True)
+
+            pending = self._pending.pop(key, None)
+            self._timers.pop(key, None)
+            if pending is not None:
+                await self._send(key[0], pending)
+
+    async def _send_after_window(self, key: Tuple[str, str]) -> None:
+        await asyncio.sleep(self.window)
+
+        del self._timers[key]
+        pending = self._pending.pop(key)
+        try:
+            await self._send(key[0], pending)
+        except Exception:
+            logger.exception(f"Failed to send a warning to {key[0]}")
+
+    async def _send(self, user_id: str, pending: _PendingWarning) -> None:
+        if pending.merged:
+            logger.debug(
+                f"Sending {pending.merged + 1} warnings to {user_id} as a single message"
+            )
+        metrics.warnings.inc(result="sent")
+
+        if pending.rule is not None:
+            # The threads image is of no help with the rules of a room
+            await self.room_manager.send_msg_on_creation(
+                self.messages["rule_warning"].render(
+                    count=pending.count, room_name=pending.room_name, rule=pending.rule
+                ),
+                pending.room_future,
+            )
+            return
+
+        await self.room_manager.send_msg_on_creation(
+            self.messages["warning"].render(
+                count=pending.count, room_name=pending.room_name
+            ),
+            pending.room_future,
+        )
+
+        if self._should_send_image(user_id):
+            await self.room_manager.send_msg_on_creation(
+                WARNING_IMAGE, pending.room_future, is_image=True
+            )
+
+    def _should_send_image(self, user_id: str) -> bool:
+        now = time.monotonic()
+
+        # Forget users whose period is over, so the dictionary doesn't keep growing
+        while self._image_sent:
+            oldest_user, sent_at = next(iter(self._image_sent.items()))
+            if now - sent_at < self.image_period:
+                break
+            del self._image_sent[oldest_user]
+
+        if user_id in self._image_sent:
+            return False
+
+        self._image_sent[user_id] = now
+        return True
+
+
+class QueuedMessage(NamedTuple):
+    """A message waiting in the outbox"""
+
+    txn_id: str
+    user_id: str
+    room_id: str
+    kind: str
+    body: str
+    formatted_body: Optional[str]
+    attempts: int
+
+    @property
+    def content(self) -> Union[str, RenderedMessage]:
+        if self.formatted_body is not None:
+            return RenderedMessage(self.body, self.formatted_body)
+        return self.body
+
+
+class PersistentOutbox:
+    def __init__(
+        self,
+        chat: "ChatFunctions",
+        store: Storage,
+        batch_size: int = 50,
+        retry_delay: float = 5,
+        max_retry_delay: float = 600,
+        max_attempts: int = 10,
+        arrival_wait: float = 10,
+        shards: Optional["ShardCoordinator"] = None,
+        poll_interval: float = 5,
+    ):
+        """Stores messages to users in the database, and sends them in the background.
+
+        Queued messages survive crashes and restarts. A background task takes the due
+        messages from the database in batches, and sends the messages of each room in
+        the order they were queued, with the rooms sent to concurrently. Failed sends
+        are retried with an exponential backoff, holding back the later messages of
+        the room until they have been sent. Each message keeps its transaction
+        ID across attempts, so a message whose response was lost isn't sent twice.
+
+        Args:
+            chat: Chat functions used to send the messages.
+
+            store: The storage the messages are kept in.
+
+            batch_size: The maximum amount of messages taken from the database at once.
+
+            retry_delay: The amount of seconds to wait before the first retry of a
+                message. Doubled after each failed attempt.
+
+            max_retry_delay: The maximum amount of seconds between attempts.
+
+            max_attempts: The amount of attempts after which a message is dropped.
+
+            arrival_wait: The amount of seconds to wait for a new room to be synced,
+                before fetching its state instead.
+
+            shards: If set, only the messages of rooms in shards owned by this worker
+                are sent. Messages are queued with the shard of their room, whichever
+                worker queues them.
+
+            poll_interval: When sharded, the maximum amount of seconds to wait before
+                looking for messages queued by other workers.
+        """
+        self.chat = chat
+        self.store = store
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.arrival_wait = arrival_wait
+        self.shards = shards
+        self.poll_interval = poll_interval
+
+        # Rooms whose messages are being sent
+        self._sending = set()  # type: Set[str]
+        # Held while reading due messages, and while removing sent ones, so that
+        # messages that have just been sent aren't read again
+        self._lock = asyncio.Lock()
+        self._tasks = set()  # type: Set[asyncio.Task]
+        self._drain_task = None  # type: Optional[asyncio.Task]
+        # Set when there may be new messages to send
+        self._wakeup = asyncio.Event()
+        # Keeps queued_at increasing, so messages queued at once keep their order
+        self._last_queued_at = 0
+
+    def start(self) -> None:
+        """Start sending queued messages, including those left by a previous run"""
+        if self._drain_task is None:
+            self._drain_task = asyncio.get_event_loop().create_task(
+                self._drain_forever()
+            )
+
+    async def close(self) -> None:
+        """Stop sending messages. Unsent messages are sent on the next start"""
+        tasks = list(self._tasks)
+        if self._drain_task is not None:
+            tasks.append(self._drain_task)
+            self._drain_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def queue(
+        self,
+        user_id: str,
+        room_id: str,
+        content: Union[str, RenderedMessage],
+        is_image: bool = False,
+    ) -> None:
+        """Queue a message to be sent to a user
+
+        Args:
+            user_id: The user the message is for.
+
+            room_id: The DM room of the user. It doesn't need to have been synced yet.
+
+            content: The text to send, or the path of the image.
+
+            is_image: Whether the content is the path of an image.
+        """
+        if isinstance(content, RenderedMessage):
+            body, formatted_body = content.body, content.formatted_body
+        else:
+            body, formatted_body = content, None
+
+        queued_at = max(int(time.time() * 1000000), self._last_queued_at + 1)
+        self._last_queued_at = queued_at
+
+        await self.store.queue_message(
+            uuid.uuid4().hex,
+            user_id,
+            room_id,
+            "image" if is_image else "text",
+            body,
+            formatted_body,
+            queued_at,
+            self.shards.shard_of(room_id) if self.shards is not None else None,
+        )
+        metrics.outbox_messages.inc(event="queued")
+        self._wakeup.set()
+
+    async def drain(self) -> Optional[float]:
+        """Start sending the due messages of rooms that aren't being sent to already
+
+        Returns:
+            The amount of seconds until the next message is due, if any.
+        """
+        now = int(time.time() * 1000)
+        shards = sorted(self.shards.owned) if self.shards is not None else None
+        async with self._lock:
+            rows = await self.store.get_due_messages(now, self.batch_size, shards)
+
+            rooms = {}  # type: Dict[str, List[QueuedMessage]]
+            for row in rows:
+                message = QueuedMessage(*row)
+                if message.room_id not in self._sending:
+                    rooms.setdefault(message.room_id, []).append(message)
+
+            loop = asyncio.get_event_loop()
+            for room_id, messages in rooms.items():
+                self._sending.add(room_id)
+                task = loop.create_task(self._send_room(room_id, messages))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+        if len(rows) == self.batch_size:
+            # There may be more due messages
+            return 0 if rooms else None
+
+        next_attempt_at = await self.store.get_next_message_attempt(shards)
+        if self.shards is not None:
+            # Other workers don't wake this one up when they queue messages for it
+            if next_attempt_at is None:
+                return self.poll_interval
+            return min(self.poll_interval, max(0.0, (next_attempt_at - now) / 1000))
+        if next_attempt_at is None:
+            return None
+        return max(0.0, (next_attempt_at - now) / 1000)
+
+    async def _drain_forever(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                delay = await self.drain()
+            except Exception:
+                logger.exception("Failed to read the outbox")
+                delay = self.retry_delay
+
+            if delay == 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_room(self, room_id: str, messages: List[QueuedMessage]) -> None:
+        sent = []  # type: List[str]
+        failed = []  # type: List[QueuedMessage]
+        try:
+            if not await self._room_ready(room_id):
+                logger.warning(f"Room {room_id} is not available yet")
+                failed = messages[:1]
+            else:
+                for i, message in enumerate(messages):
+                    # Another worker may have taken over the room in the meantime. The
+                    # messages left are sent by that worker
+                    if self.shards is not None and not self.shards.owns(room_id):
+                        break
+
+                    response = await self.chat.send_msg(
+                        message.content,
+                        room_id,
+                        message.kind == "image",
+                        message.txn_id,
+                    )
+                    if response is None or isinstance(response, ErrorResponse):
+                        # The room's later messages are held back until this one
+                        # has been sent, keeping them in order
+                        failed = [message]
+                        break
+                    sent.append(message.txn_id)
+
+        except Exception:
+            logger.exception(f"Failed to send queued messages to room {room_id}")
+            failed = messages[len(sent) : len(sent) + 1]
+        finally:
+            async with self._lock:
+                try:
+                    await self.store.delete_messages(sent)
+                    metrics.outbox_messages.inc(len(sent), event="sent")
+                    await self._retry(failed)
+                except Exception:
+                    logger.exception(f"Failed to update the outbox of room {room_id}")
+                finally:
+                    self._sending.discard(room_id)
+            # The room may have more messages waiting
+            self._wakeup.set()
+
+    async def _room_ready(self, room_id: str) -> bool:
+        """Whether a room is known to the client, so that messages can be sent to it"""
+        if room_id in self.chat.client.rooms:
+            return True
+
+        # Rooms created by the bot are usable once synced. After a restart, a quiet
+        # room may not be synced at all, so its state is fetched instead
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(self.chat.room_arrivals.wait_for(room_id)),
+                self.arrival_wait,
+            )
+            return True
+        except asyncio.TimeoutError:
+            return await self.chat.room_state.load(room_id) is not None
+
+    async def _retry(self, messages: List[QueuedMessage]) -> None:
+        now = time.time()
+        retries = []  # type: List[Tuple[str, int, int]]
+        dropped = []  # type: List[str]
+        for message in messages:
+            attempts = message.attempts + 1
+            if attempts >= self.max_attempts:
+                logger.error(
+                    f"Dropping a message to {message.user_id} in room "
+                    f"{message.room_id} after {attempts} attempts"
+                )
+                dropped.append(message.txn_id)
+                continue
+
+            delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+            retries.append((message.txn_id, attempts, int((now + delay) * 1000)))
+
+        await self.store.retry_messages(retries)
+        await self.store.delete_messages(dropped)
+        metrics.outbox_messages.inc(len(retries), event="retried")
+        metrics.outbox_messages.inc(len(dropped), event="dropped")
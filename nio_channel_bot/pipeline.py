@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
+from nio_channel_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# A job is a coroutine function taking no arguments, e.g. a bound `Command.filter_channel`
+Job = Callable[[], Awaitable[Any]]
+
+
+class ModerationPipeline:
+    def __init__(self, workers: int = 4, max_queue_size: int = 100, burst: int = 10):
+        """Runs moderation jobs off the sync loop, using a queue per room.
+
+        Jobs of the same room are run one at a time, in the order they were submitted,
+        while jobs of different rooms are run concurrently by a pool of workers.
+
+        Args:
+            workers: The amount of rooms that can be moderated concurrently.
+
+            max_queue_size: The maximum amount of pending jobs per room. Submitting a
+                job to a full queue waits until there is space, which in turn holds up
+                the sync loop (backpressure).
+
+            burst: The maximum amount of jobs run for a room before a worker moves on
+                to the next room, so that a busy room can't starve the others.
+        """
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.burst = burst
+
+        # room_id -> pending jobs, with the time they were submitted at. Queues are
+        # removed once drained, so rooms that went quiet don't keep one around
+        self._queues = {}  # type: Dict[str, asyncio.Queue]
+        # room_id -> the amount of submissions waiting for space in its full queue
+        self._waiting = {}  # type: Dict[str, int]
+        # Room ids with pending jobs, waiting for a worker
+        self._ready = asyncio.Queue()  # type: asyncio.Queue
+        # Room ids that are either waiting for or being drained by a worker
+        self._scheduled = set()  # type: Set[str]
+        self._tasks = []  # type: List[asyncio.Task]
+
+        # Metrics
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        # The amount of submissions that had to wait for space in a full queue, and
+        # the total amount of seconds spent waiting
+        self.blocked = 0
+        self.blocked_seconds = 0.0
+        # The largest queue depth seen for any room
+        self.max_depth = 0
+
+    def start(self) -> None:
+        """Start the worker pool"""
+        loop = asyncio.get_event_loop()
+        while len(self._tasks) < self.workers:
+            self._tasks.append(loop.create_task(self._work()))
+
+    async def close(self, timeout: float = 10) -> None:
+        """Wait for pending jobs to finish, then stop the worker pool
+
+        Args:
+            timeout: The maximum amount of seconds to wait for pending jobs.
+        """
+        queues = [queue.join() for queue in self._queues.values()]
+        if queues and self._tasks:
+            try:
+                await asyncio.wait_for(asyncio.gather(*queues), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Stopping with {self.depth()} moderation jobs still pending"
+                )
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+        logger.info(f"Moderation pipeline stopped: {self.stats()}")
+
+    async def submit(self, room_id: str, job: Job) -> None:
+        """Queue a job to be run for a room
+
+        Args:
+            room_id: The room the job belongs to.
+
+            job: The coroutine function to run.
+        """
+        queue = self._queues.get(room_id)
+        if queue is None:
+            queue = self._queues[room_id] = asyncio.Queue(self.max_queue_size)
+
+        if queue.full():
+            logger.debug(f"Moderation queue of room {room_id} is full, waiting...")
+            self.blocked += 1
+            start = time.monotonic()
+            # The queue is kept while submissions wait for space in it
+            self._waiting[room_id] = self._waiting.get(room_id, 0) + 1
+            try:
+                await queue.put((job, time.monotonic()))
+            finally:
+                self._waiting[room_id] -= 1
+                if not self._waiting[room_id]:
+                    del self._waiting[room_id]
+            self.blocked_seconds += time.monotonic() - start
+        else:
+            queue.put_nowait((job, time.monotonic()))
+
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, queue.qsize())
+        metrics.queue_depth.inc()
+
+        if room_id not in self._scheduled:
+            self._scheduled.add(room_id)
+            self._ready.put_nowait(room_id)
+
+    def depth(self) -> int:
+        """The total amount of pending jobs over all rooms"""
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def stats(self) -> Dict[str, float]:
+        """Get the current queue and backpressure metrics"""
+        return {
+            "depth": self.depth(),
+            "rooms_pending": len(self._scheduled),
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "blocked_seconds": self.blocked_seconds,
+        }
+
+    async def _work(self) -> None:
+        while True:
+            room_id = await self._ready.get()
+            queue = self._queues[room_id]
+
+            try:
+                for _ in range(self.burst):
+                    if queue.empty():
+                        break
+
+                    job, submitted_at = queue.get_nowait()
+                    metrics.queue_depth.inc(-1)
+                    metrics.queue_seconds.observe(time.monotonic() - submitted_at)
+                    try:
+                        await job()
+                    except Exception:
+                        self.failed += 1
+                        logger.exception(f"Moderation job failed in room {room_id}")
+                    finally:
+                        self.processed += 1
+                        queue.task_done()
+            finally:
+                if queue.empty():
+                    self._scheduled.discard(room_id)
+                    if room_id not in self._waiting:
+                        del self._queues[room_id]
+                else:
+                    # Let other rooms have a turn before continuing with this one
+                    self._ready.put_nowait(room_id)
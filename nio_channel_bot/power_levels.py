@@ -0,0 +1,252 @@
+import asyncio
+import logging
+from itertools import chain
+from typing import Any, Dict, Optional, Tuple, Union
+
+from nio import (
+    AsyncClient,
+    ErrorResponse,
+    PowerLevelsEvent,
+    RoomGetStateEventError,
+    RoomPutStateError,
+    RoomPutStateResponse,
+    SyncResponse,
+)
+
+from nio_channel_bot.ratelimit import with_ratelimit
+
+logger = logging.getLogger(__name__)
+
+
+class PowerLevelCache:
+    def __init__(self, client: AsyncClient, batch_window: float = 0):
+        """A cache of the `m.room.power_levels` state of each room.
+
+        The content of the state event is kept from sync, so changing a user's power
+        level only requires a single PUT. It is only fetched from the homeserver if
+        the room's power levels have not been synced, or have changed since.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            batch_window: If above 0, the amount of seconds to collect power level
+                changes of the same room for, before sending them in a single update.
+        """
+        self.client = client
+        self.batch_window = batch_window
+
+        # room_id -> content of the latest m.room.power_levels event
+        self._content = {}  # type: Dict[str, Dict[str, Any]]
+        # room_id -> ID of the event the content was taken from, if known
+        self._versions = {}  # type: Dict[str, Optional[str]]
+        # room_id -> minimum power level -> the users with at least that level,
+        # derived from the cached content
+        self._moderators = {}  # type: Dict[str, Dict[int, Tuple[str, ...]]]
+
+        # Rooms whose cached content was sent by us, but hasn't come back through sync
+        self._unsynced = set()
+
+        # Updates of the same room are sent one at a time, each building on the last
+        self._locks = {}  # type: Dict[str, asyncio.Lock]
+
+        # room_id -> user_id -> power level, waiting to be sent in the next batch
+        self._pending = {}  # type: Dict[str, Dict[str, int]]
+        # room_id -> the result of the next batch
+        self._batches = {}  # type: Dict[str, asyncio.Future]
+
+    def update(self, room_id: str, content: Dict[str, Any], version: Optional[str]):
+        """Cache the content of a room's power levels
+
+        Args:
+            room_id: The room the power levels belong to.
+
+            content: The content of the `m.room.power_levels` state event.
+
+            version: The ID of the state event, if known.
+        """
+        self._content[room_id] = content
+        self._versions[room_id] = version
+        self._moderators.pop(room_id, None)
+
+    def invalidate(self, room_id: str) -> None:
+        """Forget the cached power levels of a room, so they are fetched on next use"""
+        self._content.pop(room_id, None)
+        self._versions.pop(room_id, None)
+        self._moderators.pop(room_id, None)
+        self._unsynced.discard(room_id)
+
+    async def on_sync(self, response: SyncResponse) -> None:
+        """Response callback caching the power levels of every synced room"""
+        for room_id, join_info in response.rooms.join.items():
+            for event in chain(join_info.state, join_info.timeline.events):
+                if isinstance(event, PowerLevelsEvent):
+                    # Our own updates come back through sync as well
+                    if self._versions.get(room_id) != event.event_id:
+                        self.update(room_id, event.source["content"], event.event_id)
+                    self._unsynced.discard(room_id)
+
+    async def get_content(
+        self, room_id: str
+    ) -> Union[Dict[str, Any], RoomGetStateEventError]:
+        """Get the content of a room's power levels, fetching it if it isn't cached"""
+        content = self._content.get(room_id)
+        if content is not None and not self._is_stale(room_id, content):
+            return content
+
+        logger.debug(f"Fetching power levels of room {room_id}")
+        response = await with_ratelimit(
+            self.client.room_get_state_event, endpoint="state"
+        )(room_id, "m.room.power_levels")
+        if isinstance(response, RoomGetStateEventError):
+            logger.error(f"Failed to fetch room {room_id} state: {response.message}")
+            return response
+
+        self.update(room_id, response.content, None)
+        return response.content
+
+    async def get_moderators(self, room_id: str, min_level: int) -> Tuple[str, ...]:
+        """Get the users of a room with at least a power level
+
+        The list is derived from the cached power levels once, and kept until they
+        change. Users who have left the room may be included.
+
+        Args:
+            room_id: The room to get the users of.
+
+            min_level: The minimum power level of the users, e.g. 100 for admins.
+
+        Returns:
+            The user IDs, from the highest power level to the lowest. Empty if the
+            power levels of the room couldn't be fetched.
+        """
+        content = await self.get_content(room_id)
+        if isinstance(content, ErrorResponse):
+            return ()
+
+        moderators = self._moderators.setdefault(room_id, {})
+        users = moderators.get(min_level)
+        if users is None:
+            levels = content.get("users", {})
+            users = moderators[min_level] = tuple(
+                sorted(
+                    (user for user, level in levels.items() if level >= min_level),
+                    key=lambda user: (-levels[user], user),
+                )
+            )
+        return users
+
+    async def set_user_power(
+        self, room_id: str, user_id: str, power: int
+    ) -> Union[RoomPutStateResponse, ErrorResponse]:
+        """Set the power level of a user in a room
+
+        If batching is enabled, the change is sent together with any others made to
+        the same room within the batch window.
+        """
+        logger.debug(f"Setting user power: {room_id}, user: {user_id}, level: {power}")
+        if self.batch_window <= 0:
+            return await self._put(room_id, {user_id: power})
+
+        self._pending.setdefault(room_id, {})[user_id] = power
+
+        batch = self._batches.get(room_id)
+        if batch is None:
+            loop = asyncio.get_event_loop()
+            batch = self._batches[room_id] = loop.create_future()
+            loop.create_task(self._send_batch(room_id, batch))
+
+        # Shield the batch, as it is shared with the other callers waiting for it
+        return await asyncio.shield(batch)
+
+    async def set_users_power(
+        self, room_id: str, users: Dict[str, int]
+    ) -> Union[RoomPutStateResponse, ErrorResponse]:
+        """Set the power levels of several users of a room in a single update
+
+        Args:
+            room_id: The room to set the power levels in.
+
+            users: user_id -> the new power level of the user.
+        """
+        logger.debug(f"Setting power levels of {len(users)} users in {room_id}")
+        return await self._put(room_id, users)
+
+    async def set_events_default(
+        self, room_id: str, level: int
+    ) -> Union[RoomPutStateResponse, ErrorResponse]:
+        """Set the power level users need to send messages in a room
+
+        Args:
+            room_id: The room to set the power level in.
+
+            level: The new `events_default` of the room.
+        """
+        logger.debug(f"Setting events_default of {room_id} to {level}")
+        return await self._put(room_id, {}, {"events_default": level})
+
+    async def _send_batch(self, room_id: str, batch: asyncio.Future) -> None:
+        await asyncio.sleep(self.batch_window)
+
+        users = self._pending.pop(room_id)
+        del self._batches[room_id]
+
+        if len(users) > 1:
+            logger.info(f"Sending {len(users)} power level changes to room {room_id}")
+        try:
+            batch.set_result(await self._put(room_id, users))
+        except Exception as e:
+            batch.set_exception(e)
+
+    async def _put(
+        self,
+        room_id: str,
+        users: Dict[str, int],
+        fields: Optional[Dict[str, Any]] = None,
+    ) -> Union[RoomPutStateResponse, ErrorResponse]:
+        lock = self._locks.get(room_id)
+        if lock is None:
+            lock = self._locks[room_id] = asyncio.Lock()
+
+        async with lock:
+            content = await self.get_content(room_id)
+            if isinstance(content, ErrorResponse):
+                return content
+
+            # Build the new content without touching the cached one, in case the
+            # update is rejected
+            new_content = dict(content)
+            new_content["users"] = {**content.get("users", {}), **users}
+            if fields:
+                new_content.update(fields)
+
+            try:
+                response = await with_ratelimit(
+                    self.client.room_put_state, endpoint="state"
+                )(
+                    room_id=room_id,
+                    event_type="m.room.power_levels",
+                    content=new_content,
+                )
+            except BaseException:
+                # The update may have been applied without the response arriving
+                self.invalidate(room_id)
+                raise
+            if isinstance(response, RoomPutStateResponse):
+                self.update(room_id, new_content, response.event_id)
+                self._unsynced.add(room_id)
+            elif isinstance(response, RoomPutStateError):
+                logger.warning(
+                    f"Failed to set power levels in {room_id}: {response.message}"
+                )
+                self.invalidate(room_id)
+            return response
+
+    def _is_stale(self, room_id: str, content: Dict[str, Any]) -> bool:
+        """Whether the cached content differs from the power levels nio has synced"""
+        room = self.client.rooms.get(room_id)
+        if room is None or room_id in self._unsynced:
+            # Either there is nothing synced to compare with, or our own update is
+            # newer than anything synced
+            return False
+
+        return room.power_levels.users != content.get("users", {})
@@ -0,0 +1,461 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from functools import partial
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from nio import (
+    AsyncClient,
+    ErrorResponse,
+    MatrixRoom,
+    RoomMessageText,
+    RoomPutStateResponse,
+    RoomRedactError,
+)
+
+from nio_channel_bot import metrics
+from nio_channel_bot.bot_commands import MODERATOR_POWER_LEVEL
+from nio_channel_bot.chat_functions import ChatFunctions
+from nio_channel_bot.pipeline import ModerationPipeline
+from nio_channel_bot.ratelimit import with_ratelimit
+from nio_channel_bot.sharding import ShardCoordinator
+from nio_channel_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Users are muted once they have more fails than this, as in `Command.filter_channel`
+MAX_FAILS = 3
+
+
+class RaidDetector:
+    def __init__(self, threshold: int = 20, window: float = 10, cooldown: float = 60):
+        """Detects rooms being flooded, from the rate of messages that need moderating.
+
+        A room is raided once `threshold` messages are recorded within `window` seconds,
+        and stays raided until that rate hasn't been reached for `cooldown` seconds.
+
+        Args:
+            threshold: The amount of messages that start a raid.
+
+            window: The amount of seconds the messages have to arrive within.
+
+            cooldown: The amount of seconds a raid lasts after the last time the
+                threshold was reached.
+        """
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+
+        # room_id -> the times of the last `threshold` messages
+        self._times = {}  # type: Dict[str, Deque[float]]
+        # room_id -> the time the raid of the room ends at
+        self._raided_until = {}  # type: Dict[str, float]
+
+    def record(self, room_id: str, now: Optional[float] = None) -> bool:
+        """Record a message of a room
+
+        Returns:
+            Whether the room is raided.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        times = self._times.get(room_id)
+        if times is None:
+            times = self._times[room_id] = deque(maxlen=self.threshold)
+        times.append(now)
+
+        # Only the oldest of the last `threshold` messages has to be within the window
+        if len(times) == self.threshold and now - times[0] < self.window:
+            self._raided_until[room_id] = now + self.cooldown
+
+        return self.is_raided(room_id, now)
+
+    def is_raided(self, room_id: str, now: Optional[float] = None) -> bool:
+        """Whether a room is raided"""
+        until = self._raided_until.get(room_id)
+        if until is None:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now < until
+
+    def ends_at(self, room_id: str) -> Optional[float]:
+        """The time the raid of a room ends at, unless the threshold is reached again"""
+        return self._raided_until.get(room_id)
+
+
+class BulkModerator:
+    def __init__(
+        self,
+        client: AsyncClient,
+        store: Storage,
+        chat: ChatFunctions,
+        batch_size: int = 20,
+    ):
+        """Moderates many messages of a room at once.
+
+        Messages are redacted `batch_size` at a time, the fail counters are updated
+        once per sender and the offending senders are muted in a single power levels
+        update. No warnings are sent to users.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            store: Bot storage.
+
+            chat: Chat functions used to communicate with rooms.
+
+            batch_size: The maximum amount of redactions requested at once. They are
+                still paced by the shared rate limiter.
+        """
+        self.client = client
+        self.store = store
+        self.chat = chat
+        self.batch_size = batch_size
+
+    async def redact_and_mute(
+        self, room: MatrixRoom, events: List[RoomMessageText], reason: str = "raided"
+    ) -> int:
+        """Redact messages of a room, and mute the senders over the fail limit
+
+        Redacted messages are recorded as processed, so that they are skipped if
+        delivered again.
+
+        Args:
+            room: The room the messages were sent in.
+
+            events: The messages to redact.
+
+            reason: Why the room is moderated in bulk, used in logs.
+
+        Returns:
+            The amount of messages redacted.
+        """
+        # Messages already moderated, e.g. before a restart, aren't redacted again
+        processed = self.store.processed
+        events = [
+            event for event in events if not processed.is_processed(event.event_id)
+        ]
+
+        redacted = set()  # type: Set[str]
+        try:
+            return await self._redact_and_mute(room, events, reason, redacted)
+        finally:
+            # Messages that couldn't be redacted are moderated again if redelivered
+            for event in events:
+                if event.event_id in redacted:
+                    processed.complete(event.event_id)
+                else:
+                    processed.release(event.event_id)
+
+    async def _redact_and_mute(
+        self,
+        room: MatrixRoom,
+        events: List[RoomMessageText],
+        reason: str,
+        redacted: Set[str],
+    ) -> int:
+        # The power levels of the room may not have been synced since the bot started
+        await self.chat.room_state.load(room.room_id)
+        if not room.power_levels.can_user_redact(self.client.user_id):
+            logger.error(
+                f"Bot does not have sufficient power to redact others in group: {room.name}"
+            )
+            return 0
+
+        # Moderators may have sent messages before the room's power levels were synced
+        events = [
+            event
+            for event in events
+            if room.power_levels.get_user_level(event.sender) < MODERATOR_POWER_LEVEL
+        ]
+
+        redact = with_ratelimit(self.client.room_redact, endpoint="redact")
+        fails = Counter()  # type: Counter
+        for start in range(0, len(events), self.batch_size):
+            batch = events[start : start + self.batch_size]
+            with metrics.redaction_seconds.time():
+                responses = await asyncio.gather(
+                    *(
+                        redact(
+                            room.room_id,
+                            event.event_id,
+                            "You are not a moderator of this channel.",
+                        )
+                        for event in batch
+                    )
+                )
+
+            for event, response in zip(batch, responses):
+                if isinstance(response, RoomRedactError):
+                    metrics.redactions.inc(result="error")
+                    logger.error(
+                        f"Failed to redact message in room {room.room_id} with id "
+                        f"{event.event_id} with error: {response.status_code}"
+                    )
+                else:
+                    metrics.redactions.inc(result="ok")
+                    fails[event.sender] += 1
+                    redacted.add(event.event_id)
+
+        logger.info(
+            f"Redacted {len(redacted)} messages of {len(fails)} users in {reason} room "
+            f"{room.room_id}"
+        )
+
+        # Count the fails of each sender at once, and mute everyone over the limit
+        # in a single update
+        muted = {}  # type: Dict[str, int]
+        for sender, count in fails.items():
+            if room.power_levels.get_user_level(sender) == -1:
+                # Already muted
+                continue
+
+            if (
+                await self.store.fails.increment(sender, room.room_id, count)
+                > MAX_FAILS
+            ):
+                await self.store.fails.reset(sender, room.room_id)
+                muted[sender] = -1
+
+        if not muted:
+            return len(redacted)
+
+        with metrics.mute_seconds.time():
+            response = await self.chat.power_levels.set_users_power(room.room_id, muted)
+        if isinstance(response, RoomPutStateResponse):
+            metrics.mutes.inc(len(muted), result="ok")
+            logger.info(f"Muted {len(muted)} users in {reason} room {room.name}")
+        else:
+            metrics.mutes.inc(len(muted), result="error")
+            logger.error(f"Error: Power level response: {response}")
+        return len(redacted)
+
+
+class RaidMode:
+    def __init__(
+        self,
+        client: AsyncClient,
+        store: Storage,
+        chat: ChatFunctions,
+        detector: RaidDetector,
+        pipeline: Optional[ModerationPipeline] = None,
+        batch_size: int = 20,
+        lockdown_level: Optional[int] = None,
+        shards: Optional[ShardCoordinator] = None,
+    ):
+        """Moderates raided rooms in bulk.
+
+        Messages of a raided room are collected instead of being moderated one by one.
+        A single moderation job then moderates every message collected by the time it
+        runs with a `BulkModerator`. No warnings are sent to users during a raid.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            store: Bot storage.
+
+            chat: Chat functions used to communicate with rooms.
+
+            detector: Decides which rooms are raided.
+
+            pipeline: The pipeline the moderation jobs are queued on. If not provided,
+                messages are moderated inline.
+
+            batch_size: The maximum amount of redactions requested at once. They are
+                still paced by the shared rate limiter.
+
+            lockdown_level: If set, the `events_default` power level of a room is
+                raised to this level for the duration of a raid, so that only users
+                with at least this level can send messages. Locked down rooms are
+                stored, so that the lockdowns left by a crash are lifted at the next
+                start.
+
+            shards: If set, batches of rooms taken over by another worker while they
+                were queued are left to that worker.
+        """
+        self.client = client
+        self.store = store
+        self.chat = chat
+        self.detector = detector
+        self.pipeline = pipeline
+        self.moderator = BulkModerator(client, store, chat, batch_size)
+        self.lockdown_level = lockdown_level
+        self.shards = shards
+
+        # room_id -> messages waiting to be moderated in the next batch
+        self._pending = {}  # type: Dict[str, List[RoomMessageText]]
+        # room_id -> the task ending the raid of the room once it has calmed down
+        self._raids = {}  # type: Dict[str, asyncio.Task]
+        # room_id -> the events_default of the room before it was locked down, and
+        # the level it was locked down with. Recorded before the room is locked down
+        self._locked = {}  # type: Dict[str, Tuple[int, int]]
+        self._restore_task = None  # type: Optional[asyncio.Task]
+
+    def record(self, room_id: str) -> bool:
+        """Record a message that needs moderating, starting a raid if the room is flooded
+
+        Returns:
+            Whether the room is raided, in which case the message should be moderated
+            by `moderate`.
+        """
+        if not self.detector.record(room_id):
+            return False
+
+        if room_id not in self._raids:
+            logger.warning(f"Room {room_id} is being raided, moderating it in bulk")
+            metrics.raids.inc(event="start")
+            metrics.raided_rooms.inc()
+            self._raids[room_id] = asyncio.get_event_loop().create_task(
+                self._run_raid(room_id)
+            )
+        return True
+
+    def is_raided(self, room_id: str) -> bool:
+        """Whether a room is in raid mode"""
+        return room_id in self._raids
+
+    async def moderate(self, room: MatrixRoom, event: RoomMessageText) -> None:
+        """Moderate a message of a raided room in the next batch of the room"""
+        pending = self._pending.get(room.room_id)
+        if pending is not None:
+            # A batch is already waiting to run
+            pending.append(event)
+            return
+
+        self._pending[room.room_id] = [event]
+        job = partial(self._moderate_batch, room)
+        if self.pipeline is not None:
+            await self.pipeline.submit(room.room_id, job)
+        else:
+            await job()
+
+    async def on_sync(self, response) -> None:
+        """Response callback lifting the lockdowns left by a previous run, once the
+        first sync is done"""
+        if self._restore_task is None and self.lockdown_level is not None:
+            self._restore_task = asyncio.get_event_loop().create_task(
+                self.lift_stale_lockdowns()
+            )
+
+    async def lift_stale_lockdowns(self) -> None:
+        """Lift the lockdowns of rooms left locked down by a previous run"""
+        for room_id, locked in (await self.store.get_raid_lockdowns()).items():
+            # Rooms raided again since the start are lifted when their raid ends,
+            # and the rooms of other workers by those workers
+            if room_id in self._raids or room_id in self._locked:
+                continue
+            if self.shards is not None and not self.shards.owns(room_id):
+                continue
+
+            logger.info(
+                f"Lifting the lockdown of room {room_id} left by a previous run"
+            )
+            self._locked[room_id] = locked
+            await self._lift_lockdown(room_id)
+
+    async def close(self) -> None:
+        """End all raids, lifting the lockdown of rooms"""
+        if self._restore_task is not None:
+            self._restore_task.cancel()
+            await asyncio.gather(self._restore_task, return_exceptions=True)
+
+        for room_id, task in list(self._raids.items()):
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await self._end_raid(room_id)
+
+        # Lockdowns whose lifting was interrupted or failed
+        for room_id in list(self._locked):
+            if room_id not in self._raids:
+                await self._lift_lockdown(room_id)
+
+    async def _run_raid(self, room_id: str) -> None:
+        if self.lockdown_level is not None:
+            await self._lock_down(room_id)
+
+        # The end of the raid moves back each time the threshold is reached again
+        while True:
+            delay = self.detector.ends_at(room_id) - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        await self._end_raid(room_id)
+
+    async def _end_raid(self, room_id: str) -> None:
+        if self._raids.pop(room_id, None) is None:
+            return
+
+        logger.info(f"Raid of room {room_id} is over")
+        metrics.raids.inc(event="end")
+        metrics.raided_rooms.inc(-1)
+
+        if room_id in self._locked:
+            await self._lift_lockdown(room_id)
+
+    async def _lock_down(self, room_id: str) -> None:
+        content = await self.chat.power_levels.get_content(room_id)
+        if isinstance(content, ErrorResponse):
+            return
+
+        previous = content.get("events_default", 0)
+        if previous >= self.lockdown_level:
+            return
+
+        # Recorded before the room is locked down, so that the lockdown is lifted
+        # even if the request is cancelled midway or the bot crashes
+        self._locked[room_id] = (previous, self.lockdown_level)
+        await self.store.set_raid_lockdown(room_id, previous, self.lockdown_level)
+
+        response = await self.chat.power_levels.set_events_default(
+            room_id, self.lockdown_level
+        )
+        if isinstance(response, RoomPutStateResponse):
+            metrics.raids.inc(event="lockdown")
+            logger.warning(
+                f"Locked down room {room_id}: only users with power level "
+                f"{self.lockdown_level} can send messages until the raid is over"
+            )
+        else:
+            logger.error(f"Failed to lock down room {room_id}: {response}")
+            del self._locked[room_id]
+            await self.store.delete_raid_lockdown(room_id)
+
+    async def _lift_lockdown(self, room_id: str) -> None:
+        previous, level = self._locked[room_id]
+
+        # The record is kept until the lockdown is lifted, so a failed attempt is
+        # retried when the bot stops, or at the next start
+        content = await self.chat.power_levels.get_content(room_id)
+        if isinstance(content, ErrorResponse):
+            return
+
+        # Leave the room as it is if a moderator has changed the level in the meantime,
+        # or if the room was never locked down
+        if content.get("events_default", 0) == level:
+            response = await self.chat.power_levels.set_events_default(
+                room_id, previous
+            )
+            if not isinstance(response, RoomPutStateResponse):
+                logger.error(
+                    f"Failed to lift the lockdown of room {room_id}: {response}"
+                )
+                return
+            logger.info(f"Lifted the lockdown of room {room_id}")
+
+        self._locked.pop(room_id, None)
+        await self.store.delete_raid_lockdown(room_id)
+
+    async def _moderate_batch(self, room: MatrixRoom) -> None:
+        events = self._pending.pop(room.room_id)
+        # Another worker may have taken over the room while the batch was queued
+        if self.shards is not None and not self.shards.owns(room.room_id):
+            for event in events:
+                self.store.processed.release(event.event_id)
+            return
+
+        with metrics.moderation_seconds.time():
+            await self.moderator.redact_and_mute(room, events)
@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import logging
+import time
+from typing import Dict, Optional
+
+from nio import ErrorResponse
+
+from nio_channel_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+# Requests per second and burst size of each class of endpoint, before anything has
+# been learnt from the homeserver's responses
+DEFAULT_LIMITS = {
+    "send": {"rate": 10, "burst": 20},
+    "redact": {"rate": 10, "burst": 20},
+    "state": {"rate": 2, "burst": 5},
+    "create_room": {"rate": 0.5, "burst": 3},
+}
+
+# Additional time to wait after the homeserver's requested retry delay, in seconds
+RETRY_DEADZONE = 0.05
+# Delay used when a rate limited response doesn't specify one, in milliseconds
+DEFAULT_RETRY_AFTER_MS = 5000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """Paces requests to a class of endpoints.
+
+        Each request takes a token. Tokens are refilled at `rate` per second, up to
+        `burst` tokens. When the homeserver rate limits a request, the bucket is paused
+        for the requested time and its rate is halved. Each successful request then
+        recovers part of the configured rate.
+
+        Args:
+            rate: The maximum amount of requests per second.
+
+            burst: The maximum amount of requests that can be made at once.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+        # Waiting requests take their tokens in the order they arrived
+        self._lock = asyncio.Lock()
+
+        # Metrics
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.rate_limited = 0
+
+    async def acquire(self) -> None:
+        """Wait until a request may be made"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    delay = (1 - self.tokens) / self.rate
+
+                self.waits += 1
+                self.wait_seconds += delay
+                await asyncio.sleep(delay)
+
+    def on_rate_limited(self, retry_after_ms: Optional[int]) -> None:
+        """Pause the bucket and slow it down after the homeserver rate limited a request
+
+        Args:
+            retry_after_ms: The amount of milliseconds the homeserver asked to wait.
+        """
+        self.rate_limited += 1
+
+        delay = (retry_after_ms or DEFAULT_RETRY_AFTER_MS) / 1000 + RETRY_DEADZONE
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+        # No tokens accumulate while the bucket is paused
+        self.tokens = 0
+        self.updated = self.paused_until
+
+        self.rate = max(self.rate / 2, self.max_rate / 100)
+
+    def on_success(self) -> None:
+        """Recover part of the configured rate after a successful request"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+
+class RateLimiter:
+    def __init__(self, limits: Optional[Dict[str, Dict[str, float]]] = None):
+        """A token bucket per class of endpoint, shared by every request of the bot.
+
+        Args:
+            limits: A mapping from endpoint class to a dictionary with its "rate" and
+                "burst". Defaults to `DEFAULT_LIMITS`.
+        """
+        self.buckets = {}  # type: Dict[str, TokenBucket]
+        self.configure(limits or DEFAULT_LIMITS)
+
+    def configure(self, limits: Dict[str, Dict[str, float]]) -> None:
+        """Set the limits of endpoint classes, replacing their buckets"""
+        for endpoint, limit in limits.items():
+            defaults = DEFAULT_LIMITS.get(endpoint, DEFAULT_LIMITS["send"])
+            self.buckets[endpoint] = TokenBucket(
+                limit.get("rate", defaults["rate"]),
+                limit.get("burst", defaults["burst"]),
+            )
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        """Get the bucket of an endpoint class"""
+        return self.buckets[endpoint]
+
+
+# The rate limiter shared by the whole process
+rate_limiter = RateLimiter()
+
+
+def with_ratelimit(func=None, *, endpoint: str = "send"):
+    """Wraps a request method so that it is paced by the shared rate limiter.
+
+    Requests that are rate limited by the homeserver anyway are retried after the
+    requested delay.
+
+    Can be used both as `@with_ratelimit` and `@with_ratelimit(endpoint="redact")`.
+
+    Args:
+        func: The coroutine function making the request.
+
+        endpoint: The class of endpoint the request is made to. One of "send",
+            "redact", "state" or "create_room".
+    """
+    if func is None:
+        return functools.partial(with_ratelimit, endpoint=endpoint)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        bucket = rate_limiter.bucket(endpoint)
+        while True:
+            with metrics.ratelimit_waits.time(endpoint=endpoint):
+                await bucket.acquire()
+
+            logger.debug(f"Executing function: {func.__name__}")
+            response = await func(*args, **kwargs)
+            if (
+                isinstance(response, ErrorResponse)
+                and response.status_code == "M_LIMIT_EXCEEDED"
+            ):
+                logger.debug(
+                    f"Rate limited on '{endpoint}', retrying in {response.retry_after_ms}ms"
+                )
+                bucket.on_rate_limited(response.retry_after_ms)
+                metrics.ratelimit_hits.inc(endpoint=endpoint)
+            else:
+                bucket.on_success()
+                return response
+
+    return wrapper
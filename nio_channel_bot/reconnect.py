@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import random
+from typing import Callable
+
+from nio_channel_bot import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ReconnectBackoff:
+    def __init__(
+        self,
+        base_delay: float = 1,
+        max_delay: float = 60,
+        failure_threshold: int = 10,
+        cooldown: float = 300,
+        rng: Callable[[], float] = random.random,
+    ):
+        """Decides how long to wait before reconnecting to the homeserver.
+
+        The delay doubles with every consecutive failure, up to `max_delay`. Half of
+        each delay is random (jitter), so that bots that lost their connection at the
+        same time don't all reconnect at the same time.
+
+        After `failure_threshold` consecutive failures the circuit breaker opens, and
+        the homeserver is only tried once every `cooldown` seconds until a sync
+        succeeds again.
+
+        Args:
+            base_delay: The delay after the first failure, in seconds.
+
+            max_delay: The maximum delay while the circuit breaker is closed, in seconds.
+
+            failure_threshold: The amount of consecutive failures that opens the
+                circuit breaker.
+
+            cooldown: The delay between attempts while the circuit breaker is open, in
+                seconds.
+
+            rng: Returns a random number in [0, 1). Used for the jitter.
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.rng = rng
+
+        # The amount of failures since the last successful sync
+        self.failures = 0
+
+    @property
+    def is_open(self) -> bool:
+        """Whether the circuit breaker is open"""
+        return self.failures >= self.failure_threshold
+
+    def on_failure(self) -> float:
+        """Record a failed connection attempt
+
+        Returns:
+            The amount of seconds to wait before the next attempt.
+        """
+        self.failures += 1
+        metrics.reconnects.inc()
+
+        if self.is_open:
+            if self.failures == self.failure_threshold:
+                logger.warning(
+                    f"{self.failures} connection attempts failed in a row, only "
+                    f"retrying every {self.cooldown}s until the homeserver is back"
+                )
+            delay = self.cooldown
+        else:
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+
+        return delay / 2 + self.rng() * delay / 2
+
+    def on_success(self) -> None:
+        """Record a successful sync, closing the circuit breaker"""
+        if self.failures:
+            logger.info(f"Reconnected after {self.failures} failed attempts")
+        self.failures = 0
+
+    async def wait(self) -> None:
+        """Record a failed connection attempt, and wait before the next one"""
+        delay = self.on_failure()
+        logger.warning(f"Unable to connect to homeserver, retrying in {delay:.1f}s...")
+        # Sleep without blocking the event loop, so queued work keeps running
+        await asyncio.sleep(delay)
+
+    async def on_sync(self, response) -> None:
+        """Response callback resetting the backoff once a sync succeeds"""
+        self.on_success()
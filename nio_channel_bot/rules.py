@@ -0,0 +1,347 @@
+import logging
+import re
+from itertools import chain
+from typing import Any, Dict, Iterable, List, Optional, Pattern, Set, Tuple, Union
+
+from nio import (
+    RoomEncryptedMedia,
+    RoomMessageMedia,
+    RoomMessageText,
+    SyncResponse,
+    UnknownEvent,
+)
+
+from nio_channel_bot import metrics
+from nio_channel_bot.errors import ConfigError
+from nio_channel_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# The type of the state event moderators set the content rules of a room with
+RULES_EVENT_TYPE = "nio_channel_bot.rules"
+
+# The messages that rules are evaluated on, besides text messages
+MEDIA_EVENTS = (RoomMessageMedia, RoomEncryptedMedia)
+RuledEvent = Union[RoomMessageText, RoomMessageMedia, RoomEncryptedMedia]
+
+RULE_KEYS = {"keywords", "patterns", "max_links", "max_mentions", "blocked_media"}
+
+WORD_RE = re.compile(r"\w+")
+LINK_RE = re.compile(r"https?://", re.IGNORECASE)
+MENTION_RE = re.compile(r"@[a-z0-9._=/+-]+:[a-z0-9.-]+(?::\d+)?", re.IGNORECASE)
+
+
+def _keyword_pattern(keywords: Iterable[str]) -> str:
+    """Build a regex matching any of the keywords, shaped like the trie of keywords.
+
+    Every alternative shares its prefix with the others, so the regex engine only
+    follows the branch of the next character, however many keywords there are.
+    """
+    trie = {}  # type: Dict[str, Any]
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        # Marks the end of a keyword
+        node[""] = {}
+
+    def build(node: Dict[str, Any]) -> str:
+        branches = [
+            re.escape(char) + build(child)
+            for char, child in sorted(node.items())
+            if char
+        ]
+        if not branches:
+            return ""
+
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if "" in node:
+            # A keyword ends here, and longer ones carry on
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    return build(trie)
+
+
+class CompiledRules:
+    def __init__(self, rules: Dict[str, Any]):
+        """A rule set, compiled once into the matchers every message is checked with.
+
+        Single word keywords are kept in a set that each word of a message is looked
+        up in. Other keywords are merged into a single trie-shaped regex, and all the
+        patterns into another, so that a message is scanned once per kind of rule
+        rather than once per rule.
+
+        Args:
+            rules: The rule set, with any of the keys:
+                keywords: Words or phrases that aren't allowed, ignoring case.
+                patterns: Regular expressions that messages can't match, ignoring case.
+                max_links: The maximum amount of links in a message.
+                max_mentions: The maximum amount of users mentioned in a message.
+                blocked_media: The media that can't be sent, either by msgtype (e.g.
+                    "m.video") or by mimetype (e.g. "image/gif" or "image/*").
+
+        Raises:
+            ConfigError: If the rule set is invalid.
+        """
+        if not isinstance(rules, dict):
+            raise ConfigError("A rule set must be a mapping")
+        unknown = set(rules) - RULE_KEYS
+        if unknown:
+            raise ConfigError(
+                f"Unknown rules {', '.join(sorted(unknown))}, expected any of: "
+                f"{', '.join(sorted(RULE_KEYS))}"
+            )
+
+        keywords = {keyword.casefold() for keyword in self._strings(rules, "keywords")}
+        # Single word keywords are looked up word by word in a set
+        self.words = frozenset(
+            keyword for keyword in keywords if WORD_RE.fullmatch(keyword)
+        )
+        # Phrases, and keywords with other characters, are merged into a regex
+        phrases = keywords - self.words
+        self.phrases = None  # type: Optional[Pattern]
+        if phrases:
+            # Keywords only match whole words
+            self.phrases = re.compile(
+                rf"(?<!\w){_keyword_pattern(phrases)}(?!\w)", re.IGNORECASE
+            )
+
+        patterns = self._strings(rules, "patterns")
+        self.patterns = None  # type: Optional[Pattern]
+        if patterns:
+            for pattern in patterns:
+                try:
+                    re.compile(f"(?:{pattern})")
+                except re.error as e:
+                    raise ConfigError(f"Invalid pattern '{pattern}': {e}")
+            self.patterns = re.compile(
+                "|".join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE
+            )
+
+        self.max_links = self._limit(rules, "max_links")
+        self.max_mentions = self._limit(rules, "max_mentions")
+
+        self.blocked_msgtypes = set()  # type: Set[str]
+        self.blocked_mimetypes = set()  # type: Set[str]
+        # Major types of mimetypes blocked with a wildcard, e.g. "image" for "image/*"
+        self.blocked_major_types = set()  # type: Set[str]
+        for media in self._strings(rules, "blocked_media"):
+            if media.startswith("m."):
+                self.blocked_msgtypes.add(media)
+            elif media.endswith("/*"):
+                self.blocked_major_types.add(media[:-2].lower())
+            else:
+                self.blocked_mimetypes.add(media.lower())
+
+        self.empty = not (
+            self.words
+            or self.phrases
+            or self.patterns
+            or self.max_links is not None
+            or self.max_mentions is not None
+            or self.blocked_msgtypes
+            or self.blocked_mimetypes
+            or self.blocked_major_types
+        )
+
+    @staticmethod
+    def _strings(rules: Dict[str, Any], key: str) -> List[str]:
+        values = rules.get(key, [])
+        if not isinstance(values, list) or not all(
+            isinstance(value, str) and value for value in values
+        ):
+            raise ConfigError(f"{key} must be a list of non-empty strings")
+        return values
+
+    @staticmethod
+    def _limit(rules: Dict[str, Any], key: str) -> Optional[int]:
+        value = rules.get(key)
+        if value is not None and (
+            not isinstance(value, int) or isinstance(value, bool) or value < 0
+        ):
+            raise ConfigError(f"{key} must be a non-negative integer")
+        return value
+
+    def check(self, event: RuledEvent) -> Optional[str]:
+        """Find the rule a message breaks
+
+        Args:
+            event: The message to check.
+
+        Returns:
+            The name of the first rule the message breaks, or None if it breaks none.
+        """
+        content = event.source.get("content", {})
+
+        if isinstance(event, MEDIA_EVENTS) and self._is_blocked_media(content):
+            return "blocked_media"
+
+        body = content.get("body")
+        if not isinstance(body, str):
+            return None
+
+        if self.words and not self.words.isdisjoint(WORD_RE.findall(body.casefold())):
+            return "keywords"
+
+        if self.phrases is not None and self.phrases.search(body):
+            return "keywords"
+
+        if self.patterns is not None and self.patterns.search(body):
+            return "patterns"
+
+        if self.max_links is not None and len(LINK_RE.findall(body)) > self.max_links:
+            return "max_links"
+
+        if self.max_mentions is not None:
+            mentions = content.get("m.mentions")
+            if isinstance(mentions, dict):
+                mentions = mentions.get("user_ids")
+            if not isinstance(mentions, list):
+                mentions = MENTION_RE.findall(body)
+            users = {user for user in mentions if isinstance(user, str)}
+            if len(users) > self.max_mentions:
+                return "max_mentions"
+
+        return None
+
+    def _is_blocked_media(self, content: Dict[str, Any]) -> bool:
+        if content.get("msgtype") in self.blocked_msgtypes:
+            return True
+
+        info = content.get("info")
+        mimetype = info.get("mimetype") if isinstance(info, dict) else None
+        if not isinstance(mimetype, str):
+            return False
+        mimetype = mimetype.lower()
+        return (
+            mimetype in self.blocked_mimetypes
+            or mimetype.split("/", 1)[0] in self.blocked_major_types
+        )
+
+
+class RuleEngine:
+    def __init__(
+        self,
+        store: Storage,
+        default: Optional[Dict[str, Any]] = None,
+        rooms: Optional[Dict[str, Dict[str, Any]]] = None,
+        state_events: bool = True,
+    ):
+        """The content rules of each room.
+
+        The rules of a room are taken from the `nio_channel_bot.rules` state event of
+        the room if there is one, from the configured rules of the room otherwise, and
+        from the default rules if neither is set. Each rule set is compiled the first
+        time a message of the room is checked, and kept until the room's state event
+        changes.
+
+        Args:
+            store: The storage the rules set in rooms are kept in, as rooms synced
+                from a stored sync token don't come with their full state.
+
+            default: The rules of rooms without rules of their own.
+
+            rooms: A mapping from room ID to the rules of the room.
+
+            state_events: Whether moderators can set the rules of a room with a state
+                event, overriding the configured ones.
+
+        Raises:
+            ConfigError: If any of the configured rules are invalid.
+        """
+        self.store = store
+        self.state_events = state_events
+
+        self._default = CompiledRules(default or {})
+        self._configured = {
+            room_id: CompiledRules(rules) for room_id, rules in (rooms or {}).items()
+        }  # type: Dict[str, CompiledRules]
+
+        # room_id -> (event_id, content) of the rules set with a state event
+        self._state = {}  # type: Dict[str, Tuple[str, Dict[str, Any]]]
+        # room_id -> the compiled rules of the room, None if the room has no rules
+        self._compiled = {}  # type: Dict[str, Optional[CompiledRules]]
+
+    async def load(self) -> None:
+        """Load the rules set in rooms by previous runs"""
+        if self.state_events:
+            self._state = await self.store.get_room_rules()
+
+    def rules_for(self, room_id: str) -> Optional[CompiledRules]:
+        """Get the compiled rules of a room, compiling them if they aren't cached
+
+        Returns:
+            The rules, or None if the room has no rules.
+        """
+        try:
+            return self._compiled[room_id]
+        except KeyError:
+            pass
+
+        rules = None  # type: Optional[CompiledRules]
+        state = self._state.get(room_id)
+        if state is not None:
+            try:
+                with metrics.rules_compile_seconds.time():
+                    rules = CompiledRules(state[1])
+            except ConfigError as e:
+                logger.warning(f"Ignoring invalid rules of room {room_id}: {e}")
+
+        if rules is None:
+            rules = self._configured.get(room_id, self._default)
+
+        compiled = self._compiled[room_id] = None if rules.empty else rules
+        return compiled
+
+    def check(self, room_id: str, event: RuledEvent) -> Optional[str]:
+        """Find the rule a message breaks
+
+        Args:
+            room_id: The room the message was sent in.
+
+            event: The message to check.
+
+        Returns:
+            The name of the first rule the message breaks, or None if it breaks none.
+        """
+        rules = self.rules_for(room_id)
+        if rules is None:
+            return None
+        return rules.check(event)
+
+    async def set_rules(
+        self, room_id: str, event_id: str, content: Dict[str, Any]
+    ) -> None:
+        """Replace the rules set in a room with the content of a new state event
+
+        The rules are recompiled the next time a message of the room is checked. An
+        empty state event removes the rules set in the room.
+        """
+        if self._state.get(room_id, (None,))[0] == event_id:
+            return
+
+        if content:
+            self._state[room_id] = (event_id, content)
+            await self.store.set_room_rules(room_id, event_id, content)
+        else:
+            self._state.pop(room_id, None)
+            await self.store.delete_room_rules(room_id)
+        self._compiled.pop(room_id, None)
+        logger.info(f"Rules of room {room_id} changed")
+
+    async def on_sync(self, response: SyncResponse) -> None:
+        """Response callback picking up the rules set in every synced room"""
+        if not self.state_events:
+            return
+
+        for room_id, join_info in response.rooms.join.items():
+            for event in chain(join_info.state, join_info.timeline.events):
+                if (
+                    isinstance(event, UnknownEvent)
+                    and event.type == RULES_EVENT_TYPE
+                    and event.source.get("state_key") == ""
+                ):
+                    await self.set_rules(
+                        room_id, event.event_id, event.source.get("content", {})
+                    )
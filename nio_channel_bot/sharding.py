@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import logging
+import time
+from functools import lru_cache
+from typing import FrozenSet, List, Optional, Set
+
+from nio_channel_bot import metrics
+from nio_channel_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+
+@lru_cache(maxsize=65536)
+def shard_of(room_id: str, shards: int) -> int:
+    """Get the shard a room belongs to"""
+    return _hash(room_id) % shards
+
+
+def preferred_worker(shard: int, workers: List[str]) -> str:
+    """Choose the worker a shard should be owned by, among the live workers.
+
+    Uses rendezvous hashing, so that only the shards of a worker that joins or leaves
+    move to another worker.
+    """
+    return max(workers, key=lambda worker_id: _hash(f"{worker_id}:{shard}"))
+
+
+class ShardCoordinator:
+    def __init__(
+        self,
+        store: Storage,
+        worker_id: str,
+        shards: int = 64,
+        lease_seconds: float = 30,
+        safety_margin: Optional[float] = None,
+    ):
+        """Splits the rooms of the bot between several bot processes sharing a database.
+
+        Rooms are hashed into a fixed amount of shards. Each worker heartbeats into
+        the database, and holds a lease on the shards it should own among the live
+        workers. Leases are renewed every third of `lease_seconds`, so the shards of a
+        worker that dies are taken over by the others once its leases expire. A shard
+        is only given up by its owner, or taken over once its lease has expired.
+
+        A worker that fails to renew its leases in time, e.g. because its event loop
+        was blocked, stops handling the rooms of its shards `safety_margin` seconds
+        before the leases expire by its own clock, so that two workers don't handle a
+        room at once.
+
+        Only the handling of events is split. Every worker still syncs and decrypts
+        the events of every room, as it has to see invites and the DM rooms of users.
+
+        Args:
+            store: The storage shared by every worker.
+
+            worker_id: The unique ID of this worker.
+
+            shards: The amount of shards the rooms are split into. Must be the same for
+                every worker.
+
+            lease_seconds: The amount of seconds a lease lasts without being renewed.
+
+            safety_margin: The amount of seconds before its leases expire that a
+                worker stops handling rooms, covering clock drift between workers.
+                Defaults to a sixth of `lease_seconds`.
+        """
+        self.store = store
+        self.worker_id = worker_id
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.safety_margin = (
+            safety_margin if safety_margin is not None else lease_seconds / 6
+        )
+
+        # The shards this worker holds a lease on
+        self.owned = frozenset()  # type: FrozenSet[int]
+        # The monotonic time until which the leases are safe to rely on
+        self._valid_until = 0.0
+        self._task = None  # type: Optional[asyncio.Task]
+
+    def owns(self, room_id: str) -> bool:
+        """Whether this worker moderates a room
+
+        Checked again when work for the room is done, as the leases of this worker may
+        have expired since the work was queued.
+        """
+        return (
+            time.monotonic() < self._valid_until
+            and shard_of(room_id, self.shards) in self.owned
+        )
+
+    def shard_of(self, room_id: str) -> int:
+        """Get the shard a room belongs to"""
+        return shard_of(room_id, self.shards)
+
+    def start(self) -> None:
+        """Start renewing leases and rebalancing shards in the background"""
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._rebalance_forever())
+
+    async def close(self) -> None:
+        """Stop rebalancing, and hand the shards of this worker over to the others"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        owned = self.owned
+        self.owned = frozenset()
+        await self._lose(owned)
+        metrics.owned_shards.set(0)
+        await self.store.delete_worker(self.worker_id)
+
+    async def rebalance(self) -> None:
+        """Renew this worker's leases, giving up and taking over shards as needed"""
+        # The leases are only relied on until they expire by the local clock, counted
+        # from before they were renewed
+        started = time.monotonic()
+        now = int(time.time() * 1000)
+        expires_at = now + int(self.lease_seconds * 1000)
+        await self.store.heartbeat_worker(self.worker_id, expires_at)
+
+        workers = await self.store.get_live_workers(now)
+        if self.worker_id not in workers:
+            workers.append(self.worker_id)
+        desired = {
+            shard
+            for shard in range(self.shards)
+            if preferred_worker(shard, workers) == self.worker_id
+        }
+
+        # Shards are given up first, so that their new owner can take them right away
+        released = self.owned - desired
+        if released:
+            self.owned -= released
+            await self._lose(released)
+            await self.store.release_shards(self.worker_id, released)
+
+        # Renews the leases held by this worker, and takes over released or expired ones
+        await self.store.claim_shards(self.worker_id, desired, expires_at, now)
+        owned = frozenset(await self.store.get_owned_shards(self.worker_id, now))
+
+        lost = self.owned - owned
+        gained = owned - self.owned
+        self.owned = owned
+        self._valid_until = started + self.lease_seconds - self.safety_margin
+        if lost:
+            # Leases that expired before they could be renewed may have been taken over
+            await self._lose(lost)
+        metrics.owned_shards.set(len(owned))
+
+        if gained or released or lost:
+            metrics.shard_changes.inc(len(gained), event="gained")
+            metrics.shard_changes.inc(len(released | lost), event="lost")
+            logger.info(
+                f"Worker {self.worker_id} owns {len(owned)}/{self.shards} shards "
+                f"({len(gained)} gained, {len(released | lost)} lost) "
+                f"among {len(workers)} workers"
+            )
+
+    async def _lose(self, shards: Set[int]) -> None:
+        # Write out the fail counters of the rooms, so that their new owner reads them
+        fails = self.store.fails
+        await fails.flush()
+        fails.evict(lambda room_id: shard_of(room_id, self.shards) in shards)
+
+    async def _rebalance_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.rebalance()
+            except Exception:
+                logger.exception("Failed to renew shard leases")
@@ -1,5 +1,13 @@
+import asyncio
+import json
 import logging
-from typing import Any, Dict
+import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from nio_channel_bot import metrics
 
 # The latest migration version of the database.
 #
@@ -8,69 +16,147 @@ from typing import Any, Dict
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-latest_migration_version = 1
+latest_migration_version = 11
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=256)
+def _to_postgres_placeholders(query: str) -> str:
+    """Transforms a query using ?'s as placeholders into one using asyncpg's $1, $2, ...
+
+    Results are cached, as the bot only ever issues a small, fixed set of queries.
+    """
+    counter = iter(range(1, query.count("?") + 1))
+    return re.sub(r"\?", lambda _: f"${next(counter)}", query)
+
+
+def _shard_condition(shards: Optional[Sequence[int]]) -> str:
+    """Build a condition limiting a query to rows in the given shards, if any"""
+    if shards is None:
+        return ""
+    if not shards:
+        return " AND 1 = 0"
+    return f" AND shard IN ({', '.join('?' * len(shards))})"
+
+
 class Storage:
-    def __init__(self, database_config: Dict[str, str]):
-        """Setup the database.
+    def __init__(self, database_config: Dict[str, Any]):
+        """Setup the database configuration.
+
+        No connection is made until `connect` is awaited, which runs an initial setup or
+        migrations depending on whether a database has already been created.
 
-        Runs an initial setup or migrations depending on whether a database file has already
-        been created.
+        All queries are non-blocking: SQLite is accessed through aiosqlite, which runs a
+        single connection on its own thread that acts as the dedicated writer, while
+        Postgres is accessed through an asyncpg connection pool.
 
         Args:
             database_config: a dictionary containing the following keys:
                 * type: A string, one of "sqlite" or "postgres".
                 * connection_string: A string, featuring a connection string that
                     be fed to each respective db library's `connect` method.
+                * pool_size: An optional integer, the maximum amount of connections
+                    kept in the Postgres connection pool.
+                * fail_cache_size: An optional integer, the maximum amount of fail
+                    counters kept in memory.
+                * fail_flush_interval: An optional number, the amount of seconds
+                    between writes of changed fail counters to the database.
+                * processed_cache_size: An optional integer, the maximum amount of
+                    processed event IDs kept in memory.
+                * processed_flush_interval: An optional number, the amount of
+                    seconds between writes of processed event IDs to the database.
+                * processed_retention: An optional number, the amount of seconds
+                    processed event IDs are kept in the database for.
         """
-        self.conn = self._get_database_connection(
-            database_config["type"], database_config["connection_string"]
-        )
-        self.cursor = self.conn.cursor()
         self.db_type = database_config["type"]
+        self.connection_string = database_config["connection_string"]
+        self.pool_size = database_config.get("pool_size", 10)
+
+        # The aiosqlite connection, when using SQLite
+        self.conn = None
+        # The asyncpg connection pool, when using Postgres
+        self.pool = None
+
+        # SQLite only supports one writer at a time. Serialise write statements so that
+        # concurrent callers can't interleave statements into each other's transactions
+        self._write_lock = asyncio.Lock()
+
+        # Write-behind cache in front of the `fails` table
+        self.fails = FailCounterCache(
+            self,
+            max_size=database_config.get("fail_cache_size", 10000),
+            flush_interval=database_config.get("fail_flush_interval", 5),
+        )
+        # Recently processed events, checkpointed to the `processed_events` table
+        self.processed = ProcessedEventCache(
+            self,
+            max_size=database_config.get("processed_cache_size", 10000),
+            flush_interval=database_config.get("processed_flush_interval", 5),
+            retention=database_config.get("processed_retention", 86400),
+        )
+
+    async def connect(self) -> None:
+        """Connect to the database and bring its schema up to date"""
+        await self._open_database_connection()
 
         # Try to check the current migration version
         migration_level = 0
         try:
-            self._execute("SELECT version FROM migration_version")
-            row = self.cursor.fetchone()
+            row = await self._fetchone("SELECT version FROM migration_version")
             migration_level = row[0]
         except Exception:
-            self._initial_setup()
+            await self._initial_setup()
         finally:
             if migration_level < latest_migration_version:
-                self._run_migrations(migration_level)
+                await self._run_migrations(migration_level)
 
         logger.info(f"Database initialization of type '{self.db_type}' complete")
 
-    def _get_database_connection(
-        self, database_type: str, connection_string: str
-    ) -> Any:
-        """Creates and returns a connection to the database"""
-        if database_type == "sqlite":
-            import sqlite3
+        self.fails.start()
+        await self.processed.load()
+        self.processed.start()
 
-            # Initialize a connection to the database, with autocommit on
-            return sqlite3.connect(connection_string, isolation_level=None)
-        elif database_type == "postgres":
-            import psycopg2
+    async def close(self) -> None:
+        """Write out any cached data and close the connection to the database"""
+        await self.fails.close()
+        await self.processed.close()
 
-            conn = psycopg2.connect(connection_string)
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
 
-            # Autocommit on
-            conn.set_isolation_level(0)
+    async def _open_database_connection(self) -> None:
+        """Opens the connection (or connection pool) to the database"""
+        if self.db_type == "sqlite":
+            import aiosqlite
 
-            return conn
+            # Initialize a connection to the database, with autocommit on
+            self.conn = await aiosqlite.connect(
+                self.connection_string, isolation_level=None
+            )
+
+            # Write-ahead logging lets readers continue while the writer commits, and
+            # only requires an fsync on checkpoints rather than on every commit
+            await self.conn.execute("PRAGMA journal_mode=WAL")
+            await self.conn.execute("PRAGMA synchronous=NORMAL")
+        elif self.db_type == "postgres":
+            import asyncpg
+
+            # asyncpg connections are in autocommit mode unless a transaction is started
+            self.pool = await asyncpg.create_pool(
+                self.connection_string, min_size=1, max_size=self.pool_size
+            )
 
-    def _initial_setup(self) -> None:
+    async def _initial_setup(self) -> None:
         """Initial setup of the database"""
         logger.info("Performing initial database setup...")
 
         # Set up the migration_version table
-        self._execute(
+        await self._execute(
             """
             CREATE TABLE migration_version (
                 version INTEGER PRIMARY KEY
@@ -79,7 +165,7 @@ class Storage:
         )
 
         # Initially set the migration version to 0
-        self._execute(
+        await self._execute(
             """
             INSERT INTO migration_version (
                 version
@@ -89,7 +175,7 @@ class Storage:
         )
 
         # Set up the improperly sent message table
-        self._execute(
+        await self._execute(
             """
             CREATE TABLE fails (
                 user_id TEXT NOT NULL,
@@ -100,7 +186,7 @@ class Storage:
         )
 
         # Create a unique index on room_id, user_id
-        self._execute(
+        await self._execute(
             """
             CREATE UNIQUE INDEX fail_id
             ON fails(user_id, room_id)
@@ -111,7 +197,7 @@ class Storage:
 
         logger.info("Database setup complete")
 
-    def _run_migrations(self, current_migration_version: int) -> None:
+    async def _run_migrations(self, current_migration_version: int) -> None:
         """Execute database migrations. Migrates the database to the
         `latest_migration_version`.
 
@@ -123,83 +209,836 @@ class Storage:
 
         if current_migration_version < 1:
             logger.info("Migrating the database from v0 to v1...")
-        
+
             # Add new table, delete old ones, etc.
             # Add table for storing uploaded media file uris, so we don't have to reupload them to the server each time
-            self._execute(
-            """
+            await self._execute(
+                """
             CREATE TABLE static_media_uris (
                 filename TEXT UNIQUE NOT NULL,
                 uri TEXT NOT NULL
             )
             """
-        )
+            )
             # Update the stored migration version
-            self._execute("UPDATE migration_version SET version = 1")
-        
+            await self._execute("UPDATE migration_version SET version = 1")
+
             logger.info("Database migrated to v1")
 
-    def _execute(self, *args) -> None:
-        """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres.
+        if current_migration_version < 2:
+            logger.info("Migrating the database from v1 to v2...")
+
+            # Add table for remembering the DM room created/found for each user, so DM
+            # rooms don't have to be rediscovered (or recreated) after a restart
+            await self._execute(
+                """
+            CREATE TABLE dm_rooms (
+                user_id TEXT PRIMARY KEY,
+                room_id TEXT NOT NULL,
+                created_at BIGINT NOT NULL
+            )
+            """
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 2")
+
+            logger.info("Database migrated to v2")
+
+        if current_migration_version < 3:
+            logger.info("Migrating the database from v2 to v3...")
+
+            # Remember the hash of each uploaded file, so that a file that has changed
+            # is uploaded again. Existing rows have no hash and are uploaded once more
+            await self._execute(
+                "ALTER TABLE static_media_uris ADD COLUMN content_hash TEXT"
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 3")
+
+            logger.info("Database migrated to v3")
+
+        if current_migration_version < 4:
+            logger.info("Migrating the database from v3 to v4...")
+
+            # Add table for remembering the IDs of uploaded sync filters, so they
+            # don't have to be uploaded again on every start
+            await self._execute(
+                """
+            CREATE TABLE sync_filters (
+                user_id TEXT NOT NULL,
+                filter_hash TEXT NOT NULL,
+                filter_id TEXT NOT NULL,
+                PRIMARY KEY (user_id, filter_hash)
+            )
+            """
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 4")
+
+            logger.info("Database migrated to v4")
 
-        This allows for the support of queries that are compatible with both postgres and sqlite.
+        if current_migration_version < 5:
+            logger.info("Migrating the database from v4 to v5...")
+
+            # Add table for messages waiting to be sent to users, so that they are
+            # still sent after a crash or restart. The transaction ID is reused for
+            # every attempt, so the homeserver ignores repeated sends
+            await self._execute(
+                """
+            CREATE TABLE outbox (
+                txn_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                room_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                body TEXT NOT NULL,
+                formatted_body TEXT,
+                queued_at BIGINT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at BIGINT NOT NULL
+            )
+            """
+            )
+            await self._execute(
+                "CREATE INDEX outbox_next_attempt_at ON outbox(next_attempt_at)"
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 5")
+
+            logger.info("Database migrated to v5")
+
+        if current_migration_version < 6:
+            logger.info("Migrating the database from v5 to v6...")
+
+            # Add tables for sharding rooms across several bot processes. Each worker
+            # keeps its row alive while running, and holds leases on the shards of
+            # rooms it moderates
+            await self._execute(
+                """
+            CREATE TABLE shard_workers (
+                worker_id TEXT PRIMARY KEY,
+                expires_at BIGINT NOT NULL
+            )
+            """
+            )
+            await self._execute(
+                """
+            CREATE TABLE shard_leases (
+                shard INTEGER PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                expires_at BIGINT NOT NULL
+            )
+            """
+            )
+            # Queued messages are sent by the worker owning the shard of their room
+            await self._execute("ALTER TABLE outbox ADD COLUMN shard INTEGER")
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 6")
+
+            logger.info("Database migrated to v6")
+
+        if current_migration_version < 7:
+            logger.info("Migrating the database from v6 to v7...")
+
+            # Add a table keeping the last message processed in each room, so that
+            # messages sent while the bot was down can be caught up on
+            await self._execute(
+                """
+            CREATE TABLE room_checkpoints (
+                room_id TEXT PRIMARY KEY,
+                event_id TEXT NOT NULL,
+                origin_server_ts BIGINT NOT NULL
+            )
+            """
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 7")
+
+            logger.info("Database migrated to v7")
+
+        if current_migration_version < 8:
+            logger.info("Migrating the database from v7 to v8...")
+
+            # Add a table of recently processed events, so that events redelivered
+            # after a restart aren't moderated twice
+            await self._execute(
+                """
+            CREATE TABLE processed_events (
+                event_id TEXT PRIMARY KEY,
+                processed_at BIGINT NOT NULL
+            )
+            """
+            )
+            await self._execute(
+                "CREATE INDEX processed_events_processed_at ON processed_events (processed_at)"
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 8")
+
+            logger.info("Database migrated to v8")
+
+        if current_migration_version < 9:
+            logger.info("Migrating the database from v8 to v9...")
+
+            # Add a table keeping the content rules set in each room, as rooms synced
+            # from a stored sync token don't come with their full state
+            await self._execute(
+                """
+            CREATE TABLE room_rules (
+                room_id TEXT PRIMARY KEY,
+                event_id TEXT NOT NULL,
+                content TEXT NOT NULL
+            )
+            """
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 9")
+
+            logger.info("Database migrated to v9")
+
+        if current_migration_version < 10:
+            logger.info("Migrating the database from v9 to v10...")
+
+            # Index the messages of each room in order, so that a room's messages
+            # can be held back behind an earlier one waiting to be retried
+            await self._execute(
+                "CREATE INDEX outbox_room_queued_at ON outbox (room_id, queued_at)"
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 10")
+
+            logger.info("Database migrated to v10")
+
+        if current_migration_version < 11:
+            logger.info("Migrating the database from v10 to v11...")
+
+            # Add a table of the rooms locked down during a raid, so that their
+            # lockdown can be lifted after a crash or restart
+            await self._execute(
+                """
+            CREATE TABLE raid_lockdowns (
+                room_id TEXT PRIMARY KEY,
+                previous_level INTEGER NOT NULL,
+                lockdown_level INTEGER NOT NULL
+            )
+            """
+            )
+            # Update the stored migration version
+            await self._execute("UPDATE migration_version SET version = 11")
+
+            logger.info("Database migrated to v11")
+
+    async def _execute(self, query: str, params: Sequence[Any] = ()) -> None:
+        """Execute a statement that does not return any rows.
+
+        Queries use ?'s as placeholders, which are transformed to $n's for postgres.
+        This allows for the support of queries that are compatible with both postgres
+        and sqlite.
 
         Args:
-            args: Arguments passed to cursor.execute.
+            query: The SQL statement to execute.
+
+            params: The values to substitute into the statement's placeholders.
         """
-        if self.db_type == "postgres":
-            self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
-        else:
-            self.cursor.execute(*args)
+        with metrics.db_query_seconds.time(operation="execute"):
+            if self.db_type == "postgres":
+                await self.pool.execute(_to_postgres_placeholders(query), *params)
+            else:
+                async with self._write_lock:
+                    await self.conn.execute(query, params)
+
+    async def _executemany(self, query: str, params: Iterable[Sequence[Any]]) -> None:
+        """Execute a statement once for each set of parameters, in a single transaction.
 
-    def delete_uri(self, filename: str):
+        Args:
+            query: The SQL statement to execute.
+
+            params: An iterable of parameter sequences, one per execution.
+        """
+        params = list(params)
+        if not params:
+            return
+
+        with metrics.db_query_seconds.time(operation="executemany"):
+            if self.db_type == "postgres":
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await conn.executemany(_to_postgres_placeholders(query), params)
+            else:
+                async with self._write_lock:
+                    await self.conn.execute("BEGIN")
+                    try:
+                        await self.conn.executemany(query, params)
+                    except Exception:
+                        await self.conn.execute("ROLLBACK")
+                        raise
+                    await self.conn.execute("COMMIT")
+
+    async def _fetchone(self, query: str, params: Sequence[Any] = ()) -> Optional[Any]:
+        """Execute a query and return its first row, or None if there were no results.
+
+        Args:
+            query: The SQL query to execute.
+
+            params: The values to substitute into the query's placeholders.
+        """
+        with metrics.db_query_seconds.time(operation="fetchone"):
+            if self.db_type == "postgres":
+                return await self.pool.fetchrow(_to_postgres_placeholders(query), *params)
+
+            async with self.conn.execute(query, params) as cursor:
+                return await cursor.fetchone()
+
+    async def _fetchall(self, query: str, params: Sequence[Any] = ()) -> List[Any]:
+        """Execute a query and return all resulting rows.
+
+        Args:
+            query: The SQL query to execute.
+
+            params: The values to substitute into the query's placeholders.
+        """
+        with metrics.db_query_seconds.time(operation="fetchall"):
+            if self.db_type == "postgres":
+                return await self.pool.fetch(_to_postgres_placeholders(query), *params)
+
+            async with self.conn.execute(query, params) as cursor:
+                return list(await cursor.fetchall())
+
+    async def delete_uri(self, filename: str):
         """Delete a uri entry via its filename"""
-        self._execute(
+        await self._execute(
             """
             DELETE FROM static_media_uris WHERE filename = ?
         """,
-            ((filename,))
+            (filename,),
         )
 
-    def get_uri(self, filename):
-        """Get the uri of a file by the filename"""
+    async def get_uri(self, filename: str, content_hash: str) -> Optional[str]:
+        """Get the uri of a file by the filename, if it was uploaded with the same contents
 
-        self._execute(
+        Args:
+            filename: The path of the file.
+
+            content_hash: The SHA-256 of the file's current contents.
+        """
+        row = await self._fetchone(
             """
             SELECT uri FROM static_media_uris
-            WHERE filename = ?
+            WHERE filename = ? AND content_hash = ?
         """,
-            ((filename,)),
+            (filename, content_hash),
         )
 
-        row = self.cursor.fetchone()
         if row is not None:
             return row[0]
         return None
-    
-    def set_uri(self, filename, uri):
-        """Create a new URI for a file with filename"""
-        self._execute(
+
+    async def set_uri(self, filename: str, uri: str, content_hash: str):
+        """Store the URI of a file with filename, replacing that of older contents"""
+        await self._execute(
             """
             INSERT INTO static_media_uris (
                 filename,
-                uri
+                uri,
+                content_hash
             ) VALUES(
-                ?, ?
+                ?, ?, ?
             )
+            ON CONFLICT (filename) DO UPDATE SET
+                uri = excluded.uri,
+                content_hash = excluded.content_hash
         """,
             (
                 filename,
                 uri,
+                content_hash,
             ),
         )
 
-    def update_or_create_fail(self, user_id, room_id):
+    async def get_dm_room(self, user_id: str) -> Optional[str]:
+        """Get the ID of the DM room stored for a user"""
+        row = await self._fetchone(
+            """
+            SELECT room_id FROM dm_rooms
+            WHERE user_id = ?
+        """,
+            (user_id,),
+        )
+
+        if row is not None:
+            return row[0]
+        return None
+
+    async def set_dm_room(self, user_id: str, room_id: str):
+        """Store the ID of the DM room used for a user, replacing any previous one"""
+        await self._execute(
+            """
+            INSERT INTO dm_rooms (
+                user_id,
+                room_id,
+                created_at
+            ) VALUES(
+                ?, ?, ?
+            )
+            ON CONFLICT (user_id) DO
+            UPDATE SET room_id = excluded.room_id, created_at = excluded.created_at
+        """,
+            (user_id, room_id, int(time.time() * 1000)),
+        )
+
+    async def add_dm_rooms(self, rooms: Dict[str, str]):
+        """Store the ID of the DM room found for each user, keeping any stored one
+
+        Args:
+            rooms: A mapping from user ID to the ID of a DM room shared with the user.
+        """
+        created_at = int(time.time() * 1000)
+        await self._executemany(
+            """
+            INSERT INTO dm_rooms (
+                user_id,
+                room_id,
+                created_at
+            ) VALUES(
+                ?, ?, ?
+            )
+            ON CONFLICT (user_id) DO NOTHING
+        """,
+            [(user_id, room_id, created_at) for user_id, room_id in rooms.items()],
+        )
+
+    async def delete_dm_room(self, user_id: str):
+        """Delete the DM room stored for a user"""
+        await self._execute(
+            """
+            DELETE FROM dm_rooms WHERE user_id = ?
+        """,
+            (user_id,),
+        )
+
+    async def get_sync_filter(self, user_id: str, filter_hash: str) -> Optional[str]:
+        """Get the ID of a sync filter uploaded by a user, by the hash of the filter"""
+        row = await self._fetchone(
+            """
+            SELECT filter_id FROM sync_filters
+            WHERE user_id = ? AND filter_hash = ?
+        """,
+            (user_id, filter_hash),
+        )
+
+        if row is not None:
+            return row[0]
+        return None
+
+    async def set_sync_filter(self, user_id: str, filter_hash: str, filter_id: str):
+        """Store the ID of a sync filter uploaded by a user"""
+        await self._execute(
+            """
+            INSERT INTO sync_filters (
+                user_id,
+                filter_hash,
+                filter_id
+            ) VALUES(
+                ?, ?, ?
+            )
+            ON CONFLICT (user_id, filter_hash) DO UPDATE SET
+                filter_id = excluded.filter_id
+        """,
+            (user_id, filter_hash, filter_id),
+        )
+
+    async def queue_message(
+        self,
+        txn_id: str,
+        user_id: str,
+        room_id: str,
+        kind: str,
+        body: str,
+        formatted_body: Optional[str],
+        queued_at: int,
+        shard: Optional[int] = None,
+    ):
+        """Store a message waiting to be sent to a user
+
+        Args:
+            txn_id: The transaction ID the message is sent with.
+
+            user_id: The user the message is for.
+
+            room_id: The room to send the message to.
+
+            kind: Either "text" or "image".
+
+            body: The text of the message, or the path of the image.
+
+            formatted_body: The HTML of a text message, if it has been rendered.
+
+            queued_at: The time the message was queued at, in microseconds. Messages
+                are sent in this order.
+
+            shard: The shard of the room, when rooms are sharded across workers.
+        """
+        await self._execute(
+            """
+            INSERT INTO outbox (
+                txn_id,
+                user_id,
+                room_id,
+                kind,
+                body,
+                formatted_body,
+                queued_at,
+                next_attempt_at,
+                shard
+            ) VALUES(
+                ?, ?, ?, ?, ?, ?, ?, ?, ?
+            )
+        """,
+            (
+                txn_id,
+                user_id,
+                room_id,
+                kind,
+                body,
+                formatted_body,
+                queued_at,
+                queued_at // 1000,
+                shard,
+            ),
+        )
+
+    async def get_due_messages(
+        self, now: int, limit: int, shards: Optional[Sequence[int]] = None
+    ) -> List[Any]:
+        """Get the oldest messages due to be (re)sent, in the order they were queued
+
+        The messages of a room are held back while an earlier message of the room
+        is waiting to be retried, so that each room's messages are sent in order.
+
+        Args:
+            now: The current time, in milliseconds.
+
+            limit: The maximum amount of messages to return.
+
+            shards: If given, only get the messages of rooms in these shards.
+
+        Returns:
+            Rows of (txn_id, user_id, room_id, kind, body, formatted_body, attempts).
+        """
+        return await self._fetchall(
+            f"""
+            SELECT txn_id, user_id, room_id, kind, body, formatted_body, attempts
+            FROM outbox
+            WHERE next_attempt_at <= ?{_shard_condition(shards)}
+            AND NOT EXISTS (
+                SELECT 1 FROM outbox AS earlier
+                WHERE earlier.room_id = outbox.room_id
+                AND earlier.queued_at < outbox.queued_at
+                AND earlier.next_attempt_at > ?
+            )
+            ORDER BY queued_at
+            LIMIT ?
+        """,
+            (now, *(shards or ()), now, limit),
+        )
+
+    async def get_next_message_attempt(
+        self, shards: Optional[Sequence[int]] = None
+    ) -> Optional[int]:
+        """Get the time the next message is due at, in milliseconds
+
+        Only the oldest message of each room is considered, as the others are held
+        back behind it.
+
+        Args:
+            shards: If given, only consider the messages of rooms in these shards.
+        """
+        row = await self._fetchone(
+            f"""
+            SELECT MIN(next_attempt_at) FROM outbox
+            WHERE 1 = 1{_shard_condition(shards)}
+            AND NOT EXISTS (
+                SELECT 1 FROM outbox AS earlier
+                WHERE earlier.room_id = outbox.room_id
+                AND earlier.queued_at < outbox.queued_at
+            )
+        """,
+            tuple(shards or ()),
+        )
+        if row is not None:
+            return row[0]
+        return None
+
+    async def retry_messages(self, retries: Iterable[Tuple[str, int, int]]):
+        """Reschedule messages that failed to send
+
+        Args:
+            retries: Tuples of (txn_id, attempts, next_attempt_at), with the next
+                attempt in milliseconds.
+        """
+        await self._executemany(
+            """
+            UPDATE outbox SET attempts = ?, next_attempt_at = ?
+            WHERE txn_id = ?
+        """,
+            (
+                (attempts, next_attempt_at, txn_id)
+                for txn_id, attempts, next_attempt_at in retries
+            ),
+        )
+
+    async def delete_messages(self, txn_ids: Iterable[str]):
+        """Delete messages that have been sent, or given up on"""
+        await self._executemany(
+            "DELETE FROM outbox WHERE txn_id = ?",
+            ((txn_id,) for txn_id in txn_ids),
+        )
+
+    async def get_room_checkpoints(self) -> Dict[str, Tuple[str, int]]:
+        """Get the last processed message of every room
+
+        Returns:
+            A mapping from room ID to the event ID and timestamp of the message.
+        """
+        rows = await self._fetchall(
+            "SELECT room_id, event_id, origin_server_ts FROM room_checkpoints"
+        )
+        return {room_id: (event_id, ts) for room_id, event_id, ts in rows}
+
+    async def set_room_checkpoints(self, checkpoints: Iterable[Tuple[str, str, int]]):
+        """Store the last processed message of rooms, unless a later one is stored
+
+        Args:
+            checkpoints: Tuples of (room_id, event_id, origin_server_ts).
+        """
+        await self._executemany(
+            """
+            INSERT INTO room_checkpoints (
+                room_id,
+                event_id,
+                origin_server_ts
+            ) VALUES(
+                ?, ?, ?
+            )
+            ON CONFLICT (room_id) DO UPDATE SET
+                event_id = excluded.event_id,
+                origin_server_ts = excluded.origin_server_ts
+            WHERE excluded.origin_server_ts >= room_checkpoints.origin_server_ts
+        """,
+            checkpoints,
+        )
+
+    async def get_processed_events(self, limit: int) -> List[str]:
+        """Get the IDs of the most recently processed events, oldest first"""
+        rows = await self._fetchall(
+            """
+            SELECT event_id FROM processed_events
+            ORDER BY processed_at DESC
+            LIMIT ?
+        """,
+            (limit,),
+        )
+        return [row[0] for row in reversed(rows)]
+
+    async def add_processed_events(self, events: Iterable[Tuple[str, int]]):
+        """Store processed events
+
+        Args:
+            events: Tuples of (event_id, processed_at), the time being in
+                milliseconds.
+        """
+        await self._executemany(
+            """
+            INSERT INTO processed_events (
+                event_id,
+                processed_at
+            ) VALUES(
+                ?, ?
+            )
+            ON CONFLICT (event_id) DO NOTHING
+        """,
+            events,
+        )
+
+    async def delete_processed_events(self, before: int):
+        """Delete the events processed before a time, in milliseconds"""
+        await self._execute(
+            "DELETE FROM processed_events WHERE processed_at < ?", (before,)
+        )
+
+    async def get_room_rules(self) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+        """Get the content rules set in every room
+
+        Returns:
+            A mapping from room ID to the ID of the state event the rules were set
+            with, and the rules.
+        """
+        rows = await self._fetchall("SELECT room_id, event_id, content FROM room_rules")
+        return {
+            room_id: (event_id, json.loads(content))
+            for room_id, event_id, content in rows
+        }
+
+    async def set_room_rules(self, room_id: str, event_id: str, rules: Dict[str, Any]):
+        """Store the content rules set in a room
+
+        Args:
+            room_id: The room the rules were set in.
+
+            event_id: The ID of the state event the rules were set with.
+
+            rules: The content of the state event.
+        """
+        await self._execute(
+            """
+            INSERT INTO room_rules (
+                room_id,
+                event_id,
+                content
+            ) VALUES(
+                ?, ?, ?
+            )
+            ON CONFLICT (room_id) DO UPDATE SET
+                event_id = excluded.event_id,
+                content = excluded.content
+        """,
+            (room_id, event_id, json.dumps(rules)),
+        )
+
+    async def delete_room_rules(self, room_id: str):
+        """Forget the content rules set in a room"""
+        await self._execute("DELETE FROM room_rules WHERE room_id = ?", (room_id,))
+
+    async def get_raid_lockdowns(self) -> Dict[str, Tuple[int, int]]:
+        """Get the rooms locked down during a raid
+
+        Returns:
+            A mapping from room ID to the `events_default` of the room before it was
+            locked down, and the level it was raised to.
+        """
+        rows = await self._fetchall(
+            "SELECT room_id, previous_level, lockdown_level FROM raid_lockdowns"
+        )
+        return {room_id: (previous, level) for room_id, previous, level in rows}
+
+    async def set_raid_lockdown(
+        self, room_id: str, previous_level: int, lockdown_level: int
+    ):
+        """Record that a room is being locked down during a raid
+
+        Args:
+            room_id: The room being locked down.
+
+            previous_level: The `events_default` of the room before the lockdown.
+
+            lockdown_level: The `events_default` the room is locked down with.
+        """
+        await self._execute(
+            """
+            INSERT INTO raid_lockdowns (
+                room_id,
+                previous_level,
+                lockdown_level
+            ) VALUES(
+                ?, ?, ?
+            )
+            ON CONFLICT (room_id) DO UPDATE SET
+                previous_level = excluded.previous_level,
+                lockdown_level = excluded.lockdown_level
+        """,
+            (room_id, previous_level, lockdown_level),
+        )
+
+    async def delete_raid_lockdown(self, room_id: str):
+        """Forget the lockdown of a room, once it has been lifted"""
+        await self._execute(
+            "DELETE FROM raid_lockdowns WHERE room_id = ?", (room_id,)
+        )
+
+    async def heartbeat_worker(self, worker_id: str, expires_at: int):
+        """Mark a worker as alive until a time, in milliseconds"""
+        await self._execute(
+            """
+            INSERT INTO shard_workers (
+                worker_id,
+                expires_at
+            ) VALUES(
+                ?, ?
+            )
+            ON CONFLICT (worker_id) DO UPDATE SET expires_at = excluded.expires_at
+        """,
+            (worker_id, expires_at),
+        )
+
+    async def get_live_workers(self, now: int) -> List[str]:
+        """Get the IDs of the workers that are alive at a time, in milliseconds"""
+        rows = await self._fetchall(
+            "SELECT worker_id FROM shard_workers WHERE expires_at > ?", (now,)
+        )
+        return [row[0] for row in rows]
+
+    async def delete_worker(self, worker_id: str):
+        """Remove a stopped worker, along with its shard leases"""
+        await self._execute(
+            "DELETE FROM shard_leases WHERE worker_id = ?", (worker_id,)
+        )
+        await self._execute(
+            "DELETE FROM shard_workers WHERE worker_id = ?", (worker_id,)
+        )
+
+    async def claim_shards(
+        self, worker_id: str, shards: Iterable[int], expires_at: int, now: int
+    ):
+        """Take or renew the leases of shards, unless another worker holds them
+
+        Args:
+            worker_id: The worker claiming the shards.
+
+            shards: The shards to claim.
+
+            expires_at: The time the leases expire at, in milliseconds.
+
+            now: The current time, in milliseconds. Leases that expired before it
+                are taken over.
+        """
+        await self._executemany(
+            """
+            INSERT INTO shard_leases (
+                shard,
+                worker_id,
+                expires_at
+            ) VALUES(
+                ?, ?, ?
+            )
+            ON CONFLICT (shard) DO UPDATE SET
+                worker_id = excluded.worker_id,
+                expires_at = excluded.expires_at
+            WHERE shard_leases.worker_id = excluded.worker_id
+                OR shard_leases.expires_at <= ?
+        """,
+            ((shard, worker_id, expires_at, now) for shard in shards),
+        )
+
+    async def release_shards(self, worker_id: str, shards: Iterable[int]):
+        """Give up the leases a worker holds on shards"""
+        await self._executemany(
+            "DELETE FROM shard_leases WHERE shard = ? AND worker_id = ?",
+            ((shard, worker_id) for shard in shards),
+        )
+
+    async def get_owned_shards(self, worker_id: str, now: int) -> List[int]:
+        """Get the shards a worker holds a valid lease on"""
+        rows = await self._fetchall(
+            "SELECT shard FROM shard_leases WHERE worker_id = ? AND expires_at > ?",
+            (worker_id, now),
+        )
+        return [row[0] for row in rows]
+
+    async def update_or_create_fail(self, user_id, room_id):
         """Create a new fail entry, or increment an existing one"""
         logger.debug(
             f"Creating new/incrementing attempts for {user_id} in room {room_id}"
         )
-        self._execute(
+        await self._execute(
             """
             INSERT INTO fails (
                 user_id,
@@ -209,7 +1048,7 @@ class Storage:
                 ?, ?, 1
             )
             ON CONFLICT (user_id, room_id) DO
-            UPDATE SET attempts = attempts + 1
+            UPDATE SET attempts = fails.attempts + 1
         """,
             (
                 user_id,
@@ -217,19 +1056,52 @@ class Storage:
             ),
         )
 
-    def delete_fail(self, user_id: str, room_id: str):
+    async def add_fails(self, fails: Iterable[Tuple[str, str, int]]):
+        """Add to the amount of fails of many users at once
+
+        Args:
+            fails: An iterable of (user_id, room_id, amount) tuples.
+        """
+        await self._executemany(
+            """
+            INSERT INTO fails (
+                user_id,
+                room_id,
+                attempts
+            ) VALUES(
+                ?, ?, ?
+            )
+            ON CONFLICT (user_id, room_id) DO
+            UPDATE SET attempts = fails.attempts + excluded.attempts
+        """,
+            fails,
+        )
+
+    async def delete_fails(self, fails: Iterable[Tuple[str, str]]):
+        """Delete the fail entries of many users at once
+
+        Args:
+            fails: An iterable of (user_id, room_id) tuples.
+        """
+        await self._executemany(
+            """
+            DELETE FROM fails WHERE user_id = ? AND room_id = ?
+        """,
+            fails,
+        )
+
+    async def delete_fail(self, user_id: str, room_id: str):
         """Delete a fail entry via its user and room ids"""
-        self._execute(
+        await self._execute(
             """
             DELETE FROM fails WHERE room_id = ? AND user_id = ?
         """,
             (room_id, user_id),
         )
 
-    def get_fail(self, user_id, room_id):
+    async def get_fail(self, user_id, room_id):
         """Get the number of fails for a user in a group"""
-
-        self._execute(
+        row = await self._fetchone(
             """
             SELECT attempts from fails
             WHERE room_id = ? AND user_id = ?
@@ -240,11 +1112,311 @@ class Storage:
             ),
         )
 
-        row = self.cursor.fetchall()
-        if len(row) != 0:
+        if row is not None:
             logger.debug(
-                f"Found failed attempts for {user_id} in room {room_id}: {row[0][0]}"
+                f"Found failed attempts for {user_id} in room {room_id}: {row[0]}"
             )
-            return row[0][0]
+            return row[0]
         logger.debug(f"First failed attempt for {user_id} in room {room_id}")
         return 0
+
+
+class FailCounterCache:
+    def __init__(self, store: Storage, max_size: int = 10000, flush_interval: float = 5):
+        """A write-behind cache of the amount of fails per user in each room.
+
+        Reads are served from memory once a counter has been loaded, and changes are
+        only recorded as pending. Pending changes are written to the `fails` table in
+        a single batch every `flush_interval` seconds, and when the cache is closed.
+
+        Changes are written as increments rather than as the counts held in memory,
+        so that a late flush of a worker that has lost a room adds to the counters of
+        the room's new owner instead of overwriting them.
+
+        Args:
+            store: The storage the counters are loaded from and flushed to.
+
+            max_size: The maximum amount of counters kept in memory. The least recently
+                used counters are evicted first.
+
+            flush_interval: The amount of seconds between flushes.
+        """
+        self.store = store
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+
+        # (user_id, room_id) -> attempts, in least to most recently used order
+        self._counters = OrderedDict()  # type: OrderedDict[Tuple[str, str], int]
+        # (user_id, room_id) -> (reset, amount) of the changes not yet written out. A
+        # reset deletes the counter's entry before the amount is added to it
+        self._changes = {}  # type: Dict[Tuple[str, str], Tuple[bool, int]]
+        # Counters with pending changes that were evicted before they could be flushed
+        self._evicted = {}  # type: Dict[Tuple[str, str], int]
+        # Counters whose changes are being written, kept readable until the write has
+        # committed, as the database still has their previous values until then
+        self._in_flight = {}  # type: Dict[Tuple[str, str], int]
+
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None  # type: Optional[asyncio.Task]
+
+    def start(self) -> None:
+        """Start periodically flushing pending changes to the database"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(
+                self._flush_periodically()
+            )
+
+    async def close(self) -> None:
+        """Stop the periodic flush and write out any remaining changes"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        await self.flush()
+
+    async def get(self, user_id: str, room_id: str) -> int:
+        """Get the number of fails for a user in a room"""
+        key = (user_id, room_id)
+        if key in self._counters:
+            self._counters.move_to_end(key)
+            return self._counters[key]
+
+        if key in self._evicted:
+            attempts = self._evicted[key]
+        elif key in self._in_flight:
+            attempts = self._in_flight[key]
+        else:
+            attempts = await self.store.get_fail(user_id, room_id)
+
+            # Another caller may have loaded (and changed) the counter in the meantime
+            if key in self._counters:
+                self._counters.move_to_end(key)
+                return self._counters[key]
+
+        self._set(key, attempts)
+        return attempts
+
+    async def increment(self, user_id: str, room_id: str, amount: int = 1) -> int:
+        """Increment the number of fails for a user in a room
+
+        Args:
+            user_id: The user who failed.
+
+            room_id: The room they failed in.
+
+            amount: The number of fails to add.
+
+        Returns:
+            The new number of fails.
+        """
+        key = (user_id, room_id)
+        attempts = await self.get(user_id, room_id) + amount
+        reset, pending = self._changes.get(key, (False, 0))
+        self._changes[key] = (reset, pending + amount)
+        self._set(key, attempts)
+        return attempts
+
+    async def reset(self, user_id: str, room_id: str) -> None:
+        """Reset the number of fails for a user in a room, deleting their entry"""
+        key = (user_id, room_id)
+        self._changes[key] = (True, 0)
+        self._set(key, 0)
+
+    def evict(self, predicate: Callable[[str], bool]) -> None:
+        """Drop the clean counters of the rooms matching a predicate from memory
+
+        Used when another process takes over the rooms, so that their counters are
+        read from the database again if the rooms come back. Counters with pending
+        changes are kept until they have been flushed.
+        """
+        for key in [key for key in self._counters if predicate(key[1])]:
+            if key not in self._changes:
+                del self._counters[key]
+
+    def _set(self, key: Tuple[str, str], attempts: int) -> None:
+        self._counters[key] = attempts
+        self._counters.move_to_end(key)
+        self._evicted.pop(key, None)
+
+        while len(self._counters) > self.max_size:
+            evicted_key, evicted_attempts = self._counters.popitem(last=False)
+            if evicted_key in self._changes:
+                # Keep the counter readable until its changes have been written out
+                self._evicted[evicted_key] = evicted_attempts
+
+    async def flush(self) -> None:
+        """Write all pending changes to the database in a single batch"""
+        async with self._flush_lock:
+            if not self._changes:
+                return
+
+            changes, self._changes = self._changes, {}
+            self._in_flight = self._evicted
+            self._in_flight.update(
+                (key, self._counters[key]) for key in changes if key in self._counters
+            )
+            self._evicted = {}
+
+            deleted = [key for key, (reset, _) in changes.items() if reset]
+            added = [
+                (user_id, room_id, amount)
+                for (user_id, room_id), (_, amount) in changes.items()
+                if amount
+            ]
+
+            try:
+                await self.store.delete_fails(deleted)
+                await self.store.add_fails(added)
+            except Exception:
+                # Put the changes back in front of any made since, unless a reset
+                # has superseded them
+                for key, (reset, amount) in changes.items():
+                    newer_reset, newer_amount = self._changes.get(key, (False, 0))
+                    if not newer_reset:
+                        self._changes[key] = (reset, amount + newer_amount)
+                for key, attempts in self._in_flight.items():
+                    if key not in self._counters:
+                        self._evicted.setdefault(key, attempts)
+                raise
+            finally:
+                self._in_flight = {}
+
+            logger.debug(
+                f"Flushed {len(added)} incremented and {len(deleted)} reset fail counters"
+            )
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush fail counters to the database")
+
+
+class ProcessedEventCache:
+    def __init__(
+        self,
+        store: Storage,
+        max_size: int = 10000,
+        flush_interval: float = 5,
+        retention: float = 86400,
+    ):
+        """The IDs of recently processed events, so that redelivered events are skipped.
+
+        Events can be delivered again after a reconnect or a restart. An event is only
+        recorded once it has been moderated, and is marked as pending in the
+        meantime so that a redelivery doesn't queue it twice. The most recent
+        `max_size` event IDs are kept in memory, where they are checked in constant
+        time. New IDs are written to the `processed_events` table in a single batch
+        every `flush_interval` seconds, and loaded back on startup. IDs older than
+        `retention` seconds are removed from the table.
+
+        Args:
+            store: The storage the event IDs are loaded from and flushed to.
+
+            max_size: The maximum amount of event IDs kept in memory. The least
+                recently processed are evicted first.
+
+            flush_interval: The amount of seconds between flushes.
+
+            retention: The amount of seconds event IDs are kept in the database for.
+        """
+        self.store = store
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+
+        # event IDs, in least to most recently processed order
+        self._events = OrderedDict()  # type: OrderedDict[str, None]
+        # event_id -> the time it was processed at, for events not flushed yet
+        self._new = {}  # type: Dict[str, int]
+        # Events being processed. Only processed events are stored, so that events
+        # lost to a crash before they were processed are processed again
+        self._pending = set()  # type: Set[str]
+
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None  # type: Optional[asyncio.Task]
+
+    async def load(self) -> None:
+        """Load the most recently processed events from the database"""
+        for event_id in await self.store.get_processed_events(self.max_size):
+            self._events[event_id] = None
+
+    def start(self) -> None:
+        """Start periodically flushing new event IDs to the database"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_event_loop().create_task(
+                self._flush_periodically()
+            )
+
+    async def close(self) -> None:
+        """Stop the periodic flush and write out any remaining event IDs"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+
+        await self.flush()
+
+    def contains(self, event_id: str) -> bool:
+        """Whether an event has been processed, or is being processed"""
+        return event_id in self._events or event_id in self._pending
+
+    def is_processed(self, event_id: str) -> bool:
+        """Whether an event has been processed"""
+        return event_id in self._events
+
+    def claim(self, event_id: str) -> None:
+        """Mark an event as being processed, until it is completed or released"""
+        self._pending.add(event_id)
+
+    def release(self, event_id: str) -> None:
+        """Forget an event that couldn't be processed, so it is processed if delivered
+        again"""
+        self._pending.discard(event_id)
+
+    def complete(self, event_id: str) -> None:
+        """Record that an event has been processed"""
+        self._pending.discard(event_id)
+        if event_id in self._events:
+            return
+
+        self._events[event_id] = None
+        self._new[event_id] = int(time.time() * 1000)
+        if len(self._events) > self.max_size:
+            self._events.popitem(last=False)
+
+    async def flush(self) -> None:
+        """Write new event IDs to the database, and delete the expired ones"""
+        async with self._flush_lock:
+            if not self._new:
+                return
+
+            new, self._new = self._new, {}
+            try:
+                await self.store.add_processed_events(new.items())
+                await self.store.delete_processed_events(
+                    int((time.time() - self.retention) * 1000)
+                )
+            except Exception:
+                new.update(self._new)
+                self._new = new
+                raise
+
+            logger.debug(f"Flushed {len(new)} processed event IDs")
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush processed event IDs to the database")
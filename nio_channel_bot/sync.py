@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from itertools import chain
+from typing import Any, Dict, List, Optional, Set, Union
+
+from nio import (
+    AsyncClient,
+    Event,
+    JoinedMembersError,
+    MatrixRoom,
+    RoomCreateEvent,
+    RoomGetStateError,
+    RoomMemberEvent,
+    SyncResponse,
+    UploadFilterResponse,
+)
+
+from nio_channel_bot import metrics
+from nio_channel_bot.ratelimit import with_ratelimit
+from nio_channel_bot.rules import RULES_EVENT_TYPE
+from nio_channel_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# The timeline events the bot handles (see the callbacks registered in main), and the
+# state events that the room state it relies on is built from
+DEFAULT_TIMELINE_TYPES = [
+    "m.room.message",
+    "m.room.encrypted",
+    "m.reaction",
+    "m.room.member",
+    "m.room.power_levels",
+    "m.room.create",
+    "m.room.name",
+    "m.room.canonical_alias",
+    "m.room.encryption",
+    RULES_EVENT_TYPE,
+]
+DEFAULT_TIMELINE_LIMIT = 50
+
+# Matches no event types at all
+NO_EVENTS = {"not_types": ["*"]}
+
+
+def build_sync_filter(
+    lazy_load_members: bool = True,
+    timeline_types: Optional[List[str]] = None,
+    timeline_limit: int = DEFAULT_TIMELINE_LIMIT,
+) -> Dict[str, Any]:
+    """Build the filter used for syncing
+
+    Presence, typing notifications, read receipts and account data are never synced,
+    as the bot doesn't use them.
+
+    Args:
+        lazy_load_members: Whether the homeserver should only send the membership of
+            users whose events are in the sync, instead of every member of a room.
+
+        timeline_types: The types of the room events to sync. Defaults to
+            `DEFAULT_TIMELINE_TYPES`.
+
+        timeline_limit: The maximum amount of events synced per room in each sync.
+    """
+    return {
+        "presence": NO_EVENTS,
+        "account_data": NO_EVENTS,
+        "room": {
+            "state": {"lazy_load_members": lazy_load_members},
+            "timeline": {
+                "types": timeline_types or DEFAULT_TIMELINE_TYPES,
+                "limit": timeline_limit,
+            },
+            "ephemeral": NO_EVENTS,
+            "account_data": NO_EVENTS,
+        },
+    }
+
+
+async def upload_sync_filter(
+    client: AsyncClient, store: Storage, sync_filter: Dict[str, Any]
+) -> Union[str, Dict[str, Any]]:
+    """Get the ID of a sync filter, uploading it if it hasn't been already
+
+    The IDs of uploaded filters are stored by the hash of the filter, so that a
+    changed filter is uploaded again.
+
+    Args:
+        client: The logged in client to upload the filter with.
+
+        store: Bot storage.
+
+        sync_filter: The filter, as built by `build_sync_filter`.
+
+    Returns:
+        The ID of the filter, or the filter itself if it could not be uploaded, which
+        can be passed to the sync as well.
+    """
+    filter_hash = hashlib.sha256(
+        json.dumps(sync_filter, sort_keys=True).encode()
+    ).hexdigest()
+
+    filter_id = await store.get_sync_filter(client.user_id, filter_hash)
+    if filter_id is not None:
+        logger.debug(f"Using stored sync filter {filter_id}")
+        return filter_id
+
+    response = await client.upload_filter(**sync_filter)
+    if not isinstance(response, UploadFilterResponse):
+        logger.warning(
+            f"Failed to upload the sync filter, sending it inline: {response}"
+        )
+        return sync_filter
+
+    logger.info(f"Uploaded sync filter {response.filter_id}")
+    await store.set_sync_filter(client.user_id, filter_hash, response.filter_id)
+    return response.filter_id
+
+
+class RoomStateLoader:
+    def __init__(self, client: AsyncClient):
+        """Fetches the full state of rooms that weren't fully synced, when needed.
+
+        When the bot resumes syncing from a stored sync token, only rooms with new
+        activity are synced, and only with the state that has changed. The full state
+        of such a room (e.g. its power levels and members) is fetched the first time
+        the bot needs to act in it.
+
+        Args:
+            client: The client whose rooms are loaded.
+        """
+        self.client = client
+
+        # Rooms whose full state is known
+        self._loaded = set()  # type: Set[str]
+        # Only one request for the state of a room happens at a time
+        self._locks = {}  # type: Dict[str, asyncio.Lock]
+
+    def is_loaded(self, room_id: str) -> bool:
+        """Whether the full state of a room is known"""
+        return room_id in self._loaded
+
+    async def on_sync(self, response: SyncResponse) -> None:
+        """Response callback marking rooms whose full state was synced
+
+        A room's full state is synced on the initial sync, and when the bot joins it,
+        both of which include the room's creation event.
+        """
+        for room_id, join_info in response.rooms.join.items():
+            if room_id in self._loaded:
+                continue
+            for event in chain(join_info.state, join_info.timeline.events):
+                if isinstance(event, RoomCreateEvent):
+                    self._loaded.add(room_id)
+                    break
+
+        for room_id in response.rooms.leave:
+            self._loaded.discard(room_id)
+
+    async def load(self, room_id: str) -> Optional[MatrixRoom]:
+        """Make sure the full state of a room is known, fetching it if it isn't
+
+        Rooms that haven't been synced at all are added to the client's rooms.
+
+        Args:
+            room_id: The room to load.
+
+        Returns:
+            The loaded room, or None if its state could not be fetched, e.g. because
+            the bot is no longer in the room.
+        """
+        if room_id in self._loaded:
+            return self.client.rooms.get(room_id)
+
+        lock = self._locks.get(room_id)
+        if lock is None:
+            lock = self._locks[room_id] = asyncio.Lock()
+
+        async with lock:
+            # The room may have been loaded while we were waiting
+            if room_id in self._loaded:
+                return self.client.rooms.get(room_id)
+
+            logger.debug(f"Fetching the full state of room {room_id}")
+            response = await with_ratelimit(
+                self.client.room_get_state, endpoint="state"
+            )(room_id)
+            if isinstance(response, RoomGetStateError):
+                logger.warning(
+                    f"Failed to fetch the state of room {room_id}: {response.message}"
+                )
+                return None
+
+            room = self.client.rooms.get(room_id)
+            if room is None:
+                room = self.client.rooms[room_id] = MatrixRoom(
+                    room_id, self.client.user_id
+                )
+
+            for event_dict in response.events:
+                event = Event.parse_event(event_dict)
+                if isinstance(event, RoomMemberEvent):
+                    room.handle_membership(event)
+                elif isinstance(event, Event):
+                    room.handle_event(event)
+
+            if room.encrypted:
+                self.client.encrypted_rooms.add(room_id)
+            # Every member is part of the full state
+            room.members_synced = True
+
+            self._loaded.add(room_id)
+            return room
+
+    async def load_members(self, room: MatrixRoom) -> None:
+        """Make sure every member of a room is known
+
+        With lazy loading, only the members whose events were synced are known.
+        """
+        if room.members_synced:
+            return
+
+        logger.debug(f"Fetching the members of room {room.room_id}")
+        response = await with_ratelimit(self.client.joined_members, endpoint="state")(
+            room.room_id
+        )
+        if isinstance(response, JoinedMembersError):
+            logger.warning(
+                f"Failed to fetch the members of room {room.room_id}: "
+                f"{response.message}"
+            )
+
+
+class StartupTimer:
+    def __init__(self, client: AsyncClient, started: Optional[float] = None):
+        """Reports how long it took for the bot to start, once the first sync is done
+
+        Args:
+            client: The client that is syncing.
+
+            started: The `time.monotonic()` the bot was started at. Defaults to now.
+        """
+        self.client = client
+        self.started = time.monotonic() if started is None else started
+        self.done = False
+
+    async def on_sync(self, response: SyncResponse) -> None:
+        """Response callback reporting the time taken by the first sync"""
+        if self.done:
+            return
+        self.done = True
+
+        elapsed = time.monotonic() - self.started
+        metrics.startup_seconds.set(elapsed)
+
+        kind = "incremental" if self.client.loaded_sync_token else "initial"
+        logger.info(
+            f"Started in {elapsed:.1f}s ({kind} sync of "
+            f"{len(response.rooms.join)} joined rooms)"
+        )
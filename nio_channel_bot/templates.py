@@ -0,0 +1,128 @@
+import html
+import re
+from functools import lru_cache
+from string import Formatter
+from typing import Any, Dict, List, NamedTuple, Set, Tuple
+
+from markdown import markdown
+
+from nio_channel_bot.errors import ConfigError
+
+# The messages sent to users, and the fields each of them can use
+DEFAULT_MESSAGES = {
+    "warning": """Your comment has been deleted {count} times in {room_name} discussion due to being improperly sent. Please reply in threads. \n
+How to enable threads: \n
+1. Hover on a message and click 'Reply in Thread' button. \n
+2. Press 'Join the beta' button. \n
+3. Reply to a message using the 'Reply in Thread' button.""",
+    "ban": "# You have made >3 improper comments in {room_name} discussion. Please seek help from the group admins: {admins}",
+    "rule_warning": "Your comment has been deleted {count} times in {room_name} discussion. Your last comment broke the '{rule}' rule of the room.",
+}
+MESSAGE_FIELDS = {
+    "warning": {"count", "room_name"},
+    "ban": {"room_name", "admins"},
+    "rule_warning": {"count", "room_name", "rule"},
+}
+
+# Stands in for a field while the template is rendered. Made of letters and digits
+# only, so markdown leaves it untouched
+_PLACEHOLDER = "TEMPLATEFIELD{}END"
+_PLACEHOLDER_RE = re.compile(r"TEMPLATEFIELD(\d+)END")
+
+
+class RenderedMessage(NamedTuple):
+    """A message with both its plain text body and its HTML formatted body"""
+
+    body: str
+    formatted_body: str
+
+
+@lru_cache(maxsize=1024)
+def render_markdown(text: str) -> str:
+    """Convert markdown to HTML, caching the result for repeated messages"""
+    return markdown(text)
+
+
+class MessageTemplate:
+    def __init__(self, text: str, fields: Set[str]):
+        """A markdown message with fields, rendered to HTML once.
+
+        Fields use `str.format` syntax, e.g. "Hello {name}". Only the field values are
+        substituted when the message is rendered, the markdown is never parsed again.
+
+        Args:
+            text: The markdown text of the message.
+
+            fields: The names of the fields the text may use.
+
+        Raises:
+            ConfigError: If the text uses an unknown field.
+        """
+        self.text = text
+
+        # The literal text in front of each field, with the field's name and format
+        # spec, in order
+        self._parts = []  # type: List[Tuple[str, str, str]]
+        # The literal text after the last field
+        self._tail = ""
+
+        marked_text = ""
+        for literal, field_name, format_spec, _ in Formatter().parse(text):
+            # Escaped braces are parsed into literals without a field, which are
+            # joined with the literal text after them
+            self._tail += literal
+            if field_name is None:
+                continue
+
+            if field_name not in fields:
+                raise ConfigError(
+                    f"Unknown field '{{{field_name}}}' in message, expected one of: "
+                    f"{', '.join(sorted(fields))}"
+                )
+            marked_text += self._tail + _PLACEHOLDER.format(len(self._parts))
+            self._parts.append((self._tail, field_name, format_spec))
+            self._tail = ""
+        marked_text += self._tail
+
+        # Split the rendered HTML around the placeholders. Odd parts are field indices
+        self._html_parts = _PLACEHOLDER_RE.split(render_markdown(marked_text))
+
+    def render(self, **values: Any) -> RenderedMessage:
+        """Fill in the fields of the message
+
+        Args:
+            values: The value of each field.
+        """
+        formatted = [format(values[name], spec) for _, name, spec in self._parts]
+
+        body = "".join(
+            literal + value for (literal, _, _), value in zip(self._parts, formatted)
+        )
+        body += self._tail
+
+        formatted_body = "".join(
+            html.escape(formatted[int(part)]) if i % 2 else part
+            for i, part in enumerate(self._html_parts)
+        )
+        return RenderedMessage(body, formatted_body)
+
+
+def compile_messages(messages: Dict[str, str]) -> Dict[str, MessageTemplate]:
+    """Compile the configured messages, falling back to the default ones
+
+    Args:
+        messages: A mapping from message name to its markdown text.
+
+    Raises:
+        ConfigError: If a message is unknown or uses unknown fields.
+    """
+    for name in messages:
+        if name not in DEFAULT_MESSAGES:
+            raise ConfigError(
+                f"Unknown message '{name}', expected one of: {', '.join(DEFAULT_MESSAGES)}"
+            )
+
+    return {
+        name: MessageTemplate(messages.get(name, default), MESSAGE_FIELDS[name])
+        for name, default in DEFAULT_MESSAGES.items()
+    }
@@ -0,0 +1,37 @@
+import unittest
+
+from benchmarks.bench_replay import parse_args, run
+
+
+class ReplayBenchmarkTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_replay(self):
+        """Tests that every replayed message is moderated through the fake homeserver,
+        even when the homeserver rate limits requests"""
+        args = parse_args(
+            [
+                "--messages",
+                "40",
+                "--rooms",
+                "2",
+                "--users",
+                "5",
+                "--batch",
+                "10",
+                "--latency-ms",
+                "0",
+                "--rate-limit-probability",
+                "0.2",
+            ]
+        )
+
+        results = await run(args)
+
+        self.assertGreater(results["submitted"], 0)
+        self.assertEqual(results["moderated"], results["submitted"])
+        self.assertEqual(results["failed"], 0)
+        self.assertEqual(results["requests"]["redact"], results["moderated"])
+        self.assertGreater(results["rate_limited"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,30 +1,67 @@
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import AsyncMock, Mock, patch
 
 import nio
 
+from nio_channel_bot.bot_commands import Command
 from nio_channel_bot.callbacks import Callbacks
-from nio_channel_bot.storage import Storage
+from nio_channel_bot.catchup import RoomCheckpoints
+from nio_channel_bot.chat_functions import ChatFunctions
+from nio_channel_bot.rules import RuleEngine
+from nio_channel_bot.storage import ProcessedEventCache, Storage
 
-from tests.utils import make_awaitable, run_coroutine
 
-
-class CallbacksTestCase(unittest.TestCase):
+class CallbacksTestCase(unittest.IsolatedAsyncioTestCase):
     def setUp(self) -> None:
         # Create a Callbacks object and give it some Mock'd objects to use
         self.fake_client = Mock(spec=nio.AsyncClient)
         self.fake_client.user = "@fake_user:example.com"
 
         self.fake_storage = Mock(spec=Storage)
+        self.fake_storage.processed = ProcessedEventCache(self.fake_storage)
+        self.fake_chat = Mock(spec=ChatFunctions)
 
         # We don't spec config, as it doesn't currently have well defined attributes
         self.fake_config = Mock()
+        self.fake_config.filter_old_messages = False
+
+        self.fake_pipeline = Mock()
+        self.fake_pipeline.submit = AsyncMock()
 
         self.callbacks = Callbacks(
-            self.fake_client, self.fake_storage, self.fake_config
+            self.fake_client,
+            self.fake_storage,
+            self.fake_config,
+            self.fake_chat,
+            self.fake_pipeline,
+        )
+
+        # A channel with the bot, a moderator and a regular user
+        self.room = nio.MatrixRoom("!abcdefg:example.com", self.fake_client.user)
+        for user_id in (
+            self.fake_client.user,
+            "@moderator:example.com",
+            "@user:example.com",
+        ):
+            self.room.add_member(user_id, None, None)
+        self.room.power_levels.users["@moderator:example.com"] = 50
+
+    def _message(self, sender, age_ms=0, thread=False, body="Hello"):
+        content = {"msgtype": "m.text", "body": body}
+        if thread:
+            content["m.relates_to"] = {"rel_type": "m.thread", "event_id": "$root"}
+        return nio.RoomMessageText.from_dict(
+            {
+                "type": "m.room.message",
+                "event_id": "$message",
+                "sender": sender,
+                "origin_server_ts": int(time.time() * 1000) - age_ms,
+                "content": content,
+            }
         )
 
-    def test_invite(self):
+    async def test_invite(self):
         """Tests the callback for InviteMemberEvents"""
         # Tests that the bot attempts to join a room after being invited to it
 
@@ -37,14 +74,123 @@ class CallbacksTestCase(unittest.TestCase):
         fake_invite_event.sender = "@some_other_fake_user:example.com"
 
         # Pretend that attempting to join a room is always successful
-        self.fake_client.join.return_value = make_awaitable(None)
+        self.fake_client.join.return_value = None
 
         # Pretend that we received an invite event
-        run_coroutine(self.callbacks.invite(fake_room, fake_invite_event))
+        await self.callbacks.invite(fake_room, fake_invite_event)
 
         # Check that we attempted to join the room
         self.fake_client.join.assert_called_once_with(fake_room_id)
 
+    async def test_message_moderated(self):
+        """Tests that regular messages of users are queued for moderation"""
+        await self.callbacks.message(self.room, self._message("@user:example.com"))
+
+        self.fake_pipeline.submit.assert_called_once()
+        self.assertEqual(self.fake_pipeline.submit.call_args.args[0], self.room.room_id)
+
+    async def test_message_skipped(self):
+        """Tests that messages that don't need moderating are rejected early"""
+        for event in (
+            self._message(self.fake_client.user),
+            self._message("@moderator:example.com"),
+            self._message("@user:example.com", thread=True),
+            self._message("@user:example.com", age_ms=10 * 60 * 1000),
+        ):
+            await self.callbacks.message(self.room, event)
+
+        self.fake_pipeline.submit.assert_not_called()
+
+    async def test_message_redelivered(self):
+        """Tests that a redelivered message is only moderated again if it couldn't be
+        moderated before"""
+        event = self._message("@user:example.com")
+        await self.callbacks.message(self.room, event)
+        # Still waiting to be moderated
+        await self.callbacks.message(self.room, event)
+        self.assertEqual(self.fake_pipeline.submit.call_count, 1)
+
+        job = self.fake_pipeline.submit.call_args.args[1]
+        with patch.object(Command, "filter_channel", AsyncMock(side_effect=OSError)):
+            with self.assertRaises(OSError):
+                await job()
+        self.assertFalse(self.fake_storage.processed.contains(event.event_id))
+
+        await self.callbacks.message(self.room, event)
+        self.assertEqual(self.fake_pipeline.submit.call_count, 2)
+        job = self.fake_pipeline.submit.call_args.args[1]
+        with patch.object(Command, "filter_channel", AsyncMock()):
+            await job()
+        self.assertTrue(self.fake_storage.processed.is_processed(event.event_id))
+
+        await self.callbacks.message(self.room, event)
+        self.assertEqual(self.fake_pipeline.submit.call_count, 2)
+
+    async def test_room_lost_while_queued(self):
+        """Tests that a queued job of a room taken over by another worker is left to
+        that worker"""
+        self.callbacks.shards = Mock()
+        self.callbacks.shards.owns.return_value = True
+        event = self._message("@user:example.com")
+        await self.callbacks.message(self.room, event)
+
+        self.callbacks.shards.owns.return_value = False
+        job = self.fake_pipeline.submit.call_args.args[1]
+        with patch.object(Command, "filter_channel", AsyncMock()) as filter_channel:
+            await job()
+        filter_channel.assert_not_called()
+        self.assertFalse(self.fake_storage.processed.contains(event.event_id))
+
+    async def test_message_rules(self):
+        """Tests that thread replies are only moderated for breaking a rule of the
+        room, and that moderators aren't bound by the rules"""
+        store = Mock(spec=Storage)
+        self.callbacks.rules = RuleEngine(store, default={"keywords": ["spam"]})
+
+        for event in (
+            self._message("@user:example.com", thread=True),
+            self._message("@moderator:example.com", thread=True, body="spam"),
+        ):
+            await self.callbacks.message(self.room, event)
+        self.fake_pipeline.submit.assert_not_called()
+
+        # The rules are only checked once per message
+        rules = self.callbacks.rules
+        with patch.object(rules, "check", wraps=rules.check) as check:
+            await self.callbacks.message(
+                self.room, self._message("@user:example.com", thread=True, body="spam")
+            )
+        check.assert_called_once()
+        self.fake_pipeline.submit.assert_called_once()
+        job = self.fake_pipeline.submit.call_args.args[1]
+        self.assertEqual(job.args[0].rule, "keywords")
+
+    async def test_old_message_filtered(self):
+        """Tests that old messages are moderated if filter_old_messages is enabled"""
+        self.fake_config.filter_old_messages = True
+
+        await self.callbacks.message(
+            self.room, self._message("@user:example.com", age_ms=10 * 60 * 1000)
+        )
+
+        self.fake_pipeline.submit.assert_called_once()
+
+    async def test_caught_up_message(self):
+        """Tests that messages sent before the bot started are left to the catch-up
+        of rooms with a checkpoint, and recorded as processed"""
+        self.fake_config.filter_old_messages = True
+        checkpoints = Mock(spec=RoomCheckpoints)
+        checkpoints.covers.return_value = True
+        self.callbacks.checkpoints = checkpoints
+
+        event = self._message("@user:example.com", age_ms=10 * 60 * 1000)
+        await self.callbacks.message(self.room, event)
+
+        self.fake_pipeline.submit.assert_not_called()
+        checkpoints.record.assert_called_once_with(
+            self.room.room_id, event.event_id, event.server_timestamp
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,161 @@
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nio_channel_bot.catchup import CatchUp, RoomCheckpoints
+from nio_channel_bot.storage import Storage
+
+ROOM_ID = "!room:example.com"
+
+
+def _message(i, sender="@user:example.com", ts=None):
+    return nio.RoomMessageText.from_dict(
+        {
+            "type": "m.room.message",
+            "event_id": f"$message{i}",
+            "sender": sender,
+            "origin_server_ts": ts if ts is not None else i,
+            "content": {"msgtype": "m.text", "body": "Hello"},
+        }
+    )
+
+
+class RoomCheckpointsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        await self.store.connect()
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    async def test_record(self):
+        """Tests that only the latest message of each room is stored"""
+        checkpoints = RoomCheckpoints(self.store)
+        await checkpoints.load()
+
+        checkpoints.record(ROOM_ID, "$new", 20)
+        checkpoints.record(ROOM_ID, "$old", 10)
+        await checkpoints.flush()
+
+        self.assertEqual(
+            await self.store.get_room_checkpoints(), {ROOM_ID: ("$new", 20)}
+        )
+
+        # Another process can't move the checkpoint back either
+        await self.store.set_room_checkpoints([(ROOM_ID, "$old", 10)])
+        self.assertEqual(
+            await self.store.get_room_checkpoints(), {ROOM_ID: ("$new", 20)}
+        )
+
+    async def test_held(self):
+        """Tests that checkpoints of rooms being caught up on aren't stored until the
+        rooms have been caught up on"""
+        await self.store.set_room_checkpoints([(ROOM_ID, "$first", 1)])
+        checkpoints = RoomCheckpoints(self.store)
+        await checkpoints.load()
+        self.assertTrue(checkpoints.covers(ROOM_ID, 2))
+        self.assertFalse(checkpoints.covers("!other:example.com", 2))
+        self.assertFalse(checkpoints.covers(ROOM_ID, checkpoints.cutoff))
+
+        checkpoints.hold([ROOM_ID])
+        checkpoints.record(ROOM_ID, "$second", 2)
+        await checkpoints.flush()
+        self.assertEqual(
+            await self.store.get_room_checkpoints(), {ROOM_ID: ("$first", 1)}
+        )
+
+        checkpoints.release(ROOM_ID)
+        await checkpoints.close()
+        self.assertEqual(
+            await self.store.get_room_checkpoints(), {ROOM_ID: ("$second", 2)}
+        )
+
+
+class CatchUpTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        # Async methods of the spec'd client are AsyncMocks, so return values are plain
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.room = nio.MatrixRoom(ROOM_ID, "@bot:example.com")
+        self.fake_client.rooms = {ROOM_ID: self.room}
+        self.fake_client.room_context.return_value = Mock(end="t0")
+
+        self.checkpoints = Mock(spec=RoomCheckpoints)
+        self.checkpoints.initial = {ROOM_ID: ("$checkpoint", 0)}
+        self.checkpoints.cutoff = int(time.time() * 1000)
+
+        self.moderator = Mock()
+        self.moderator.redact_and_mute = AsyncMock(
+            side_effect=lambda room, events, reason: len(events)
+        )
+
+    def _catch_up(self, pages, **kwargs):
+        def room_messages(room_id, start, **kwargs):
+            chunk, end = pages[start]
+            return Mock(chunk=chunk, end=end)
+
+        self.fake_client.room_messages.side_effect = room_messages
+        return CatchUp(
+            self.fake_client,
+            self.checkpoints,
+            self.moderator,
+            lambda room, event: event.sender != "@moderator:example.com",
+            page_size=2,
+            **kwargs,
+        )
+
+    async def test_catch_up(self):
+        """Tests that missed messages are paginated from the checkpoint up to the
+        bot's start, and offending ones redacted in bulk per page"""
+        now = self.checkpoints.cutoff
+        pages = {
+            "t0": ([_message(1), _message(2, "@moderator:example.com")], "t1"),
+            "t1": ([_message(3), _message(4, ts=now)], "t2"),
+        }
+        catchup = self._catch_up(pages)
+
+        await catchup.run()
+
+        self.fake_client.room_context.assert_called_once_with(
+            ROOM_ID, "$checkpoint", limit=0
+        )
+        redacted = [
+            [event.event_id for event in call.args[1]]
+            for call in self.moderator.redact_and_mute.call_args_list
+        ]
+        self.assertEqual(redacted, [["$message1"], ["$message3"]])
+        self.assertEqual((catchup.scanned, catchup.redacted), (3, 2))
+        self.checkpoints.record.assert_called_with(ROOM_ID, "$message3", 3)
+        self.checkpoints.release.assert_called_once_with(ROOM_ID)
+
+    async def test_failed_request(self):
+        """Tests that a room whose messages can't be fetched keeps its checkpoint,
+        so that it is caught up on again at the next start"""
+        catchup = self._catch_up({})
+        self.fake_client.room_messages.side_effect = None
+        self.fake_client.room_messages.return_value = nio.RoomMessagesError("Nope")
+
+        await catchup.run()
+        self.checkpoints.release.assert_not_called()
+
+        self.fake_client.room_context.return_value = nio.RoomContextError("Nope")
+        await catchup.run()
+        self.checkpoints.release.assert_not_called()
+
+    async def test_max_messages(self):
+        """Tests that no more than the maximum amount of messages are caught up on"""
+        pages = {
+            "t0": ([_message(1), _message(2)], "t1"),
+            "t1": ([_message(3), _message(4)], "t2"),
+        }
+        catchup = self._catch_up(pages, max_messages=2)
+
+        await catchup.run()
+
+        self.assertEqual(self.fake_client.room_messages.call_count, 1)
+        self.assertEqual(catchup.scanned, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import gc
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nio_channel_bot.chat_functions import RoomArrivals, RoomFuture, RoomManager
+
+
+class RoomArrivalsTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.rooms = {}
+
+        self.room_id = "!dm:example.com"
+
+    def _sync(self, *room_ids):
+        response = Mock()
+        response.rooms.join = {room_id: Mock() for room_id in room_ids}
+        return response
+
+    async def test_synced_room(self):
+        """Tests that waiting for a room that is already synced doesn't wait"""
+        self.fake_client.rooms[self.room_id] = Mock()
+        arrivals = RoomArrivals(self.fake_client)
+
+        self.assertTrue(arrivals.wait_for(self.room_id).done())
+
+    async def test_arrival(self):
+        """Tests that everyone waiting for a room is resolved by the sync containing it"""
+        arrivals = RoomArrivals(self.fake_client)
+        future = arrivals.wait_for(self.room_id)
+        self.assertIs(arrivals.wait_for(self.room_id), future)
+
+        await arrivals.on_sync(self._sync("!other:example.com"))
+        self.assertFalse(future.done())
+
+        await arrivals.on_sync(self._sync(self.room_id))
+        self.assertEqual(future.result(), self.room_id)
+
+    async def test_timeout(self):
+        """Tests that rooms which aren't synced in time fail their future"""
+        arrivals = RoomArrivals(self.fake_client, timeout=0.01)
+        future = arrivals.wait_for(self.room_id)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await future
+
+    async def test_timeout_not_awaited(self):
+        """Tests that futures nobody awaits don't report their TimeoutError as never
+        retrieved"""
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: errors.append(context)
+        )
+        arrivals = RoomArrivals(self.fake_client, timeout=0.01)
+        future = arrivals.wait_for(self.room_id)
+
+        await asyncio.sleep(0.05)
+        self.assertTrue(future.done())
+        del future
+        gc.collect()
+        self.assertEqual(errors, [])
+
+
+class RoomManagerTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.rooms = {}
+
+        self.fake_chat = Mock()
+        self.fake_chat.send_msg = AsyncMock()
+        self.room_manager = RoomManager(self.fake_chat, self.fake_client, Mock())
+
+        self.room_id = "!dm:example.com"
+        self.mxid = "@user:example.com"
+
+    async def test_send_on_creation(self):
+        """Tests that messages to users are queued in the outbox"""
+        self.fake_chat.outbox.queue = AsyncMock()
+        room_future = RoomFuture(
+            RoomArrivals(self.fake_client), self.mxid, self.room_id
+        )
+
+        await self.room_manager.send_msg_on_creation("image.gif", room_future, True)
+
+        self.fake_chat.outbox.queue.assert_called_once_with(
+            self.mxid, self.room_id, "image.gif", True
+        )
+
+    async def test_single_room_per_user(self):
+        """Tests that concurrent lookups of a user's DM room create a single room"""
+        self.fake_chat.room_arrivals = RoomArrivals(self.fake_client)
+        self.fake_chat.find_private_msg.return_value = None
+        self.fake_chat.create_private_msg = AsyncMock(
+            return_value=nio.RoomCreateResponse(self.room_id)
+        )
+        self.room_manager.store = Mock()
+        self.room_manager.store.get_dm_room = AsyncMock(return_value=None)
+        self.room_manager.store.set_dm_room = AsyncMock()
+
+        first, second = await asyncio.gather(
+            self.room_manager.get_private_room_id(self.mxid),
+            self.room_manager.get_private_room_id(self.mxid),
+        )
+
+        self.assertIs(first, second)
+        self.fake_chat.create_private_msg.assert_called_once()
+        self.fake_chat.room_arrivals.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nio_channel_bot.dm_index import DirectRoomIndex
+from nio_channel_bot.storage import Storage
+
+
+class DirectRoomIndexTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@fake_user:example.com"
+        self.fake_client.rooms = {}
+
+        self.index = DirectRoomIndex(self.fake_client)
+
+    def _make_room(self, room_id: str, *user_ids: str) -> nio.MatrixRoom:
+        room = nio.MatrixRoom(room_id, self.fake_client.user_id)
+        room.add_member(self.fake_client.user_id, None, None)
+        for user_id in user_ids:
+            room.add_member(user_id, None, None)
+        self.fake_client.rooms[room_id] = room
+        return room
+
+    def test_update_room(self):
+        """Tests that only rooms shared with exactly one other user are indexed"""
+        dm = self._make_room("!dm:example.com", "@alice:example.com")
+        group = self._make_room(
+            "!group:example.com", "@alice:example.com", "@bob:example.com"
+        )
+
+        self.index.update_room(dm)
+        self.index.update_room(group)
+
+        self.assertEqual(self.index.get("@alice:example.com"), "!dm:example.com")
+        self.assertIsNone(self.index.get("@bob:example.com"))
+
+    def test_membership_change(self):
+        """Tests that a room stops being indexed once it is no longer a DM"""
+        dm = self._make_room("!dm:example.com", "@alice:example.com")
+        self.index.update_room(dm)
+
+        dm.add_member("@bob:example.com", None, None)
+        self.index.update_room(dm)
+        self.assertIsNone(self.index.get("@alice:example.com"))
+
+    def test_remove_room(self):
+        """Tests that other DM rooms with a user are used once one is removed"""
+        first = self._make_room("!first:example.com", "@alice:example.com")
+        second = self._make_room("!second:example.com", "@alice:example.com")
+        self.index.update_room(first)
+        self.index.update_room(second)
+
+        self.index.remove_room("!first:example.com")
+        self.assertEqual(self.index.get("@alice:example.com"), "!second:example.com")
+
+        self.index.remove_room("!second:example.com")
+        self.assertIsNone(self.index.get("@alice:example.com"))
+
+    def test_seeded_on_first_sync(self):
+        """Tests that the first sync indexes every known room, even quiet ones, and
+        that the DM rooms found are stored"""
+        store = Mock(spec=Storage)
+        store.add_dm_rooms = AsyncMock()
+        index = DirectRoomIndex(self.fake_client, store)
+        self._make_room("!quiet:example.com", "@alice:example.com")
+
+        sync = nio.SyncResponse.from_dict({"next_batch": "s1", "rooms": {}})
+        asyncio.run(index.on_sync(sync))
+        self.assertEqual(index.get("@alice:example.com"), "!quiet:example.com")
+        store.add_dm_rooms.assert_awaited_once_with(
+            {"@alice:example.com": "!quiet:example.com"}
+        )
+
+        # Later syncs only look at the rooms they carry
+        self._make_room("!other:example.com", "@bob:example.com")
+        asyncio.run(index.on_sync(sync))
+        self.assertIsNone(index.get("@bob:example.com"))
+        store.add_dm_rooms.assert_awaited_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from nio_channel_bot.media import MediaCache
+from nio_channel_bot.storage import Storage
+
+
+class MediaCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        await self.store.connect()
+
+        # Async methods of the spec'd client are AsyncMocks, so return values are plain
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.uploads = 0
+        self.fake_client.upload.side_effect = self._upload
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "info.txt")
+        self._write("some text")
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    def _write(self, text: str, mtime_ns: int = 1_000_000_000) -> None:
+        with open(self.path, "w") as f:
+            f.write(text)
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    async def _upload(self, data_provider, content_type, filename, filesize):
+        self.uploads += 1
+        return nio.UploadResponse(f"mxc://example.com/{self.uploads}"), None
+
+    async def test_upload_once(self):
+        """Tests that an unchanged file is uploaded and inspected only once"""
+        cache = MediaCache(self.fake_client, self.store)
+
+        first = await cache.get(self.path)
+        second = await cache.get(self.path)
+
+        self.assertEqual(first.uri, "mxc://example.com/1")
+        self.assertEqual(first.mime_type, "text/plain")
+        self.assertEqual(first.size, len("some text"))
+        self.assertIs(first, second)
+        self.assertEqual(self.uploads, 1)
+
+    async def test_changed_file(self):
+        """Tests that a file is uploaded again once its contents change"""
+        cache = MediaCache(self.fake_client, self.store)
+        first = await cache.get(self.path)
+
+        self._write("some other text", mtime_ns=2_000_000_000)
+        second = await cache.get(self.path)
+
+        self.assertNotEqual(first.sha256, second.sha256)
+        self.assertEqual(second.uri, "mxc://example.com/2")
+        self.assertEqual(self.uploads, 2)
+
+    async def test_stored_uri(self):
+        """Tests that a URI stored by a previous run is reused for the same contents"""
+        await MediaCache(self.fake_client, self.store).get(self.path)
+
+        # Touching the file without changing it doesn't cause another upload
+        self._write("some text", mtime_ns=2_000_000_000)
+        media = await MediaCache(self.fake_client, self.store).get(self.path)
+
+        self.assertEqual(media.uri, "mxc://example.com/1")
+        self.assertEqual(self.uploads, 1)
+
+    async def test_missing_file(self):
+        """Tests that a missing file results in an error instead of an upload"""
+        cache = MediaCache(self.fake_client, self.store)
+
+        response = await cache.get(self.path + ".missing")
+
+        self.assertIsInstance(response, nio.ErrorResponse)
+        self.fake_client.upload.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
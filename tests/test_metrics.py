@@ -0,0 +1,67 @@
+import unittest
+
+from nio_channel_bot import metrics
+from nio_channel_bot.metrics import Registry
+from nio_channel_bot.ratelimit import rate_limiter, with_ratelimit
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_counter(self):
+        """Tests that counters are kept and rendered per label value"""
+        registry = Registry()
+        counter = registry.counter("test_total", "A test counter", ["result"])
+
+        counter.inc(result="ok")
+        counter.inc(2, result="ok")
+        counter.inc(result="error")
+
+        self.assertEqual(counter.get(result="ok"), 3)
+        rendered = registry.render()
+        self.assertIn("# TYPE test_total counter", rendered)
+        self.assertIn('test_total{result="ok"} 3', rendered)
+        self.assertIn('test_total{result="error"} 1', rendered)
+
+    def test_histogram(self):
+        """Tests that histogram buckets are rendered cumulatively"""
+        registry = Registry()
+        histogram = registry.histogram(
+            "test_seconds", "A test histogram", buckets=(1, 5)
+        )
+
+        histogram.observe(0.5)
+        histogram.observe(3)
+        histogram.observe(10)
+
+        rendered = registry.render()
+        self.assertIn('test_seconds_bucket{le="1"} 1', rendered)
+        self.assertIn('test_seconds_bucket{le="5"} 2', rendered)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', rendered)
+        self.assertIn("test_seconds_sum 13.5", rendered)
+        self.assertIn("test_seconds_count 3", rendered)
+
+    def test_duplicate_metric(self):
+        """Tests that a metric can't be registered twice"""
+        registry = Registry()
+        registry.counter("test_total", "A test counter")
+
+        with self.assertRaises(ValueError):
+            registry.counter("test_total", "Another test counter")
+
+
+class RateLimitMetricsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_ratelimit_waits(self):
+        """Tests that the time spent waiting for the rate limiter is recorded"""
+        rate_limiter.configure({"send": {"rate": 100, "burst": 1}})
+        before = metrics.ratelimit_waits.count(endpoint="send")
+
+        async def request():
+            return None
+
+        await with_ratelimit(request)()
+        await with_ratelimit(request)()
+
+        self.assertEqual(metrics.ratelimit_waits.count(endpoint="send"), before + 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from nio_channel_bot.offload import CooperativeYield, LoopMonitor, Offloader
+
+
+class OffloaderTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_bounded_concurrency(self):
+        """Tests that no more than the configured amount of functions run at once,
+        outside of the event loop thread"""
+        offloader = Offloader("thread", workers=2)
+        self.addCleanup(offloader.close)
+
+        running = 0
+        max_running = 0
+        threads = set()
+        lock = threading.Lock()
+
+        def work():
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            threads.add(threading.get_ident())
+            time.sleep(0.01)
+            with lock:
+                running -= 1
+            return "done"
+
+        results = await asyncio.gather(*(offloader.run("test", work) for _ in range(6)))
+
+        self.assertEqual(results, ["done"] * 6)
+        self.assertEqual(max_running, 2)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_unknown_executor(self):
+        """Tests that only known executors can be configured"""
+        with self.assertRaises(ValueError):
+            Offloader().configure("gpu", 4)
+
+
+class LoopMonitorTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_blocked_loop(self):
+        """Tests that the time the loop is blocked for is measured"""
+        monitor = LoopMonitor(interval=0.01, warning_threshold=0.05)
+        monitor.start()
+        await asyncio.sleep(0.02)
+
+        with self.assertLogs("nio_channel_bot.offload", "WARNING"):
+            time.sleep(0.1)
+            await asyncio.sleep(0.02)
+        await monitor.close()
+
+        self.assertGreaterEqual(monitor.max_blocked_seconds, 0.08)
+        self.assertGreaterEqual(monitor.blocked_seconds, monitor.max_blocked_seconds)
+
+
+class CooperativeYieldTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_yield(self):
+        """Tests that other tasks run while events are dispatched, once the loop has
+        been held for the interval"""
+        yielder = CooperativeYield(interval=0.01)
+        ran = asyncio.get_event_loop().create_future()
+        asyncio.get_event_loop().call_soon(ran.set_result, True)
+
+        # Events dispatched in quick succession don't give control back
+        yielder._last_yield = time.monotonic()
+        await yielder.on_event(Mock(), Mock())
+        self.assertFalse(ran.done())
+
+        time.sleep(0.01)
+        await yielder.on_event(Mock(), Mock())
+        self.assertTrue(ran.done())
+
+
+if __name__ == "__main__":
+    unittest.main()
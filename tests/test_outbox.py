@@ -0,0 +1,218 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nio_channel_bot.outbox import WARNING_IMAGE, PersistentOutbox, WarningOutbox
+from nio_channel_bot.storage import Storage
+from nio_channel_bot.templates import RenderedMessage, compile_messages
+
+
+class WarningOutboxTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.fake_room_manager = Mock()
+        self.fake_room_manager.send_msg_on_creation = AsyncMock()
+        self.room_future = Mock()
+        self.messages = compile_messages({"warning": "{count} warnings in {room_name}"})
+
+    def _sent(self):
+        calls = self.fake_room_manager.send_msg_on_creation.call_args_list
+        return [call.args[0] for call in calls]
+
+    async def test_coalesce(self):
+        """Tests that warnings within the window are sent as one message with the final
+        count, and the image only once"""
+        outbox = WarningOutbox(
+            self.fake_room_manager, self.messages, window=0.01, image_period=60
+        )
+
+        for count in (1, 2, 3):
+            await outbox.warn(
+                "@user:example.com",
+                self.room_future,
+                "!room:example.com",
+                "Room",
+                count,
+            )
+        self.fake_room_manager.send_msg_on_creation.assert_not_called()
+
+        await asyncio.sleep(0.05)
+        sent = self._sent()
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(sent[0].body, "3 warnings in Room")
+        self.assertEqual(sent[1], WARNING_IMAGE)
+
+        # The image isn't sent again within its period
+        await outbox.warn(
+            "@user:example.com", self.room_future, "!room:example.com", "Room", 1
+        )
+        await outbox.close()
+        self.assertEqual(len(self._sent()), 3)
+
+    async def test_no_window(self):
+        """Tests that every warning is sent right away without a window"""
+        outbox = WarningOutbox(self.fake_room_manager, self.messages, window=0)
+
+        await outbox.warn(
+            "@user:example.com", self.room_future, "!room:example.com", "Room", 1
+        )
+
+        self.assertEqual(self._sent()[0].body, "1 warnings in Room")
+
+    async def test_rule_warning(self):
+        """Tests that users are told which rule their message broke, without the
+        threads image"""
+        messages = compile_messages({"rule_warning": "{count} in {room_name}: {rule}"})
+        outbox = WarningOutbox(self.fake_room_manager, messages, window=0)
+
+        await outbox.warn(
+            "@user:example.com",
+            self.room_future,
+            "!room:example.com",
+            "Room",
+            1,
+            "keywords",
+        )
+
+        self.assertEqual([sent.body for sent in self._sent()], ["1 in Room: keywords"])
+
+    async def test_ban_drops_warning(self):
+        """Tests that a ban replaces the pending warning of the user"""
+        outbox = WarningOutbox(self.fake_room_manager, self.messages, window=60)
+
+        await outbox.warn(
+            "@user:example.com", self.room_future, "!room:example.com", "Room", 3
+        )
+        await outbox.ban(
+            "@user:example.com", self.room_future, "!room:example.com", "Room", "@admin"
+        )
+        await outbox.close()
+
+        sent = self._sent()
+        self.assertEqual(len(sent), 1)
+        self.assertIn("@admin", sent[0].body)
+
+
+class PersistentOutboxTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        await self.store.connect()
+
+        self.fake_chat = Mock()
+        self.fake_chat.client.rooms = {"!dm:example.com": Mock()}
+        self.fake_chat.send_msg = AsyncMock(
+            return_value=nio.RoomSendResponse("$event", "!dm:example.com")
+        )
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    async def _drain(self, outbox):
+        await outbox.drain()
+        await asyncio.gather(*outbox._tasks)
+
+    async def test_send_after_restart(self):
+        """Tests that queued messages are sent in order by a later run"""
+        first_run = PersistentOutbox(self.fake_chat, self.store)
+        await first_run.queue(
+            "@user:example.com", "!dm:example.com", RenderedMessage("Hi", "<p>Hi</p>")
+        )
+        await first_run.queue(
+            "@user:example.com", "!dm:example.com", WARNING_IMAGE, is_image=True
+        )
+
+        outbox = PersistentOutbox(self.fake_chat, self.store)
+        await self._drain(outbox)
+
+        calls = self.fake_chat.send_msg.call_args_list
+        self.assertEqual(
+            [call.args[:3] for call in calls],
+            [
+                (RenderedMessage("Hi", "<p>Hi</p>"), "!dm:example.com", False),
+                (WARNING_IMAGE, "!dm:example.com", True),
+            ],
+        )
+        self.assertIsNone(await self.store.get_next_message_attempt())
+
+    async def test_retry(self):
+        """Tests that failed messages are retried with the same transaction ID, and
+        dropped after the maximum amount of attempts"""
+        self.fake_chat.send_msg.return_value = nio.RoomSendError("Unavailable")
+        outbox = PersistentOutbox(
+            self.fake_chat, self.store, retry_delay=0, max_attempts=2
+        )
+        await outbox.queue("@user:example.com", "!dm:example.com", "Hi")
+
+        await self._drain(outbox)
+        self.assertIsNotNone(await self.store.get_next_message_attempt())
+        await self._drain(outbox)
+        self.assertIsNone(await self.store.get_next_message_attempt())
+
+        txn_ids = {call.args[3] for call in self.fake_chat.send_msg.call_args_list}
+        self.assertEqual(self.fake_chat.send_msg.call_count, 2)
+        self.assertEqual(len(txn_ids), 1)
+
+    async def test_retry_keeps_order(self):
+        """Tests that the later messages of a room wait for an earlier one that is
+        waiting to be retried"""
+        send_msg = self.fake_chat.send_msg
+        sent = send_msg.return_value
+        send_msg.return_value = nio.RoomSendError("Unavailable")
+        outbox = PersistentOutbox(self.fake_chat, self.store, retry_delay=60)
+        await outbox.queue("@user:example.com", "!dm:example.com", "Warning")
+        await self._drain(outbox)
+
+        send_msg.return_value = sent
+        await outbox.queue("@user:example.com", "!dm:example.com", "Ban")
+        await self._drain(outbox)
+        self.assertEqual(send_msg.call_count, 1)
+
+        # The room's messages are sent in order once the first one is due again
+        next_attempt_at = await self.store.get_next_message_attempt()
+        self.assertGreater(next_attempt_at, time.time() * 1000)
+        await self.store._execute("UPDATE outbox SET next_attempt_at = 0")
+        await self._drain(outbox)
+        self.assertEqual(
+            [call.args[0] for call in send_msg.call_args_list],
+            ["Warning", "Warning", "Ban"],
+        )
+        self.assertIsNone(await self.store.get_next_message_attempt())
+
+    async def test_shards(self):
+        """Tests that a sharded outbox only sends the messages of rooms it owns"""
+        shards = Mock()
+        shards.shard_of = lambda room_id: 1
+        shards.owned = frozenset({0})
+        shards.owns = lambda room_id: 1 in shards.owned
+        outbox = PersistentOutbox(self.fake_chat, self.store, shards=shards)
+        await outbox.queue("@user:example.com", "!dm:example.com", "Hi")
+
+        # Messages queued by other workers are looked for again later
+        self.assertEqual(await outbox.drain(), outbox.poll_interval)
+        self.fake_chat.send_msg.assert_not_called()
+
+        shards.owned = frozenset({0, 1})
+        await self._drain(outbox)
+        self.fake_chat.send_msg.assert_called_once()
+
+    async def test_shard_lost_before_sending(self):
+        """Tests that the messages of a room taken over by another worker after they
+        were read are left to that worker"""
+        shards = Mock()
+        shards.shard_of = lambda room_id: 1
+        shards.owned = frozenset({1})
+        shards.owns = lambda room_id: False
+        outbox = PersistentOutbox(self.fake_chat, self.store, shards=shards)
+        await outbox.queue("@user:example.com", "!dm:example.com", "Hi")
+
+        await self._drain(outbox)
+        self.fake_chat.send_msg.assert_not_called()
+        # The message is still queued, without counting as a failed attempt
+        row = await self.store._fetchone("SELECT attempts FROM outbox")
+        self.assertEqual(row[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
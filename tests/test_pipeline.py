@@ -0,0 +1,114 @@
+import asyncio
+import unittest
+
+from nio_channel_bot.pipeline import ModerationPipeline
+
+
+class ModerationPipelineTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_room_order(self):
+        """Tests that the jobs of a room are run one at a time, in order"""
+        pipeline = ModerationPipeline(workers=4)
+        pipeline.start()
+
+        results = []
+
+        def make_job(i):
+            async def job():
+                await asyncio.sleep(0)
+                results.append(i)
+
+            return job
+
+        for i in range(20):
+            await pipeline.submit("!room:example.com", make_job(i))
+        await pipeline.close()
+
+        self.assertEqual(results, list(range(20)))
+        self.assertEqual(pipeline.processed, 20)
+
+    async def test_rooms_run_concurrently(self):
+        """Tests that a slow room doesn't hold up the jobs of other rooms"""
+        pipeline = ModerationPipeline(workers=2)
+        pipeline.start()
+
+        slow_room_done = asyncio.Event()
+        fast_room_done = asyncio.Event()
+
+        async def slow_job():
+            await fast_room_done.wait()
+            slow_room_done.set()
+
+        async def fast_job():
+            fast_room_done.set()
+
+        await pipeline.submit("!slow:example.com", slow_job)
+        await pipeline.submit("!fast:example.com", fast_job)
+        await asyncio.wait_for(slow_room_done.wait(), 1)
+        await pipeline.close()
+
+    async def test_backpressure(self):
+        """Tests that submitting to a full queue waits, and is counted"""
+        pipeline = ModerationPipeline(workers=1, max_queue_size=1)
+
+        async def job():
+            pass
+
+        await pipeline.submit("!room:example.com", job)
+
+        # The queue is full, and no workers are running to drain it yet
+        submit = asyncio.ensure_future(pipeline.submit("!room:example.com", job))
+        await asyncio.sleep(0)
+        self.assertFalse(submit.done())
+
+        pipeline.start()
+        await asyncio.wait_for(submit, 1)
+        await pipeline.close()
+
+        self.assertEqual(pipeline.blocked, 1)
+        self.assertEqual(pipeline.processed, 2)
+        self.assertFalse(pipeline._queues)
+
+    async def test_drained_queues_removed(self):
+        """Tests that the queue of a room is removed once drained, and created again
+        for the next job of the room"""
+        pipeline = ModerationPipeline(workers=2)
+        pipeline.start()
+
+        done = []
+
+        async def job():
+            done.append(True)
+
+        for i in range(50):
+            await pipeline.submit(f"!room{i}:example.com", job)
+        await pipeline.close()
+        self.assertEqual(len(done), 50)
+        self.assertFalse(pipeline._queues)
+
+        pipeline.start()
+        await pipeline.submit("!room0:example.com", job)
+        await pipeline.close()
+        self.assertEqual(len(done), 51)
+        self.assertFalse(pipeline._queues)
+
+    async def test_failed_job(self):
+        """Tests that a failing job doesn't stop the worker"""
+        pipeline = ModerationPipeline(workers=1)
+        pipeline.start()
+
+        async def failing_job():
+            raise RuntimeError("Failed")
+
+        async def job():
+            pass
+
+        await pipeline.submit("!room:example.com", failing_job)
+        await pipeline.submit("!room:example.com", job)
+        await pipeline.close()
+
+        self.assertEqual(pipeline.failed, 1)
+        self.assertEqual(pipeline.processed, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
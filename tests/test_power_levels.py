@@ -0,0 +1,100 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from nio_channel_bot.power_levels import PowerLevelCache
+from nio_channel_bot.ratelimit import rate_limiter
+
+
+class PowerLevelCacheTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        # Async methods of the spec'd client are AsyncMocks, so return values are plain
+        rate_limiter.configure({"state": {"rate": 100, "burst": 100}})
+
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.rooms = {}
+
+        self.room_id = "!abcdefg:example.com"
+        self.content = {"users": {"@admin:example.com": 100}, "events_default": 0}
+
+    def _put_state(self, room_id, event_type, content):
+        return nio.RoomPutStateResponse("$new_event", room_id)
+
+    async def test_cached_content(self):
+        """Tests that cached power levels are updated with a single PUT"""
+        self.fake_client.room_put_state.side_effect = self._put_state
+        cache = PowerLevelCache(self.fake_client)
+        cache.update(self.room_id, self.content, "$event")
+
+        response = await cache.set_user_power(self.room_id, "@user:example.com", -1)
+
+        self.assertIsInstance(response, nio.RoomPutStateResponse)
+        self.fake_client.room_get_state_event.assert_not_called()
+        sent_content = self.fake_client.room_put_state.call_args.kwargs["content"]
+        self.assertEqual(
+            sent_content["users"],
+            {"@admin:example.com": 100, "@user:example.com": -1},
+        )
+        # The original content is left untouched
+        self.assertNotIn("@user:example.com", self.content["users"])
+
+    async def test_fetch_uncached_content(self):
+        """Tests that power levels are fetched once if they were never synced"""
+        self.fake_client.room_get_state_event.return_value = (
+            nio.RoomGetStateEventResponse(
+                self.content, "m.room.power_levels", "", self.room_id
+            )
+        )
+        self.fake_client.room_put_state.side_effect = self._put_state
+        cache = PowerLevelCache(self.fake_client)
+
+        await cache.set_user_power(self.room_id, "@first:example.com", -1)
+        await cache.set_user_power(self.room_id, "@second:example.com", -1)
+
+        self.fake_client.room_get_state_event.assert_called_once()
+        self.assertEqual(self.fake_client.room_put_state.call_count, 2)
+
+    async def test_batch(self):
+        """Tests that changes within the batch window are sent in a single update"""
+        self.fake_client.room_put_state.side_effect = self._put_state
+        cache = PowerLevelCache(self.fake_client, batch_window=0.01)
+        cache.update(self.room_id, self.content, "$event")
+
+        responses = await asyncio.gather(
+            cache.set_user_power(self.room_id, "@first:example.com", -1),
+            cache.set_user_power(self.room_id, "@second:example.com", -1),
+        )
+
+        self.assertIs(responses[0], responses[1])
+        self.fake_client.room_put_state.assert_called_once()
+        sent_content = self.fake_client.room_put_state.call_args.kwargs["content"]
+        self.assertEqual(sent_content["users"]["@first:example.com"], -1)
+        self.assertEqual(sent_content["users"]["@second:example.com"], -1)
+
+    async def test_moderators(self):
+        """Tests that moderator lists are derived once, until the power levels change"""
+        cache = PowerLevelCache(self.fake_client)
+        cache.update(
+            self.room_id,
+            {"users": {"@mod:example.com": 50, "@admin:example.com": 100}},
+            "$event",
+        )
+
+        admins = await cache.get_moderators(self.room_id, 100)
+        self.assertEqual(admins, ("@admin:example.com",))
+        self.assertIs(await cache.get_moderators(self.room_id, 100), admins)
+        self.assertEqual(
+            await cache.get_moderators(self.room_id, 50),
+            ("@admin:example.com", "@mod:example.com"),
+        )
+
+        cache.update(self.room_id, {"users": {"@new:example.com": 100}}, "$new_event")
+        self.assertEqual(
+            await cache.get_moderators(self.room_id, 100), ("@new:example.com",)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
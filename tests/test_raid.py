@@ -0,0 +1,262 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+import nio
+
+from nio_channel_bot.pipeline import ModerationPipeline
+from nio_channel_bot.power_levels import PowerLevelCache
+from nio_channel_bot.raid import BulkModerator, RaidDetector, RaidMode
+from nio_channel_bot.ratelimit import rate_limiter
+from nio_channel_bot.storage import FailCounterCache, ProcessedEventCache, Storage
+
+
+class RaidDetectorTestCase(unittest.TestCase):
+    def test_threshold(self):
+        """Tests that a room is raided once enough messages arrive within the window"""
+        detector = RaidDetector(threshold=3, window=10, cooldown=60)
+
+        self.assertFalse(detector.record("!room:example.com", now=0))
+        self.assertFalse(detector.record("!room:example.com", now=5))
+        self.assertTrue(detector.record("!room:example.com", now=9))
+        self.assertFalse(detector.is_raided("!other:example.com", now=9))
+
+    def test_window(self):
+        """Tests that messages spread over more than the window don't start a raid"""
+        detector = RaidDetector(threshold=3, window=10, cooldown=60)
+
+        for now in (0, 6, 12, 18):
+            self.assertFalse(detector.record("!room:example.com", now=now))
+
+    def test_cooldown(self):
+        """Tests that a raid lasts until the threshold hasn't been reached for the cooldown"""
+        detector = RaidDetector(threshold=2, window=10, cooldown=60)
+        detector.record("!room:example.com", now=0)
+        detector.record("!room:example.com", now=1)
+
+        self.assertTrue(detector.is_raided("!room:example.com", now=60))
+        self.assertFalse(detector.is_raided("!room:example.com", now=61))
+
+        # A single message doesn't extend the raid, reaching the threshold again does
+        detector.record("!room:example.com", now=50)
+        self.assertEqual(detector.ends_at("!room:example.com"), 61)
+        detector.record("!room:example.com", now=55)
+        self.assertEqual(detector.ends_at("!room:example.com"), 115)
+
+
+class RaidModeTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        # Async methods of the spec'd client are AsyncMocks, so return values are plain
+        rate_limiter.configure(
+            {
+                "redact": {"rate": 1000, "burst": 1000},
+                "state": {"rate": 1000, "burst": 1000},
+            }
+        )
+
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user = self.fake_client.user_id = "@bot:example.com"
+        self.fake_client.rooms = {}
+        self.fake_client.room_redact.side_effect = (
+            lambda room_id, event_id, reason: nio.RoomRedactResponse(
+                "$redaction", room_id
+            )
+        )
+        self.fake_client.room_put_state.side_effect = (
+            lambda room_id, event_type, content: nio.RoomPutStateResponse(
+                "$power_levels", room_id
+            )
+        )
+
+        self.fake_storage = Mock(spec=Storage)
+        self.fake_storage.get_fail.return_value = 0
+        self.fake_storage.fails = FailCounterCache(self.fake_storage)
+        self.fake_storage.processed = ProcessedEventCache(self.fake_storage)
+
+        self.fake_chat = Mock()
+        self.fake_chat.power_levels = PowerLevelCache(self.fake_client)
+        self.fake_chat.room_state.load = AsyncMock()
+
+        self.room = nio.MatrixRoom("!room:example.com", self.fake_client.user)
+        for user_id in (self.fake_client.user, "@a:example.com", "@b:example.com"):
+            self.room.add_member(user_id, None, None)
+        self.room.power_levels.users[self.fake_client.user] = 100
+        self.fake_chat.power_levels.update(
+            self.room.room_id,
+            {"users": {self.fake_client.user: 100}, "events_default": 0},
+            "$event",
+        )
+
+    def _message(self, sender, i):
+        return nio.RoomMessageText.from_dict(
+            {
+                "type": "m.room.message",
+                "event_id": f"$message{i}",
+                "sender": sender,
+                "origin_server_ts": int(time.time() * 1000),
+                "content": {"msgtype": "m.text", "body": "Spam"},
+            }
+        )
+
+    async def test_batch(self):
+        """Tests that messages of a raided room are redacted in a single job, and
+        offenders muted in a single update"""
+        pipeline = ModerationPipeline()
+        raid = RaidMode(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_chat,
+            RaidDetector(threshold=1),
+            pipeline,
+        )
+
+        senders = ["@a:example.com"] * 6 + ["@b:example.com"]
+        for i, sender in enumerate(senders):
+            self.assertTrue(raid.record(self.room.room_id))
+            await raid.moderate(self.room, self._message(sender, i))
+
+        # Every message is waiting in the same job
+        self.assertEqual(pipeline.submitted, 1)
+        pipeline.start()
+        await pipeline.close()
+        await raid.close()
+
+        self.assertEqual(self.fake_client.room_redact.call_count, 7)
+        self.fake_client.room_put_state.assert_called_once()
+        sent_content = self.fake_client.room_put_state.call_args.kwargs["content"]
+        self.assertEqual(sent_content["users"]["@a:example.com"], -1)
+        self.assertNotIn("@b:example.com", sent_content["users"])
+
+        self.assertEqual(
+            await self.fake_storage.fails.get("@a:example.com", self.room.room_id), 0
+        )
+        self.assertEqual(
+            await self.fake_storage.fails.get("@b:example.com", self.room.room_id), 1
+        )
+        # No warnings are sent during a raid
+        self.fake_client.room_send.assert_not_called()
+        self.assertTrue(self.fake_storage.processed.is_processed("$message0"))
+
+    async def test_processed(self):
+        """Tests that messages already moderated aren't redacted again, and that
+        messages that couldn't be redacted aren't recorded as processed"""
+        moderator = BulkModerator(self.fake_client, self.fake_storage, self.fake_chat)
+        self.fake_storage.processed.complete("$message0")
+        self.fake_client.room_redact.side_effect = (
+            lambda room_id, event_id, reason: nio.RoomRedactError("Failed")
+        )
+
+        events = [self._message("@a:example.com", i) for i in range(2)]
+        self.fake_storage.processed.claim("$message1")
+        self.assertEqual(await moderator.redact_and_mute(self.room, events), 0)
+
+        self.fake_client.room_redact.assert_called_once()
+        self.assertEqual(self.fake_client.room_redact.call_args.args[1], "$message1")
+        self.assertFalse(self.fake_storage.processed.contains("$message1"))
+
+    async def test_lockdown(self):
+        """Tests that a raided room is locked down until the raid is over"""
+        raid = RaidMode(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_chat,
+            RaidDetector(threshold=2, window=10, cooldown=0.05),
+            lockdown_level=50,
+        )
+
+        raid.record(self.room.room_id)
+        self.assertTrue(raid.record(self.room.room_id))
+
+        # Wait for the raid to end rather than for a fixed time, so that a slow run
+        # can't skip past the lockdown
+        for _ in range(100):
+            if not raid.is_raided(self.room.room_id):
+                break
+            await asyncio.sleep(0.01)
+        self.assertFalse(raid.is_raided(self.room.room_id))
+
+        self.assertEqual(
+            [
+                call.kwargs["content"]["events_default"]
+                for call in self.fake_client.room_put_state.call_args_list
+            ],
+            [50, 0],
+        )
+
+        self.fake_storage.set_raid_lockdown.assert_called_once_with(
+            self.room.room_id, 0, 50
+        )
+        self.fake_storage.delete_raid_lockdown.assert_called_once_with(
+            self.room.room_id
+        )
+
+    async def test_lockdown_interrupted(self):
+        """Tests that the lockdown of a room is lifted even if the bot stops while the
+        room is being locked down"""
+        applied = {"events_default": 0}
+        locking = asyncio.Event()
+
+        async def room_put_state(room_id, event_type, content):
+            # The homeserver applies the lockdown, but the response never arrives
+            applied["events_default"] = content["events_default"]
+            if content["events_default"] == 50:
+                locking.set()
+                await asyncio.sleep(10)
+            return nio.RoomPutStateResponse("$power_levels", room_id)
+
+        self.fake_client.room_put_state.side_effect = room_put_state
+        self.fake_client.room_get_state_event.side_effect = (
+            lambda room_id, event_type: nio.RoomGetStateEventResponse(
+                dict(applied), event_type, "", room_id
+            )
+        )
+        raid = RaidMode(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_chat,
+            RaidDetector(threshold=2, window=10, cooldown=60),
+            lockdown_level=50,
+        )
+
+        raid.record(self.room.room_id)
+        raid.record(self.room.room_id)
+        await asyncio.wait_for(locking.wait(), 1)
+        await raid.close()
+
+        self.assertEqual(applied["events_default"], 0)
+        self.fake_storage.delete_raid_lockdown.assert_called_once_with(
+            self.room.room_id
+        )
+
+    async def test_stale_lockdown(self):
+        """Tests that the lockdowns left by a previous run are lifted"""
+        self.fake_storage.get_raid_lockdowns.return_value = {self.room.room_id: (0, 50)}
+        self.fake_chat.power_levels.update(
+            self.room.room_id,
+            {"users": {self.fake_client.user: 100}, "events_default": 50},
+            "$event",
+        )
+        raid = RaidMode(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_chat,
+            RaidDetector(),
+            lockdown_level=50,
+        )
+
+        await raid.lift_stale_lockdowns()
+
+        self.assertEqual(
+            self.fake_client.room_put_state.call_args.kwargs["content"][
+                "events_default"
+            ],
+            0,
+        )
+        self.fake_storage.delete_raid_lockdown.assert_called_once_with(
+            self.room.room_id
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import time
+import unittest
+
+import nio
+
+from nio_channel_bot.ratelimit import TokenBucket, rate_limiter, with_ratelimit
+
+
+class TokenBucketTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_burst(self):
+        """Tests that requests within the burst size are not delayed"""
+        bucket = TokenBucket(rate=1, burst=5)
+
+        start = time.monotonic()
+        for _ in range(5):
+            await bucket.acquire()
+
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(bucket.waits, 0)
+
+    async def test_pacing(self):
+        """Tests that requests beyond the burst size are paced at the bucket's rate"""
+        bucket = TokenBucket(rate=50, burst=1)
+
+        start = time.monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+
+        # 5 requests had to wait for a token, refilled every 20ms
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(bucket.waits, 5)
+
+    async def test_rate_limited(self):
+        """Tests that being rate limited pauses the bucket and halves its rate"""
+        bucket = TokenBucket(rate=100, burst=10)
+
+        bucket.on_rate_limited(100)
+        self.assertEqual(bucket.rate, 50)
+
+        start = time.monotonic()
+        await bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+        # Successful requests recover the configured rate
+        for _ in range(20):
+            bucket.on_success()
+        self.assertEqual(bucket.rate, 100)
+
+
+class WithRatelimitTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_retry(self):
+        """Tests that rate limited requests are retried"""
+        rate_limiter.configure({"send": {"rate": 100, "burst": 10}})
+        responses = [
+            nio.RoomSendError("Too many requests", "M_LIMIT_EXCEEDED", 10),
+            "success",
+        ]
+
+        async def request():
+            return responses.pop(0)
+
+        response = await with_ratelimit(request, endpoint="send")()
+
+        self.assertEqual(response, "success")
+        self.assertEqual(rate_limiter.bucket("send").rate_limited, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from nio_channel_bot.reconnect import ReconnectBackoff
+
+
+class ReconnectBackoffTestCase(unittest.TestCase):
+    def test_exponential_backoff(self):
+        """Tests that the delay doubles with each failure, up to the maximum"""
+        # Without jitter, each delay is half of the full delay
+        backoff = ReconnectBackoff(base_delay=1, max_delay=8, rng=lambda: 0)
+
+        delays = [backoff.on_failure() for _ in range(6)]
+
+        self.assertEqual(delays, [0.5, 1, 2, 4, 4, 4])
+
+    def test_jitter(self):
+        """Tests that up to half of the delay is random"""
+        backoff = ReconnectBackoff(base_delay=4, rng=lambda: 0.5)
+
+        self.assertEqual(backoff.on_failure(), 3)
+
+    def test_circuit_breaker(self):
+        """Tests that the cooldown is used after too many failures, until a success"""
+        backoff = ReconnectBackoff(
+            base_delay=1, failure_threshold=3, cooldown=100, rng=lambda: 0
+        )
+
+        backoff.on_failure()
+        backoff.on_failure()
+        self.assertFalse(backoff.is_open)
+
+        self.assertEqual(backoff.on_failure(), 50)
+        self.assertTrue(backoff.is_open)
+        self.assertEqual(backoff.on_failure(), 50)
+
+        backoff.on_success()
+        self.assertFalse(backoff.is_open)
+        self.assertEqual(backoff.on_failure(), 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
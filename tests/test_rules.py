@@ -0,0 +1,198 @@
+import re
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from nio_channel_bot.errors import ConfigError
+from nio_channel_bot.rules import (
+    RULES_EVENT_TYPE,
+    CompiledRules,
+    RuleEngine,
+    _keyword_pattern,
+)
+from nio_channel_bot.storage import Storage
+
+ROOM_ID = "!room:example.com"
+
+
+def _text(body, **content):
+    return nio.RoomMessageText.from_dict(
+        {
+            "type": "m.room.message",
+            "event_id": "$text",
+            "sender": "@user:example.com",
+            "origin_server_ts": 1,
+            "content": dict(content, msgtype="m.text", body=body),
+        }
+    )
+
+
+def _image(mimetype):
+    return nio.RoomMessageImage.from_dict(
+        {
+            "type": "m.room.message",
+            "event_id": "$image",
+            "sender": "@user:example.com",
+            "origin_server_ts": 1,
+            "content": {
+                "msgtype": "m.image",
+                "body": "image.gif",
+                "url": "mxc://example.com/image",
+                "info": {"mimetype": mimetype},
+            },
+        }
+    )
+
+
+def _rules_sync(event_id, content):
+    return nio.SyncResponse.from_dict(
+        {
+            "next_batch": "s1",
+            "rooms": {
+                "join": {
+                    ROOM_ID: {
+                        "timeline": {
+                            "events": [
+                                {
+                                    "type": RULES_EVENT_TYPE,
+                                    "state_key": "",
+                                    "event_id": event_id,
+                                    "sender": "@moderator:example.com",
+                                    "origin_server_ts": 1,
+                                    "content": content,
+                                }
+                            ]
+                        }
+                    }
+                }
+            },
+        }
+    )
+
+
+class CompiledRulesTestCase(unittest.TestCase):
+    def test_keyword_pattern(self):
+        """Tests that keywords sharing prefixes are merged into a single trie"""
+        pattern = _keyword_pattern(["spam", "spammer", "span", "eggs"])
+        self.assertEqual(pattern, "(?:eggs|spa(?:m(?:mer)?|n))")
+
+        matcher = re.compile(f"^{pattern}$")
+        for word in ("spam", "spammer", "span", "eggs"):
+            self.assertTrue(matcher.match(word))
+        for word in ("spa", "spamm", "egg"):
+            self.assertFalse(matcher.match(word))
+
+    def test_check(self):
+        """Tests that messages are checked against every kind of rule"""
+        rules = CompiledRules(
+            {
+                "keywords": ["Buy now", "spam"],
+                "patterns": [r"t\.me/\w+"],
+                "max_links": 1,
+                "max_mentions": 1,
+                "blocked_media": ["image/*", "m.video"],
+            }
+        )
+
+        self.assertEqual(rules.check(_text("Please BUY NOW!")), "keywords")
+        # Keywords only match whole words
+        self.assertIsNone(rules.check(_text("I love spamming")))
+        self.assertEqual(rules.check(_text("Join t.me/channel")), "patterns")
+        self.assertEqual(
+            rules.check(_text("https://a.com and http://b.com")), "max_links"
+        )
+        self.assertEqual(
+            rules.check(_text("@a:example.com @b:example.com")), "max_mentions"
+        )
+        self.assertEqual(
+            rules.check(_text("Hi", **{"m.mentions": {"user_ids": ["@a:x", "@b:x"]}})),
+            "max_mentions",
+        )
+        self.assertEqual(rules.check(_image("image/gif")), "blocked_media")
+        self.assertIsNone(rules.check(_text("A perfectly fine message")))
+
+    def test_invalid(self):
+        """Tests that invalid rule sets are rejected"""
+        for rules in (
+            {"unknown": []},
+            {"keywords": "spam"},
+            {"patterns": ["("]},
+            {"max_links": -1},
+            {"max_mentions": True},
+            [],
+        ):
+            with self.assertRaises(ConfigError):
+                CompiledRules(rules)
+
+
+class RuleEngineTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        await self.store.connect()
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    async def test_rules_for(self):
+        """Tests that rooms use their configured rules, or the default ones"""
+        engine = RuleEngine(
+            self.store,
+            default={"keywords": ["spam"]},
+            rooms={ROOM_ID: {"keywords": ["eggs"]}},
+        )
+
+        self.assertEqual(engine.check(ROOM_ID, _text("eggs")), "keywords")
+        self.assertIsNone(engine.check(ROOM_ID, _text("spam")))
+        self.assertEqual(engine.check("!other:example.com", _text("spam")), "keywords")
+
+        # Rooms without any rules skip checking
+        self.assertIsNone(RuleEngine(self.store).rules_for(ROOM_ID))
+
+    async def test_recompiled_on_change(self):
+        """Tests that the compiled rules of a room are cached until its state event
+        changes, and that the rules set in rooms are stored"""
+        engine = RuleEngine(self.store, default={"keywords": ["spam"]})
+        compiled = engine.rules_for(ROOM_ID)
+        self.assertIs(engine.rules_for(ROOM_ID), compiled)
+
+        await engine.on_sync(_rules_sync("$rules1", {"keywords": ["eggs"]}))
+        compiled = engine.rules_for(ROOM_ID)
+        self.assertEqual(engine.check(ROOM_ID, _text("eggs")), "keywords")
+
+        # The same event synced again doesn't recompile the rules
+        await engine.on_sync(_rules_sync("$rules1", {"keywords": ["eggs"]}))
+        self.assertIs(engine.rules_for(ROOM_ID), compiled)
+
+        # The rules are loaded back on startup
+        restarted = RuleEngine(self.store, default={"keywords": ["spam"]})
+        await restarted.load()
+        self.assertEqual(restarted.check(ROOM_ID, _text("eggs")), "keywords")
+
+        # An empty state event goes back to the configured rules
+        await engine.on_sync(_rules_sync("$rules2", {}))
+        self.assertEqual(engine.check(ROOM_ID, _text("spam")), "keywords")
+        self.assertEqual(await self.store.get_room_rules(), {})
+
+    async def test_invalid_state_event(self):
+        """Tests that invalid rules set in a room fall back to the configured ones"""
+        engine = RuleEngine(self.store, default={"keywords": ["spam"]})
+
+        await engine.on_sync(_rules_sync("$rules", {"patterns": ["("]}))
+        with self.assertLogs("nio_channel_bot.rules", "WARNING"):
+            self.assertEqual(engine.check(ROOM_ID, _text("spam")), "keywords")
+
+    async def test_state_events_disabled(self):
+        """Tests that rules set in rooms are ignored if disabled"""
+        store = Mock(spec=Storage)
+        engine = RuleEngine(store, default={"keywords": ["spam"]}, state_events=False)
+
+        await engine.load()
+        await engine.on_sync(_rules_sync("$rules", {"keywords": ["eggs"]}))
+
+        self.assertIsNone(engine.check(ROOM_ID, _text("eggs")))
+        store.get_room_rules.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
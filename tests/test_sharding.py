@@ -0,0 +1,98 @@
+import asyncio
+import unittest
+
+from nio_channel_bot.sharding import ShardCoordinator, preferred_worker, shard_of
+from nio_channel_bot.storage import Storage
+
+
+class ShardingTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        await self.store.connect()
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    def test_preferred_worker(self):
+        """Tests that only the shards of a leaving worker move to another worker"""
+        workers = ["a", "b", "c"]
+        before = {shard: preferred_worker(shard, workers) for shard in range(64)}
+        after = {shard: preferred_worker(shard, ["a", "b"]) for shard in range(64)}
+
+        for shard in range(64):
+            if before[shard] != "c":
+                self.assertEqual(after[shard], before[shard])
+        self.assertEqual(len(set(before.values())), 3)
+
+    async def test_split_and_take_over(self):
+        """Tests that live workers split the shards, and take over those of a worker
+        that stops"""
+        a = ShardCoordinator(self.store, "a", shards=16)
+        b = ShardCoordinator(self.store, "b", shards=16)
+
+        await a.rebalance()
+        self.assertEqual(a.owned, frozenset(range(16)))
+
+        # b can only take the shards a has released
+        await b.rebalance()
+        self.assertFalse(b.owned)
+        await a.rebalance()
+        await b.rebalance()
+        self.assertTrue(a.owned)
+        self.assertTrue(b.owned)
+        self.assertFalse(a.owned & b.owned)
+        self.assertEqual(a.owned | b.owned, frozenset(range(16)))
+
+        room_id = "!room:example.com"
+        self.assertNotEqual(a.owns(room_id), b.owns(room_id))
+        self.assertEqual(a.shard_of(room_id), shard_of(room_id, 16))
+
+        await a.close()
+        await b.rebalance()
+        self.assertEqual(b.owned, frozenset(range(16)))
+
+    async def test_expired_lease(self):
+        """Tests that the leases of a worker that died are taken over once expired"""
+        a = ShardCoordinator(self.store, "a", shards=4, lease_seconds=0.01)
+        await a.rebalance()
+        self.assertEqual(a.owned, frozenset(range(4)))
+        await asyncio.sleep(0.02)
+
+        b = ShardCoordinator(self.store, "b", shards=4)
+        await b.rebalance()
+        self.assertEqual(b.owned, frozenset(range(4)))
+
+        # a notices it lost its shards the next time it renews them
+        await a.rebalance()
+        self.assertFalse(a.owned & b.owned)
+
+    async def test_stalled_worker(self):
+        """Tests that a worker stops handling its rooms once its leases may have
+        expired, even if it hasn't been able to renew them since"""
+        a = ShardCoordinator(self.store, "a", shards=4, lease_seconds=0.06)
+        await a.rebalance()
+        self.assertTrue(a.owns("!room:example.com"))
+
+        # The safety margin is left before the lease expires
+        await asyncio.sleep(0.05)
+        self.assertEqual(a.owned, frozenset(range(4)))
+        self.assertFalse(a.owns("!room:example.com"))
+
+        await a.rebalance()
+        self.assertTrue(a.owns("!room:example.com"))
+
+    async def test_lost_fail_counters(self):
+        """Tests that the fail counters of lost rooms are written out and evicted"""
+        a = ShardCoordinator(self.store, "a", shards=1)
+        await a.rebalance()
+        await self.store.fails.increment("@user:example.com", "!room:example.com")
+
+        await a.close()
+        self.assertEqual(
+            await self.store.get_fail("@user:example.com", "!room:example.com"), 1
+        )
+        self.assertFalse(self.store.fails._counters)
+
+
+if __name__ == "__main__":
+    unittest.main()
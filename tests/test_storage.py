@@ -0,0 +1,228 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from nio_channel_bot.storage import (
+    FailCounterCache,
+    ProcessedEventCache,
+    Storage,
+    _to_postgres_placeholders,
+    latest_migration_version,
+)
+
+
+class StorageTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        # An in-memory SQLite database is created from scratch for every test
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        await self.store.connect()
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    async def test_migrations(self):
+        """Tests that a fresh database is migrated to the latest version"""
+        row = await self.store._fetchone("SELECT version FROM migration_version")
+        self.assertEqual(row[0], latest_migration_version)
+
+    async def test_fails(self):
+        """Tests incrementing, reading and deleting fail counters"""
+        user_id = "@some_user:example.com"
+        room_id = "!abcdefg:example.com"
+
+        self.assertEqual(await self.store.get_fail(user_id, room_id), 0)
+
+        await self.store.update_or_create_fail(user_id, room_id)
+        await self.store.update_or_create_fail(user_id, room_id)
+        self.assertEqual(await self.store.get_fail(user_id, room_id), 2)
+
+        # Counters are kept per room
+        self.assertEqual(await self.store.get_fail(user_id, "!other:example.com"), 0)
+
+        await self.store.delete_fail(user_id, room_id)
+        self.assertEqual(await self.store.get_fail(user_id, room_id), 0)
+
+    async def test_uris(self):
+        """Tests storing and retrieving uploaded media uris"""
+        filename = "media/info_threads.gif"
+        self.assertIsNone(await self.store.get_uri(filename, "hash1"))
+
+        await self.store.set_uri(filename, "mxc://example.com/abc", "hash1")
+        self.assertEqual(
+            await self.store.get_uri(filename, "hash1"), "mxc://example.com/abc"
+        )
+
+        # A URI is only returned for the contents it was uploaded with
+        self.assertIsNone(await self.store.get_uri(filename, "hash2"))
+
+        await self.store.set_uri(filename, "mxc://example.com/def", "hash2")
+        self.assertIsNone(await self.store.get_uri(filename, "hash1"))
+        self.assertEqual(
+            await self.store.get_uri(filename, "hash2"), "mxc://example.com/def"
+        )
+
+    async def test_sync_filters(self):
+        """Tests storing and retrieving the IDs of uploaded sync filters"""
+        user_id = "@bot:example.com"
+        self.assertIsNone(await self.store.get_sync_filter(user_id, "hash1"))
+
+        await self.store.set_sync_filter(user_id, "hash1", "filter1")
+        self.assertEqual(await self.store.get_sync_filter(user_id, "hash1"), "filter1")
+        self.assertIsNone(await self.store.get_sync_filter(user_id, "hash2"))
+        self.assertIsNone(
+            await self.store.get_sync_filter("@other:example.com", "hash1")
+        )
+
+    async def test_fail_cache(self):
+        """Tests that fail counters are served from memory and flushed in batches"""
+        user_id = "@some_user:example.com"
+        room_id = "!abcdefg:example.com"
+
+        self.assertEqual(await self.store.fails.increment(user_id, room_id), 1)
+        self.assertEqual(await self.store.fails.increment(user_id, room_id), 2)
+
+        # Nothing is written to the database until the cache is flushed
+        self.assertEqual(await self.store.get_fail(user_id, room_id), 0)
+        await self.store.fails.flush()
+        self.assertEqual(await self.store.get_fail(user_id, room_id), 2)
+
+        # Resetting a counter deletes its entry on the next flush
+        await self.store.fails.reset(user_id, room_id)
+        self.assertEqual(await self.store.fails.get(user_id, room_id), 0)
+        await self.store.fails.flush()
+        row = await self.store._fetchone("SELECT COUNT(*) FROM fails")
+        self.assertEqual(row[0], 0)
+
+    async def test_fail_cache_eviction(self):
+        """Tests that evicted counters are not lost before they are flushed"""
+        self.store.fails.max_size = 2
+        room_id = "!abcdefg:example.com"
+
+        for user_id in ("@a:example.com", "@b:example.com", "@c:example.com"):
+            await self.store.fails.increment(user_id, room_id)
+
+        # The least recently used counter was evicted, but still has its value
+        self.assertNotIn(("@a:example.com", room_id), self.store.fails._counters)
+        self.assertEqual(await self.store.fails.get("@a:example.com", room_id), 1)
+
+        await self.store.fails.flush()
+        row = await self.store._fetchone("SELECT SUM(attempts) FROM fails")
+        self.assertEqual(row[0], 3)
+
+    async def test_fail_cache_in_flight(self):
+        """Tests that a counter evicted while its change is being written is read
+        from memory, not from the database that doesn't have the change yet"""
+        self.store.fails.max_size = 1
+        room_id = "!abcdefg:example.com"
+        writing = asyncio.Event()
+        written = asyncio.Event()
+        add_fails = self.store.add_fails
+
+        async def slow_add_fails(fails):
+            writing.set()
+            await written.wait()
+            await add_fails(fails)
+
+        await self.store.fails.increment("@a:example.com", room_id)
+        with patch.object(self.store, "add_fails", slow_add_fails):
+            flush = asyncio.ensure_future(self.store.fails.flush())
+            await writing.wait()
+            try:
+                # Evicts the counter being written
+                await self.store.fails.get("@b:example.com", room_id)
+                attempts = await self.store.fails.increment("@a:example.com", room_id)
+            finally:
+                written.set()
+                await flush
+            self.assertEqual(attempts, 2)
+
+            await self.store.fails.flush()
+        self.assertEqual(await self.store.get_fail("@a:example.com", room_id), 2)
+
+    async def test_fail_cache_increments(self):
+        """Tests that fail counters are flushed as increments, so that a late flush
+        doesn't overwrite the counters written by another process"""
+        user_id = "@some_user:example.com"
+        room_id = "!abcdefg:example.com"
+        other_process = FailCounterCache(self.store)
+
+        await self.store.fails.increment(user_id, room_id)
+        await other_process.increment(user_id, room_id, 2)
+        await other_process.flush()
+        await self.store.fails.flush()
+        self.assertEqual(await self.store.get_fail(user_id, room_id), 3)
+
+        # A reset followed by fails replaces the stored counter
+        await self.store.fails.reset(user_id, room_id)
+        await self.store.fails.increment(user_id, room_id)
+        await self.store.fails.flush()
+        self.assertEqual(await self.store.get_fail(user_id, room_id), 1)
+
+    async def test_processed_events(self):
+        """Tests that only events that have been processed are stored, and loaded
+        back on startup"""
+        processed = self.store.processed
+        processed.claim("$pending")
+        processed.claim("$released")
+        processed.release("$released")
+        processed.complete("$done")
+
+        self.assertTrue(processed.contains("$pending"))
+        self.assertFalse(processed.is_processed("$pending"))
+        self.assertFalse(processed.contains("$released"))
+        self.assertTrue(processed.is_processed("$done"))
+
+        await processed.flush()
+        self.assertEqual(await self.store.get_processed_events(10), ["$done"])
+
+        # A restart only skips the processed event
+        processed = ProcessedEventCache(self.store)
+        await processed.load()
+        self.assertTrue(processed.contains("$done"))
+        self.assertFalse(processed.contains("$pending"))
+
+    async def test_processed_events_expiry(self):
+        """Tests that processed events are evicted from memory and expire in the
+        database"""
+        processed = ProcessedEventCache(self.store, max_size=2, retention=-1)
+        for event_id in ("$a", "$b", "$c"):
+            processed.complete(event_id)
+
+        self.assertFalse(processed.contains("$a"))
+        self.assertTrue(processed.contains("$c"))
+
+        await processed.flush()
+        self.assertEqual(await self.store.get_processed_events(10), [])
+
+    async def test_dm_rooms(self):
+        """Tests storing, replacing and deleting the DM room of a user"""
+        user_id = "@some_user:example.com"
+        self.assertIsNone(await self.store.get_dm_room(user_id))
+
+        await self.store.set_dm_room(user_id, "!first:example.com")
+        await self.store.set_dm_room(user_id, "!second:example.com")
+        self.assertEqual(await self.store.get_dm_room(user_id), "!second:example.com")
+
+        await self.store.delete_dm_room(user_id)
+        self.assertIsNone(await self.store.get_dm_room(user_id))
+
+        # DM rooms found by the index don't replace the stored ones
+        await self.store.set_dm_room(user_id, "!second:example.com")
+        await self.store.add_dm_rooms(
+            {user_id: "!third:example.com", "@other:example.com": "!other:example.com"}
+        )
+        self.assertEqual(await self.store.get_dm_room(user_id), "!second:example.com")
+        self.assertEqual(
+            await self.store.get_dm_room("@other:example.com"), "!other:example.com"
+        )
+
+    def test_postgres_placeholders(self):
+        """Tests that ?'s are numbered in order for postgres"""
+        self.assertEqual(
+            _to_postgres_placeholders("SELECT a FROM b WHERE c = ? AND d = ?"),
+            "SELECT a FROM b WHERE c = $1 AND d = $2",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
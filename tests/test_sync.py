@@ -0,0 +1,153 @@
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from nio_channel_bot.ratelimit import rate_limiter
+from nio_channel_bot.storage import Storage
+from nio_channel_bot.sync import RoomStateLoader, build_sync_filter, upload_sync_filter
+
+
+def make_event(event_type, content, state_key="", sender="@admin:example.com"):
+    return {
+        "type": event_type,
+        "state_key": state_key,
+        "sender": sender,
+        "event_id": f"${event_type}{state_key}",
+        "origin_server_ts": 1,
+        "content": content,
+    }
+
+
+class RoomStateLoaderTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        rate_limiter.configure({"state": {"rate": 100, "burst": 100}})
+
+        # Async methods of the spec'd client are AsyncMocks, so return values are plain
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@bot:example.com"
+        self.fake_client.rooms = {}
+        self.fake_client.encrypted_rooms = set()
+
+        self.room_id = "!abcdefg:example.com"
+        self.fake_client.room_get_state.return_value = nio.RoomGetStateResponse(
+            [
+                make_event("m.room.create", {"creator": "@admin:example.com"}),
+                make_event(
+                    "m.room.power_levels",
+                    {"users": {"@admin:example.com": 100, "@bot:example.com": 50}},
+                ),
+                make_event(
+                    "m.room.member",
+                    {"membership": "join"},
+                    state_key="@admin:example.com",
+                ),
+                make_event(
+                    "m.room.member",
+                    {"membership": "join"},
+                    state_key="@bot:example.com",
+                    sender="@bot:example.com",
+                ),
+            ],
+            self.room_id,
+        )
+
+    async def test_load(self):
+        """Tests that the state of an unsynced room is fetched once"""
+        loader = RoomStateLoader(self.fake_client)
+
+        room = await loader.load(self.room_id)
+
+        self.assertIs(self.fake_client.rooms[self.room_id], room)
+        self.assertEqual(room.power_levels.get_user_level("@admin:example.com"), 100)
+        self.assertEqual(set(room.users), {"@admin:example.com", "@bot:example.com"})
+        self.assertTrue(room.members_synced)
+
+        self.assertIs(await loader.load(self.room_id), room)
+        self.fake_client.room_get_state.assert_called_once_with(self.room_id)
+
+    async def test_load_error(self):
+        """Tests that a room whose state can't be fetched isn't loaded"""
+        self.fake_client.room_get_state.return_value = nio.RoomGetStateError(
+            "Not in room", "M_FORBIDDEN", room_id=self.room_id
+        )
+        loader = RoomStateLoader(self.fake_client)
+
+        self.assertIsNone(await loader.load(self.room_id))
+        self.assertFalse(loader.is_loaded(self.room_id))
+        self.assertNotIn(self.room_id, self.fake_client.rooms)
+
+    async def test_synced_room(self):
+        """Tests that rooms synced with their creation event are not fetched"""
+        create_event = nio.Event.parse_event(
+            make_event("m.room.create", {"creator": "@admin:example.com"})
+        )
+        join_info = Mock(state=[create_event], timeline=Mock(events=[]))
+        response = Mock(spec=nio.SyncResponse)
+        response.rooms = Mock(join={self.room_id: join_info}, leave={})
+        self.fake_client.rooms[self.room_id] = nio.MatrixRoom(
+            self.room_id, self.fake_client.user_id
+        )
+        loader = RoomStateLoader(self.fake_client)
+
+        await loader.on_sync(response)
+        await loader.load(self.room_id)
+
+        self.assertTrue(loader.is_loaded(self.room_id))
+        self.fake_client.room_get_state.assert_not_called()
+
+
+class SyncFilterTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        await self.store.connect()
+
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@bot:example.com"
+        self.fake_client.upload_filter.return_value = nio.UploadFilterResponse("1")
+
+    async def asyncTearDown(self) -> None:
+        await self.store.close()
+
+    def test_build(self):
+        """Tests that members are lazy loaded and ephemeral events are filtered out"""
+        sync_filter = build_sync_filter()
+
+        self.assertTrue(sync_filter["room"]["state"]["lazy_load_members"])
+        self.assertEqual(sync_filter["room"]["ephemeral"], {"not_types": ["*"]})
+        self.assertEqual(sync_filter["presence"], {"not_types": ["*"]})
+        self.assertIn("m.room.message", sync_filter["room"]["timeline"]["types"])
+
+    async def test_upload_once(self):
+        """Tests that a filter is uploaded once, and its stored ID reused"""
+        sync_filter = build_sync_filter()
+
+        self.assertEqual(
+            await upload_sync_filter(self.fake_client, self.store, sync_filter), "1"
+        )
+        self.assertEqual(
+            await upload_sync_filter(self.fake_client, self.store, sync_filter), "1"
+        )
+        self.fake_client.upload_filter.assert_called_once()
+
+        # A changed filter is uploaded again
+        self.fake_client.upload_filter.return_value = nio.UploadFilterResponse("2")
+        changed_filter = build_sync_filter(timeline_limit=10)
+        self.assertEqual(
+            await upload_sync_filter(self.fake_client, self.store, changed_filter),
+            "2",
+        )
+
+    async def test_upload_error(self):
+        """Tests that the filter is sent inline if it can't be uploaded"""
+        self.fake_client.upload_filter.return_value = nio.UploadFilterError("Oops")
+        sync_filter = build_sync_filter()
+
+        self.assertEqual(
+            await upload_sync_filter(self.fake_client, self.store, sync_filter),
+            sync_filter,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
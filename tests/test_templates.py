@@ -0,0 +1,70 @@
+import unittest
+
+from nio_channel_bot.errors import ConfigError
+from nio_channel_bot.templates import MessageTemplate, compile_messages
+
+
+class MessageTemplateTestCase(unittest.TestCase):
+    def test_render(self):
+        """Tests that fields are filled in both the body and the formatted body"""
+        template = MessageTemplate(
+            "**Hello** {name}, you have {count} warnings", {"name", "count"}
+        )
+
+        message = template.render(name="Alice", count=2)
+
+        self.assertEqual(message.body, "**Hello** Alice, you have 2 warnings")
+        self.assertEqual(
+            message.formatted_body,
+            "<p><strong>Hello</strong> Alice, you have 2 warnings</p>",
+        )
+
+    def test_values_are_escaped(self):
+        """Tests that values are never interpreted as markdown or HTML"""
+        template = MessageTemplate("# Welcome to {room_name}", {"room_name"})
+
+        message = template.render(room_name="<b>*Room*</b>")
+
+        self.assertEqual(message.body, "# Welcome to <b>*Room*</b>")
+        self.assertEqual(
+            message.formatted_body, "<h1>Welcome to &lt;b&gt;*Room*&lt;/b&gt;</h1>"
+        )
+
+    def test_field_at_end(self):
+        """Tests a template ending with a field"""
+        template = MessageTemplate("Admins: {admins}", {"admins"})
+
+        self.assertEqual(template.render(admins="@a:b").body, "Admins: @a:b")
+
+    def test_escaped_braces(self):
+        """Tests that escaped braces are kept in front of the fields they precede"""
+        template = MessageTemplate("a {{x}} {count} b {{", {"count"})
+
+        message = template.render(count=3)
+
+        self.assertEqual(message.body, "a {x} 3 b {")
+        self.assertEqual(message.body, template.text.format(count=3))
+        self.assertEqual(message.formatted_body, "<p>a {x} 3 b {</p>")
+
+    def test_unknown_field(self):
+        """Tests that using an unknown field is a configuration error"""
+        with self.assertRaises(ConfigError):
+            MessageTemplate("Hello {nme}", {"name"})
+
+    def test_compile_messages(self):
+        """Tests that default messages are used for the ones not configured"""
+        messages = compile_messages({"ban": "Muted in {room_name}"})
+
+        self.assertEqual(
+            messages["ban"].render(room_name="Room", admins="").body, "Muted in Room"
+        )
+        self.assertIn(
+            "Room", messages["warning"].render(count=1, room_name="Room").body
+        )
+
+        with self.assertRaises(ConfigError):
+            compile_messages({"unknown": "text"})
+
+
+if __name__ == "__main__":
+    unittest.main()